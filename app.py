@@ -5,10 +5,13 @@ import signal
 import sys
 
 from channel import channel_factory
+from common import metrics, tokenizer
 from common.log import logger
 from config import conf, load_config
 from plugins import *
 
+channel = None  # 收到退出信号时用于保存未处理完的消息
+
 
 def sigterm_handler_wrap(_signo):
     old_handler = signal.getsignal(_signo)
@@ -16,6 +19,11 @@ def sigterm_handler_wrap(_signo):
     def func(_signo, _stack_frame):
         logger.info("signal {} received, exiting...".format(_signo))
         conf().save_user_datas()
+        if channel is not None and conf().get("checkpoint_on_exit", False):
+            try:
+                channel.checkpoint()
+            except Exception as e:
+                logger.exception("checkpoint failed: {}".format(e))
         if callable(old_handler):  #  check old_handler
             return old_handler(_signo, _stack_frame)
         sys.exit(0)
@@ -24,6 +32,7 @@ def sigterm_handler_wrap(_signo):
 
 
 def run():
+    global channel
     try:
         # load config
         load_config()
@@ -42,6 +51,10 @@ def run():
             os.environ["WECHATY_LOG"] = "warn"
 
         channel = channel_factory.create_channel(channel_name)
+        if conf().get("tokenizer_warmup", True):
+            tokenizer.warmup([conf().get("model") or "gpt-3.5-turbo"])
+        if conf().get("metrics_enabled", False):
+            metrics.start_http_server(conf().get("metrics_port", 9464), conf().get("metrics_host", "0.0.0.0"))
         if channel_name in ["wx", "wxy", "terminal", "wechatmp", "wechatmp_service", "wechatcom_app"]:
             PluginManager().load_plugins()
 
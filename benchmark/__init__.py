@@ -0,0 +1,3 @@
+"""
+性能测试脚本，不依赖微信和OpenAI，在项目根目录下以 python -m benchmark.xxx 的方式运行
+"""
@@ -0,0 +1,248 @@
+"""
+在本地模拟Redis服务，只实现会话存储用到的命令(字符串、hash、过期、WATCH/MULTI/EXEC、SCAN)，数据只保存在内存中
+用于在没有Redis的环境下测试session_store=redis
+
+python -m benchmark.fake_redis --port 6390
+"""
+
+import argparse
+import fnmatch
+import socketserver
+import threading
+import time
+
+
+class FakeRedisError(Exception):
+    pass
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}  # key -> 值(str或dict)
+        self.expires = {}  # key -> 过期时间(time.monotonic)
+        self.revisions = {}  # key -> 修改次数，WATCH通过它判断key是否被修改
+        self.lock = threading.Lock()
+
+    def _alive(self, key):
+        expire = self.expires.get(key)
+        if expire is not None and expire <= time.monotonic():
+            self._delete(key)
+        return key in self.data
+
+    def _delete(self, key):
+        if key in self.data:
+            del self.data[key]
+            self.expires.pop(key, None)
+            self._touch(key)
+            return 1
+        return 0
+
+    def _touch(self, key):
+        self.revisions[key] = self.revisions.get(key, 0) + 1
+
+    def _hash(self, key):
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if not isinstance(value, dict):
+            raise FakeRedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def revision(self, key):
+        self._alive(key)
+        return self.revisions.get(key, 0)
+
+    def call(self, args):
+        name = args[0].upper()
+        method = getattr(self, "cmd_" + name.lower(), None)
+        if method is None:
+            raise FakeRedisError("ERR unknown command '{}'".format(args[0]))
+        return method(*args[1:])
+
+    def cmd_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def cmd_auth(self, *args):
+        return "OK"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_get(self, key):
+        if not self._alive(key):
+            return None
+        return self.data[key]
+
+    def cmd_set(self, key, value, *options):
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if len(options) >= 2 and options[0].upper() == "PX":
+            self.expires[key] = time.monotonic() + int(options[1]) / 1000
+        elif len(options) >= 2 and options[0].upper() == "EX":
+            self.expires[key] = time.monotonic() + int(options[1])
+        self._touch(key)
+        return "OK"
+
+    def cmd_del(self, *keys):
+        return sum(self._delete(key) for key in keys if self._alive(key))
+
+    def cmd_hget(self, key, field):
+        value = self._hash(key)
+        return None if value is None else value.get(field)
+
+    def cmd_hmget(self, key, *fields):
+        value = self._hash(key) or {}
+        return [value.get(field) for field in fields]
+
+    def cmd_hset(self, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise FakeRedisError("ERR wrong number of arguments for 'hset' command")
+        value = self._hash(key)
+        if value is None:
+            value = self.data[key] = {}
+        added = 0
+        for i in range(0, len(pairs), 2):
+            added += pairs[i] not in value
+            value[pairs[i]] = pairs[i + 1]
+        self._touch(key)
+        return added
+
+    def cmd_pexpire(self, key, ms):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.monotonic() + int(ms) / 1000
+        self._touch(key)
+        return 1
+
+    def cmd_expire(self, key, seconds):
+        return self.cmd_pexpire(key, int(seconds) * 1000)
+
+    def cmd_scan(self, cursor, *options):
+        pattern = "*"
+        for i in range(0, len(options) - 1, 2):
+            if options[i].upper() == "MATCH":
+                pattern = options[i + 1]
+        # 一次返回全部匹配的key，cursor总是0
+        return ["0", [key for key in list(self.data) if self._alive(key) and fnmatch.fnmatchcase(key, pattern)]]
+
+    def cmd_flushdb(self, *args):
+        for key in list(self.data):
+            self._delete(key)
+        return "OK"
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True  # pipeline中每条命令的回复单独发送，避免Nagle算法带来的延迟
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.decode("utf-8").split()  # inline命令，比如telnet中输入的PING
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    def _encode(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, FakeRedisError):
+            return b"-" + str(value).encode("utf-8") + b"\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(self._encode(item) for item in value)
+        if value in ("OK", "QUEUED", "PONG"):
+            return b"+" + value.encode("utf-8") + b"\r\n"
+        data = value.encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    def handle(self):
+        db = self.server.db
+        watched = {}  # key -> WATCH时的修改次数
+        queued = None  # MULTI之后排队的命令
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            if not args:
+                continue
+            name = args[0].upper()
+            with db.lock:
+                try:
+                    if name == "WATCH":
+                        for key in args[1:]:
+                            watched.setdefault(key, db.revision(key))
+                        reply = "OK"
+                    elif name == "UNWATCH":
+                        watched.clear()
+                        reply = "OK"
+                    elif name == "MULTI":
+                        queued = []
+                        reply = "OK"
+                    elif name == "DISCARD":
+                        queued = None
+                        watched.clear()
+                        reply = "OK"
+                    elif name == "EXEC":
+                        if queued is None:
+                            raise FakeRedisError("ERR EXEC without MULTI")
+                        if any(db.revision(key) != revision for key, revision in watched.items()):
+                            reply = None
+                        else:
+                            reply = []
+                            for command in queued:
+                                try:
+                                    reply.append(db.call(command))
+                                except FakeRedisError as e:
+                                    reply.append(e)
+                        queued = None
+                        watched.clear()
+                    elif queued is not None:
+                        queued.append(args)
+                        reply = "QUEUED"
+                    else:
+                        reply = db.call(args)
+                except FakeRedisError as e:
+                    reply = e
+            self.wfile.write(self._encode(reply))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), FakeRedisHandler)
+        self.db = FakeRedis()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "redis://{}:{}/0".format(host, port)
+
+    def start(self):
+        """
+        在后台线程中运行，返回redis地址
+        """
+        _thread = threading.Thread(target=self.serve_forever, name="fake_redis", daemon=True)
+        _thread.start()
+        return self.url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake redis server for session store tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    server = FakeRedisServer(args.host, args.port)
+    print("fake redis listening on {}".format(server.url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
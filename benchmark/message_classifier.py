@@ -0,0 +1,109 @@
+"""
+比较原来分散的正则判断和message_classifier.classify处理一条消息的耗时，并检查两者的结果一致
+
+python -m benchmark.message_classifier --number 20000
+"""
+
+import argparse
+import re
+
+from benchmark.utils import timeit
+from channel.message_classifier import (
+    INTENT_BLEND,
+    INTENT_CHANGE,
+    INTENT_DESCRIBE,
+    INTENT_IMAGINE,
+    INTENT_SIMPLE_CHANGE,
+    INTENT_TEXT,
+    classify,
+)
+
+SAMPLES = [
+    "今天天气怎么样",
+    "帮我写一首关于秋天的诗，要求七言绝句，并解释每一句的意思",
+    "$mj a cat sitting on the moon --ar 16:9",
+    "$sd a watercolor landscape",
+    "mju 3 1234567890123456",
+    "$mjv 2 1234567890123456",
+    "mjr 1234567890123456",
+    "1234567890123456 U2",
+    "desc https://example.com/a/b.png",
+    "desc wechat_tmp/230701-120000.png",
+    "https://example.com/1.jpg https://example.com/2.png",
+    "wechat_tmp/230701-120000.png 一只戴帽子的猫",
+    "「张三：$mj a dog」\n- - - - - - - - - - - - - - -\nmju 1 任务ID: 1234567890123456",
+]
+
+
+def legacy_classify(text):
+    """
+    与重构前_compose_context和ChatGPTBot.reply中的判断相同，每项判断单独执行未编译的正则
+    """
+    result = {}
+    if "」\n- - - - - - - - - - - - - - -" in text:
+        try:
+            content_in_brackets = re.search("「(.*)」", text, flags=re.DOTALL).group(1)
+            content_after_dashes = re.findall(r"- - - - - - - - - - - - - - -\n(.+)", text)
+            result["quote_content"] = f"{content_after_dashes[0]} {content_in_brackets.split('：', 1)[1]}"
+        except Exception:
+            result["quote_content"] = None
+    desc_wechat = bool(re.match(r"^desc wechat_tmp/\d{6}-\d{6}\.png$", text))
+    desc_http = bool(re.match(r"^desc http[s]?://[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)$", text))
+    mj_u = text.startswith("$mju") or text.startswith("mju")
+    mj_v = text.startswith("$mjv") or text.startswith("mjv")
+    mj_r = text.startswith("$mjr") or text.startswith("mjr")
+    mj = text.startswith("$mj") or text.startswith("mj ") or mj_u or mj_v or mj_r or desc_http or desc_wechat
+    sd = text.startswith("$sd")
+    http_urls = re.findall(r"http[s]?://[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)", text, re.IGNORECASE)
+    local_urls = re.findall(r"wechat_tmp/[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)", text, re.IGNORECASE)
+    re.search(r"(wechat_tmp/\d{6}-\d{6}\.png)", text)
+    re.search(r"(http[s]?://[^\s]+(?:jpg|jpeg|png|gif|bmp|svg))", text)
+    simple_change = bool(re.match(r"^\s*\d{16}\s+[UVuV][1-4]\s*$", text))
+    if desc_wechat or desc_http:
+        intent = INTENT_DESCRIBE
+    elif (http_urls and local_urls) or len(http_urls) > 1 or len(local_urls) > 1:
+        intent = INTENT_BLEND
+    elif simple_change:
+        intent = INTENT_SIMPLE_CHANGE
+    elif (mj or sd) and (mj_u or mj_v or mj_r):
+        intent = INTENT_CHANGE
+        if mj_u or mj_v:
+            index = re.findall(r"[u|v](\d)", text)
+            result["mj_index"] = index[0] if index else None
+        match = re.search(r"任务ID: (\d+)", text) or re.search(r"[uvr]\s?(\d+)", text)
+        result["mj_task_id"] = match.group(1) if match else None
+    elif mj or sd:
+        intent = INTENT_IMAGINE
+    else:
+        intent = INTENT_TEXT
+    result.update(intent=intent, image_create=mj or sd or desc_wechat or desc_http or intent == INTENT_BLEND)
+    return result
+
+
+def check(text):
+    expected = legacy_classify(text)
+    info = classify(text)
+    assert info.intent == expected["intent"], text
+    assert bool(info.is_image_create()) == expected["image_create"], text
+    assert info.mj_index == expected.get("mj_index"), text
+    assert info.mj_task_id == expected.get("mj_task_id"), text
+    assert info.quote_content == expected.get("quote_content"), text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="message classifier benchmark")
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    for text in SAMPLES:
+        check(text)
+    # _compose_context和ChatGPTBot.reply原来各自执行一遍判断
+    legacy = timeit(lambda: [(legacy_classify(text), legacy_classify(text)) for text in SAMPLES], number=args.number)
+    compiled = timeit(lambda: [classify(text) for text in SAMPLES], number=args.number)
+    print("samples={}".format(len(SAMPLES)))
+    print("legacy regexes:     {:.2f} us/msg".format(legacy / len(SAMPLES) * 1e6))
+    print("MessageInfo:        {:.2f} us/msg".format(compiled / len(SAMPLES) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
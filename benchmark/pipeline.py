@@ -0,0 +1,250 @@
+"""
+端到端测试ChatChannel的处理流程：构造context、调度、插件、bot、包装和发送
+使用内存中的channel和可配置延迟、错误率的bot，不需要微信和OpenAI
+
+python -m benchmark.pipeline --sessions 50 --messages 20 --latency 0.5 --group-ratio 0.3 --command-ratio 0.05 --voice-ratio 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from benchmark.utils import summarize
+from bot.bot import Bot
+from bridge.bridge import Bridge
+from bridge.context import ContextType
+from bridge.reply import Reply, ReplyType
+from channel.chat_channel import ChatChannel
+from channel.chat_message import ChatMessage
+from common.log import logger
+from config import conf, load_config
+from voice.voice import Voice
+
+BOT_NAME = "bench_bot"
+
+
+class StubBot(Bot):
+    """
+    按指定分布模拟上游接口的延迟和错误
+    """
+
+    def __init__(self, latency=0.5, dist="lognormal", error_rate=0.0, seed=None):
+        self.latency = latency
+        self.dist = dist
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        with self.lock:
+            if self.dist == "fixed":
+                delay = self.latency
+            elif self.dist == "uniform":
+                delay = self.random.uniform(0, 2 * self.latency)
+            elif self.dist == "exp":
+                delay = self.random.expovariate(1 / self.latency) if self.latency > 0 else 0
+            else:  # lognormal，均值为latency，有较长的尾部
+                sigma = 0.8
+                delay = self.random.lognormvariate(0, sigma) * self.latency / (2.718281828 ** (sigma**2 / 2))
+            failed = self.random.random() < self.error_rate
+        return delay, failed
+
+    def _reply(self, query, failed):
+        if failed:
+            return Reply(ReplyType.ERROR, "stub bot error")
+        return Reply(ReplyType.TEXT, "reply: " + query)
+
+    def reply(self, query, context=None):
+        delay, failed = self.sample()
+        time.sleep(delay)
+        return self._reply(query, failed)
+
+    async def areply(self, query, context=None):
+        delay, failed = self.sample()
+        await asyncio.sleep(delay)
+        return self._reply(query, failed)
+
+
+class StubVoice(Voice):
+    def __init__(self, bot: StubBot):
+        self.bot = bot
+
+    def voiceToText(self, voice_file):
+        delay, _ = self.bot.sample()
+        time.sleep(delay / 2)
+        return Reply(ReplyType.TEXT, "voice message")
+
+    def textToVoice(self, text):
+        return Reply(ReplyType.VOICE, text)
+
+
+class BenchMessage(ChatMessage):
+    def __init__(self, msg_id, content, ctype, user_id, group_id=None):
+        self.msg_id = msg_id
+        self.create_time = time.time()
+        self.ctype = ctype
+        self.content = content
+        self.from_user_id = group_id or user_id
+        self.to_user_id = BOT_NAME
+        self.other_user_id = group_id or user_id
+        self.other_user_nickname = group_id
+        if group_id:
+            self.is_group = True
+            self.is_at = True
+            self.actual_user_id = user_id
+            self.actual_user_nickname = user_id
+
+
+class BenchChannel(ChatChannel):
+    NOT_SUPPORT_REPLYTYPE = []
+
+    def __init__(self, send_latency=0.0):
+        super().__init__()
+        self.name = BOT_NAME
+        self.user_id = BOT_NAME
+        self.send_latency = send_latency
+        self.latencies = {}  # msg_id -> (kind, 端到端耗时)
+        self.errors = 0
+        self.done_cond = threading.Condition()
+
+    def send(self, reply: Reply, context):
+        if self.send_latency:
+            time.sleep(self.send_latency)
+        cmsg = context["msg"]
+        with self.done_cond:
+            if cmsg.msg_id not in self.latencies:
+                self.latencies[cmsg.msg_id] = (context.get("bench_kind"), time.time() - cmsg.create_time)
+                if reply.type == ReplyType.ERROR:
+                    self.errors += 1
+                self.done_cond.notify_all()
+
+    def startup(self):
+        pass
+
+
+def build_workload(args):
+    """
+    生成 sessions × messages 条消息，按会话轮流发送
+    """
+    rnd = random.Random(args.seed)
+    sessions = []
+    for i in range(args.sessions):
+        group_id = "group_{}".format(i % max(args.groups, 1)) if rnd.random() < args.group_ratio else None
+        sessions.append(("user_{}".format(i), group_id))
+    workload = []
+    for j in range(args.messages):
+        for user_id, group_id in sessions:
+            r = rnd.random()
+            if r < args.command_ratio:
+                kind, ctype, content = "command", ContextType.TEXT, "#help"
+            elif r < args.command_ratio + args.voice_ratio:
+                kind, ctype, content = "voice", ContextType.VOICE, None
+            else:
+                kind, ctype, content = "text", ContextType.TEXT, "message {} from {}".format(j, user_id)
+            if group_id and kind != "voice":
+                kind = "group_" + kind
+                content = "@{} {}".format(BOT_NAME, content)
+            workload.append((kind, ctype, content, user_id, group_id))
+    return workload
+
+
+def run(args):
+    load_config()
+    logger.setLevel(args.log_level)
+    conf()["async_mode"] = args.async_mode
+    conf()["concurrency_in_session"] = args.concurrency
+    conf()["group_name_white_list"] = ["ALL_GROUP"]
+    conf()["speech_recognition"] = True
+    if args.plugins:
+        from plugins import PluginManager
+
+        PluginManager().load_plugins()
+
+    bot = StubBot(args.latency, args.dist, args.error_rate, args.seed)
+    bridge = Bridge()
+    bridge.bots["chat"] = bot
+    bridge.bots["voice_to_text"] = StubVoice(bot)
+    bridge.bots["text_to_voice"] = StubVoice(bot)
+
+    channel = BenchChannel(args.send_latency)
+    channel.channel_type = "bench"
+    workload = build_workload(args)
+    tmpdir = tempfile.mkdtemp(prefix="bench_voice_")
+    expected = 0
+    start = time.time()
+    for msg_id, (kind, ctype, content, user_id, group_id) in enumerate(workload):
+        if ctype == ContextType.VOICE:
+            content = os.path.join(tmpdir, "{}.wav".format(msg_id))  # 处理完成后会被删除
+            open(content, "wb").close()
+        cmsg = BenchMessage(msg_id, content, ctype, user_id, group_id)
+        context = channel._compose_context(ctype, content, isgroup=group_id is not None, msg=cmsg, bench_kind=kind)
+        if context:
+            expected += 1
+            channel.produce(context)
+        if args.rate > 0:
+            time.sleep(1 / args.rate)
+    with channel.done_cond:
+        channel.done_cond.wait_for(lambda: len(channel.latencies) >= expected, timeout=args.timeout)
+    elapsed = time.time() - start
+
+    latencies = list(channel.latencies.values())
+    result = {
+        "messages": len(workload),
+        "produced": expected,
+        "completed": len(latencies),
+        "errors": channel.errors,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency": summarize([t for _, t in latencies]),
+        "by_kind": {kind: summarize([t for k, t in latencies if k == kind]) for kind in sorted({k for k, _ in latencies})},
+        "pools": channel.stage_stats(),
+    }
+    return result
+
+
+def print_report(result):
+    print("messages={messages} produced={produced} completed={completed} errors={errors}".format(**result))
+    print("elapsed={:.2f}s throughput={:.1f} msg/s".format(result["elapsed"], result["throughput"]))
+    print("{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}".format("kind", "count", "p50", "p95", "p99", "max"))
+    rows = [("all", result["latency"])] + list(result["by_kind"].items())
+    for kind, s in rows:
+        print("{:<16}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(kind, s["count"], s["p50"], s["p95"], s["p99"], s["max"]))
+    for stats in result["pools"]:
+        print("pool {name}: max_workers={max_workers} completed={completed}".format(**stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ChatChannel pipeline benchmark")
+    parser.add_argument("--sessions", type=int, default=20, help="会话数")
+    parser.add_argument("--messages", type=int, default=10, help="每个会话的消息数")
+    parser.add_argument("--groups", type=int, default=5, help="群聊会话分布在多少个群中")
+    parser.add_argument("--group-ratio", type=float, default=0.3, help="群聊会话的比例")
+    parser.add_argument("--command-ratio", type=float, default=0.05, help="#指令消息的比例")
+    parser.add_argument("--voice-ratio", type=float, default=0.1, help="语音消息的比例")
+    parser.add_argument("--latency", type=float, default=0.2, help="bot的平均延迟，单位秒")
+    parser.add_argument("--dist", choices=["fixed", "uniform", "exp", "lognormal"], default="lognormal", help="bot延迟的分布")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="bot返回错误的概率")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="每次发送的耗时，单位秒")
+    parser.add_argument("--rate", type=float, default=0, help="每秒发送的消息数，0表示不限制")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrency_in_session")
+    parser.add_argument("--async-mode", action="store_true", help="以async_mode运行")
+    parser.add_argument("--plugins", action="store_true", help="加载插件")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--log-level", default="WARN")
+    parser.add_argument("--json", action="store_true", help="以json格式输出结果")
+    args = parser.parse_args()
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+多个worker同时修改同一批会话，检查各个会话存储没有丢失或重复的消息，并比较每次修改的耗时
+sqlite和redis的每个worker使用各自的存储对象(各自的连接和本地缓存)，模拟多个进程；没有指定--redis-url时使用本地模拟的Redis服务
+
+python -m benchmark.session_store --workers 4 --queries 200
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from benchmark.fake_redis import FakeRedisServer
+from bot.session_manager import Session, SessionManager
+from bot.session_store import (
+    MemorySessionStore,
+    RedisSessionStore,
+    SessionConflict,
+    SqliteSessionStore,
+)
+
+
+class PlainSession(Session):
+    """
+    不计算token的会话，只用于测试存储
+    """
+
+    def __init__(self, session_id, system_prompt=None):
+        super().__init__(session_id, system_prompt)
+        self.reset()
+
+    def discard_exceeding(self, max_tokens=None, cur_tokens=None):
+        return len(self.messages)
+
+    def calc_tokens(self):
+        return len(self.messages)
+
+
+def count_conflicts(store, stats):
+    save = store.save
+
+    def counted(session):
+        try:
+            return save(session)
+        except SessionConflict:
+            stats["conflicts"] += 1
+            raise
+
+    store.save = counted
+    return store
+
+
+def run_workers(make_store, workers, queries, sessions):
+    """
+    每个worker向随机的会话添加queries条消息，返回(耗时, 冲突次数, 各会话应有的消息数)
+    """
+    stats = {"conflicts": 0}
+    expected = {}
+    lock = threading.Lock()
+    managers = [SessionManager(PlainSession, store=count_conflicts(make_store(), stats)) for _ in range(workers)]
+
+    def work(i):
+        rnd = random.Random(i)
+        for j in range(queries):
+            session_id = "s{}".format(rnd.randrange(sessions))
+            managers[i].session_query("worker{} query{}".format(i, j), session_id)
+            with lock:
+                expected[session_id] = expected.get(session_id, 0) + 1
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, stats["conflicts"], expected
+
+
+def check(name, make_store, workers, queries, sessions, shared=True):
+    elapsed, conflicts, expected = run_workers(make_store, workers, queries, sessions)
+    reader = SessionManager(PlainSession, store=make_store())
+    for session_id, count in expected.items():
+        messages = reader.build_session(session_id).messages
+        queries_saved = [m["content"] for m in messages if m["role"] == "user"]
+        assert len(queries_saved) == count, (name, session_id, len(queries_saved), count)
+        assert len(set(queries_saved)) == count, (name, session_id, "duplicated messages")
+    if shared:
+        # 新的存储对象(比如重启后的进程)读取到相同的会话，删除和清空对所有存储对象生效
+        reader.build_session("s0", system_prompt="新的人格")
+        assert SessionManager(PlainSession, store=make_store()).build_session("s0").system_prompt == "新的人格"
+        reader.clear_session("s0")
+        assert len(SessionManager(PlainSession, store=make_store()).build_session("s0").messages) == 1
+        reader.clear_all_session()
+        assert len(SessionManager(PlainSession, store=make_store()).build_session("s1").messages) == 1
+    total = workers * queries
+    print("{:<8} workers={} queries={} sessions={}: {:.3f} ms/query, {} conflicts retried".format(name, workers, total, sessions, elapsed * 1e3 / total, conflicts))
+
+
+def check_expiry(make_store):
+    store = make_store()
+    manager = SessionManager(PlainSession, store=store)
+    manager.session_query("hello", "expiring")
+    assert len(manager.build_session("expiring").messages) == 2
+    time.sleep(store.ttl + 0.2)
+    assert len(manager.build_session("expiring").messages) == 1, "session should expire"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="session store benchmark")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200, help="每个worker添加的消息数")
+    parser.add_argument("--sessions", type=int, default=8, help="会话数量，越少冲突越多")
+    parser.add_argument("--redis-url", default=None, help="使用真实的Redis，默认启动本地模拟的服务")
+    args = parser.parse_args()
+
+    memory = MemorySessionStore(PlainSession, {})
+    check("memory", lambda: memory, args.workers, args.queries, args.sessions)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "sessions.db")
+        check("sqlite", lambda: SqliteSessionStore(PlainSession, {}, path=path), args.workers, args.queries, args.sessions)
+        check_expiry(lambda: SqliteSessionStore(PlainSession, {}, ttl=1, path=os.path.join(tmpdir, "expiry.db")))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    server = None
+    url = args.redis_url
+    if url is None:
+        server = FakeRedisServer()
+        url = server.start()
+    try:
+        prefix = "session-store-benchmark:"
+        check("redis", lambda: RedisSessionStore(PlainSession, {}, url=url, prefix=prefix), args.workers, args.queries, args.sessions)
+        check_expiry(lambda: RedisSessionStore(PlainSession, {}, ttl=1, url=url, prefix=prefix))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main()
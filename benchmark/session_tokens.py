@@ -0,0 +1,152 @@
+"""
+比较会话超长时逐条丢弃并重新计算全部token和按缓存的单条token数丢弃的耗时，并检查两者丢弃后的会话和token数一致
+需要能通过common.tokenizer加载对应模型的编码，离线环境先在联网的机器上执行 python -m common.tokenizer 并复制tiktoken_cache_dir
+
+python -m benchmark.session_tokens --messages 400
+"""
+
+import argparse
+import random
+
+from benchmark.utils import timeit
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_from_messages
+from bot.openai.open_ai_session import OpenAISession, num_tokens_from_string
+from common import tokenizer
+
+MODELS = ("gpt-3.5-turbo", "text-davinci-003")
+
+WORDS = ["今天", "天气", "怎么样", "hello", "world", "python", "token", "会话", "消息", "插件", "，", "。", "\n", "  ", "1234", "A:", "Q:"]
+
+
+def random_text(rnd, n):
+    return "".join(rnd.choice(WORDS) + rnd.choice(["", " "]) for _ in range(n))
+
+
+def build_history(session, rnd, rounds, length=40):
+    for _ in range(rounds):
+        session.add_query(random_text(rnd, rnd.randint(1, length)))
+        session.add_reply(random_text(rnd, rnd.randint(1, length)))
+    session.add_query(random_text(rnd, rnd.randint(1, length)))
+    return session
+
+
+def legacy_chatgpt_discard(session, max_tokens):
+    """
+    重构前ChatGPTSession.discard_exceeding的精确计算部分：每丢弃一条消息重新计算全部消息的token数
+    """
+    messages = session.messages
+    cur_tokens = num_tokens_from_messages(messages, session.model)
+    while cur_tokens > max_tokens:
+        if len(messages) > 2:
+            messages.pop(1)
+        elif len(messages) == 2 and messages[1]["role"] == "assistant":
+            messages.pop(1)
+            cur_tokens = num_tokens_from_messages(messages, session.model)
+            break
+        else:
+            break
+        cur_tokens = num_tokens_from_messages(messages, session.model)
+    return cur_tokens
+
+
+def legacy_prompt(messages):
+    prompt = ""
+    for item in messages:
+        if item["role"] == "system":
+            prompt += item["content"] + "<|endoftext|>\n\n\n"
+        elif item["role"] == "user":
+            prompt += "Q: " + item["content"] + "\n"
+        elif item["role"] == "assistant":
+            prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
+    if len(messages) > 0 and messages[-1]["role"] == "user":
+        prompt += "A: "
+    return prompt
+
+
+def legacy_openai_discard(session, max_tokens):
+    """
+    重构前OpenAISession.discard_exceeding的精确计算部分：每丢弃一条消息重新拼接prompt并计算token数
+    """
+    messages = session.messages
+    cur_tokens = num_tokens_from_string(legacy_prompt(messages), session.model)
+    while cur_tokens > max_tokens:
+        if len(messages) > 1:
+            messages.pop(0)
+        elif len(messages) == 1 and messages[0]["role"] == "assistant":
+            messages.pop(0)
+            cur_tokens = num_tokens_from_string(legacy_prompt(messages), session.model)
+            break
+        else:
+            break
+        cur_tokens = num_tokens_from_string(legacy_prompt(messages), session.model)
+    return cur_tokens
+
+
+def check(sessioncls, legacy, model, rounds=200):
+    rnd = random.Random(1)
+    for i in range(rounds):
+        seed = rnd.random()
+        max_tokens = rnd.choice([1, 20, 100, 300, 1000, 5000])
+        expected = build_history(sessioncls("s", "你是一个助手", model=model), random.Random(seed), rnd.randint(0, 20))
+        actual = build_history(sessioncls("s", "你是一个助手", model=model), random.Random(seed), 0)
+        actual.messages = [dict(m) for m in expected.messages]
+        if i % 2:
+            actual.calc_tokens()  # 先填充缓存，再在后面追加消息，覆盖增量计算的情况
+            extra = random_text(rnd, 10)
+            expected.add_query(extra)
+            actual.add_query(extra)
+        expected_tokens = legacy(expected, max_tokens)
+        actual_tokens = actual.discard_exceeding(max_tokens)
+        assert expected.messages == actual.messages, (sessioncls.__name__, max_tokens)
+        assert expected_tokens == actual_tokens, (sessioncls.__name__, max_tokens, expected_tokens, actual_tokens)
+        if sessioncls is ChatGPTSession:
+            assert actual.calc_tokens() == num_tokens_from_messages(actual.messages, model)
+
+
+def load_encodings():
+    """
+    从tokenizer的缓存加载编码，加载失败(比如离线且没有缓存)时返回错误信息
+    """
+    for model in MODELS:
+        name = tokenizer.encoding_name_for_model(model)
+        try:
+            tokenizer.get_encoding(name)
+        except Exception as e:
+            return "encoding {} for {} is not available in {} ({})".format(name, model, tokenizer.cache_dir(), type(e).__name__)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="session token accounting benchmark")
+    parser.add_argument("--messages", type=int, default=400, help="超长会话的消息数")
+    parser.add_argument("--max-tokens", type=int, default=1000)
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+
+    error = load_encodings()
+    if error:
+        print("skipped, {}".format(error))
+        print("run `python -m common.tokenizer` on a host with network access and copy the cache directory, or set tiktoken_cache_dir")
+        return
+
+    check(ChatGPTSession, legacy_chatgpt_discard, "gpt-3.5-turbo")
+    check(OpenAISession, legacy_openai_discard, "text-davinci-003")
+
+    rounds = args.messages // 2
+    for sessioncls, legacy, model in ((ChatGPTSession, legacy_chatgpt_discard, "gpt-3.5-turbo"), (OpenAISession, legacy_openai_discard, "text-davinci-003")):
+        template = build_history(sessioncls("s", "你是一个助手", model=model), random.Random(2), rounds)
+
+        def run(discard):
+            session = sessioncls("s", "你是一个助手", model=model)
+            session.messages = list(template.messages)
+            discard(session)
+
+        before = timeit(lambda: run(lambda s: legacy(s, args.max_tokens)), repeat=3, number=args.number)
+        after = timeit(lambda: run(lambda s: s.discard_exceeding(args.max_tokens)), repeat=3, number=args.number)
+        print("{} messages={} max_tokens={}".format(sessioncls.__name__, len(template.messages), args.max_tokens))
+        print("  recount after every pop: {:.2f} ms".format(before * 1e3))
+        print("  cached message tokens:   {:.2f} ms".format(after * 1e3))
+
+
+if __name__ == "__main__":
+    main()
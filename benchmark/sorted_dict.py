@@ -0,0 +1,172 @@
+"""
+比较原来基于堆的SortedDict和现在基于二分查找的SortedDict，并用随机操作检查两者的顺序一致
+
+python -m benchmark.sorted_dict --size 200
+"""
+
+import argparse
+import heapq
+import random
+
+from benchmark.utils import timeit
+from common.sorted_dict import SortedDict
+
+
+class LegacySortedDict(dict):
+    """
+    重构前的实现：修改和删除时线性查找并重新heapify，keys()失效后整体排序
+    """
+
+    def __init__(self, sort_func=lambda k, v: k, init_dict=None, reverse=False):
+        if init_dict is None:
+            init_dict = []
+        if isinstance(init_dict, dict):
+            init_dict = init_dict.items()
+        self.sort_func = sort_func
+        self.sorted_keys = None
+        self.reverse = reverse
+        self.heap = []
+        for k, v in init_dict:
+            self[k] = v
+
+    def __setitem__(self, key, value):
+        if key in self:
+            super().__setitem__(key, value)
+            for i, (priority, k) in enumerate(self.heap):
+                if k == key:
+                    self.heap[i] = (self.sort_func(key, value), key)
+                    heapq.heapify(self.heap)
+                    break
+            self.sorted_keys = None
+        else:
+            super().__setitem__(key, value)
+            heapq.heappush(self.heap, (self.sort_func(key, value), key))
+            self.sorted_keys = None
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        for i, (priority, k) in enumerate(self.heap):
+            if k == key:
+                del self.heap[i]
+                heapq.heapify(self.heap)
+                break
+        self.sorted_keys = None
+
+    def keys(self):
+        if self.sorted_keys is None:
+            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
+        return self.sorted_keys
+
+    def items(self):
+        if self.sorted_keys is None:
+            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
+        return [(k, self[k]) for k in self.sorted_keys]
+
+    def _update_heap(self, key):
+        for i, (priority, k) in enumerate(self.heap):
+            if k == key:
+                new_priority = self.sort_func(key, self[key])
+                if new_priority != priority:
+                    self.heap[i] = (new_priority, key)
+                    heapq.heapify(self.heap)
+                    self.sorted_keys = None
+                break
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+def expected_keys(d):
+    return [k for _, k in sorted(((d.sort_func(k, v), k) for k, v in dict.items(d)), reverse=d.reverse)]
+
+
+def check(rounds=5000):
+    """
+    对两种实现执行相同的随机插入、修改、_update_heap和删除，每一步比较遍历顺序
+    原来的实现没有覆盖pop、popitem、setdefault、update和clear，这些操作只对现在的实现执行，再同步到原来的实现
+    """
+    rnd = random.Random(1)
+    for reverse in (False, True):
+        legacy = LegacySortedDict(lambda k, v: v["priority"], reverse=reverse)
+        current = SortedDict(lambda k, v: v["priority"], reverse=reverse)
+        for _ in range(rounds):
+            key = "p{}".format(rnd.randrange(50))
+            op = rnd.random()
+            if op < 0.5:
+                priority = rnd.randrange(-5, 5)  # 范围较小，覆盖排序值相同按key排序的情况
+                legacy[key] = {"priority": priority}
+                current[key] = {"priority": priority}
+            elif op < 0.8 and key in legacy:
+                priority = rnd.randrange(-5, 5)
+                legacy[key]["priority"] = priority
+                current[key]["priority"] = priority
+                legacy._update_heap(key)
+                current._update_heap(key)
+            elif op < 0.85 and key in legacy:
+                del legacy[key]
+                del current[key]
+            elif op < 0.9:
+                current.pop(key, None)
+                if key in legacy:
+                    del legacy[key]
+            elif op < 0.94 and current:
+                popped, _ = current.popitem()
+                assert popped == legacy.keys()[-1]
+                del legacy[popped]
+            elif op < 0.97:
+                priority = rnd.randrange(-5, 5)
+                current.setdefault(key, {"priority": priority})
+                if key not in legacy:
+                    legacy[key] = {"priority": priority}
+            elif op < 0.999:
+                priority = rnd.randrange(-5, 5)
+                current.update({key: {"priority": priority}})
+                legacy[key] = {"priority": priority}
+            else:
+                current.clear()
+                for k in list(legacy.keys()):
+                    del legacy[k]
+            assert list(current.keys()) == expected_keys(current)
+            assert list(legacy.keys()) == list(current.keys())
+            assert [k for k, _ in legacy.items()] == [k for k, _ in current.items()]
+
+
+class Plugin(object):
+    def __init__(self, priority):
+        self.priority = priority
+
+
+def workload(cls, size, rnd_seed=1):
+    """
+    模拟插件管理：逐个注册插件，按plugins.json调整优先级，每次调整后遍历一次，最后逐个卸载
+    """
+    rnd = random.Random(rnd_seed)
+    plugins = cls(lambda k, v: v.priority, reverse=True)
+    names = ["PLUGIN{}".format(i) for i in range(size)]
+    for name in names:
+        plugins[name] = Plugin(rnd.randrange(-1000, 1000))
+    for name in names:
+        plugins[name].priority = rnd.randrange(-1000, 1000)
+        plugins._update_heap(name)
+        for _ in plugins.items():
+            pass
+    for name in names:
+        del plugins[name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sorted dict benchmark")
+    parser.add_argument("--size", type=int, default=200, help="插件数量")
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    check()
+    legacy = timeit(lambda: workload(LegacySortedDict, args.size), repeat=3, number=args.number)
+    current = timeit(lambda: workload(SortedDict, args.size), repeat=3, number=args.number)
+    print("size={}".format(args.size))
+    print("heap SortedDict:   {:.2f} ms/workload".format(legacy * 1e3))
+    print("bisect SortedDict: {:.2f} ms/workload".format(current * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+检查AdaptiveStagePool对突发任务的并发度：已经有空闲线程时同时提交一批任务，这批任务应该并行执行，而不是排队等待同一个线程
+
+python -m benchmark.stage_pool --tasks 8 --task-time 0.5
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures.thread import BrokenThreadPool
+
+from common.stage_pool import AdaptiveStagePool
+
+
+def burst(pool, tasks, task_time):
+    """
+    同时提交tasks个耗时task_time的任务，返回全部完成的耗时和执行过任务的线程数
+    """
+    threads = set()
+    lock = threading.Lock()
+
+    def task():
+        with lock:
+            threads.add(threading.current_thread().name)
+        time.sleep(task_time)
+
+    start = time.perf_counter()
+    futures = [pool.submit(task) for _ in range(tasks)]
+    for future in futures:
+        future.result()
+    return time.perf_counter() - start, len(threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="adaptive stage pool burst benchmark")
+    parser.add_argument("--tasks", type=int, default=8, help="一批同时提交的任务数")
+    parser.add_argument("--task-time", type=float, default=0.5, help="每个任务的耗时，单位秒")
+    args = parser.parse_args()
+
+    pool = AdaptiveStagePool("burst", min_workers=args.tasks, max_workers=args.tasks * 2, interval=3600)
+    pool.submit(lambda: None).result()  # 先执行一个任务，留下一个空闲线程
+    time.sleep(0.05)
+    elapsed, workers = burst(pool, args.tasks, args.task_time)
+    print("tasks={} task_time={}s: {:.2f}s on {} workers".format(args.tasks, args.task_time, elapsed, workers))
+    assert workers == args.tasks, "burst should run on {} workers, got {}".format(args.tasks, workers)
+    assert elapsed < args.task_time * 2, "burst took {:.2f}s, tasks were not run concurrently".format(elapsed)
+
+    # 线程数达到上限后，超出的任务排队等待
+    limited = AdaptiveStagePool("limited", min_workers=2, max_workers=2, interval=3600)
+    elapsed, workers = burst(limited, 4, args.task_time)
+    print("min_workers=max_workers=2, tasks=4: {:.2f}s on {} workers".format(elapsed, workers))
+    assert workers == 2 and elapsed >= args.task_time * 2 * 0.9
+
+    # initializer失败时与ThreadPoolExecutor一致：排队的任务以BrokenThreadPool结束，之后不能再提交任务
+    def initializer():
+        raise RuntimeError("initializer failed")
+
+    broken = AdaptiveStagePool("broken", min_workers=2, max_workers=4, initializer=initializer, interval=3600)
+    futures = [broken.submit(time.sleep, args.task_time) for _ in range(4)]
+    for future in futures:
+        assert isinstance(future.exception(timeout=5), BrokenThreadPool), "queued task should fail with BrokenThreadPool"
+    stats = broken.stats()
+    assert stats["workers"] == 0 and stats["pending"] == 0, stats
+    try:
+        broken.submit(time.sleep, 0)
+    except BrokenThreadPool:
+        pass
+    else:
+        raise AssertionError("submit should fail after the initializer failed")
+    print("failing initializer: {} queued tasks failed with BrokenThreadPool".format(len(futures)))
+
+
+if __name__ == "__main__":
+    main()
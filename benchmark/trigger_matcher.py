@@ -0,0 +1,43 @@
+"""
+比较逐个匹配触发词和编译后的匹配器的耗时
+
+python -m benchmark.trigger_matcher --keywords 300
+"""
+
+import argparse
+import random
+import string
+
+from benchmark.utils import timeit
+from channel.chat_channel import check_contain, check_prefix
+from common.trigger_matcher import AhoCorasick, PrefixTrie
+
+
+def random_word(rnd, n):
+    return "".join(rnd.choice(string.ascii_lowercase) for _ in range(n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="trigger matcher benchmark")
+    parser.add_argument("--keywords", type=int, default=300, help="关键词和前缀的数量")
+    parser.add_argument("--length", type=int, default=200, help="消息长度")
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    prefixes = ["@" + random_word(rnd, 4) for _ in range(args.keywords)]
+    keywords = [random_word(rnd, 6) for _ in range(args.keywords)]
+    content = random_word(rnd, args.length)  # 不会触发的消息，需要检查所有触发词
+    trie, automaton = PrefixTrie(prefixes), AhoCorasick(keywords)
+    assert trie.match(content) == check_prefix(content, prefixes)
+    assert (automaton.search(content) is not None) == bool(check_contain(content, keywords))
+
+    linear = timeit(lambda: (check_prefix(content, prefixes), check_contain(content, keywords)), number=args.number)
+    compiled = timeit(lambda: (trie.match(content), automaton.search(content)), number=args.number)
+    print("keywords={} length={}".format(args.keywords, args.length))
+    print("check_prefix + check_contain: {:.2f} us/msg".format(linear * 1e6))
+    print("PrefixTrie + AhoCorasick:     {:.2f} us/msg".format(compiled * 1e6))
+
+
+if __name__ == "__main__":
+    main()
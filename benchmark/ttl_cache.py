@@ -0,0 +1,147 @@
+"""
+比较原来基于datetime的ExpiredDict和现在的TTLCache的读写和遍历耗时，并检查两者在过期和刷新上的行为一致
+
+python -m benchmark.ttl_cache --size 10000
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from benchmark.utils import timeit
+from common import ttl_cache
+from common.expired_dict import ExpiredDict
+
+
+class LegacyExpiredDict(dict):
+    """
+    重构前的实现：每次读取都调用datetime.now()并重写元组，遍历时逐个key检查是否过期，过期的项只在被读取时删除
+    """
+
+    def __init__(self, expires_in_seconds):
+        super().__init__()
+        self.expires_in_seconds = expires_in_seconds
+
+    def __getitem__(self, key):
+        value, expiry_time = super().__getitem__(key)
+        if datetime.now() > expiry_time:
+            del self[key]
+            raise KeyError("expired {}".format(key))
+        self.__setitem__(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
+        super().__setitem__(key, (value, expiry_time))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def keys(self):
+        keys = list(super().keys())
+        return [key for key in keys if key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return self.keys().__iter__()
+
+
+class FakeClock(object):
+    EPOCH = datetime(2023, 1, 1)
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def datetime_now(self):
+        return self.EPOCH + timedelta(seconds=self.now)
+
+
+def check(rounds=3000):
+    """
+    用假时钟对两种实现执行相同的随机写入、读取、in判断、删除和遍历，每一步比较结果
+    原来的items()会刷新所有项的过期时间，现在只返回未过期的项，这里直接读取原来实现中未过期的项进行比较
+    """
+    global datetime
+    clock = FakeClock()
+    old_monotonic, old_datetime = ttl_cache.time.monotonic, datetime
+    ttl_cache.time.monotonic = clock.monotonic
+    datetime = type("FakeDatetime", (), {"now": staticmethod(clock.datetime_now)})
+    try:
+        rnd = random.Random(1)
+        legacy = LegacyExpiredDict(10)
+        current = ExpiredDict(10)
+        for _ in range(rounds):
+            clock.now += rnd.choice([0, 0.5, 1, 3, 11])
+            key = "k{}".format(rnd.randrange(30))
+            op = rnd.random()
+            if op < 0.4:
+                legacy[key] = current[key] = rnd.random()
+            elif op < 0.6:
+                assert legacy.get(key) == current.get(key)
+            elif op < 0.8:
+                assert (key in legacy) == (key in current)
+            elif op < 0.9 and key in legacy:
+                assert key in current
+                del legacy[key]
+                del current[key]
+            else:
+                now = clock.datetime_now()
+                alive = [(k, v) for k, (v, expiry_time) in dict.items(legacy) if now <= expiry_time]
+                assert sorted(alive) == sorted(current.items())
+    finally:
+        ttl_cache.time.monotonic = old_monotonic
+        datetime = old_datetime
+
+
+def workload(cache, keys):
+    """
+    模拟消息去重和会话读取：先判断是否存在，不存在时写入，存在时读取
+    """
+    for key in keys:
+        if key in cache:
+            cache[key]
+        else:
+            cache[key] = key
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ttl cache benchmark")
+    parser.add_argument("--size", type=int, default=10000, help="缓存中的key数量")
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+
+    check()
+    rnd = random.Random(2)
+    keys = [rnd.randrange(args.size) for _ in range(args.size * 4)]
+    for name, cls in (("datetime ExpiredDict", LegacyExpiredDict), ("monotonic TTLCache", ExpiredDict)):
+        cache = cls(3600)
+        ops = timeit(lambda: workload(cache, keys), repeat=3, number=args.number)
+        scan = timeit(lambda: cache.items(), repeat=3, number=args.number)
+        print("{:<22} {:.2f} ms/{} ops, items() {:.2f} ms".format(name, ops * 1e3, len(keys), scan * 1e3))
+
+    # 原来的实现中，写入后不再访问的项不会被删除
+    legacy, current = LegacyExpiredDict(0.05), ExpiredDict(0.05)
+    for i in range(args.size):
+        legacy[i] = current[i] = i
+    time.sleep(0.2)  # 等待后台清理线程
+    print("entries left after expiry: legacy={} current={}".format(dict.__len__(legacy), len(current.data)))
+
+
+if __name__ == "__main__":
+    main()
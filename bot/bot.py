@@ -15,3 +15,12 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def areply(self, query, context: Context = None) -> Reply:
+        """
+        async version of reply, used by the asyncio pipeline of ChatChannel
+        bots without a native implementation run reply in the bounded executor
+        """
+        from common.async_runner import AsyncRunner
+
+        return await AsyncRunner().run_sync(self.reply, query, context)
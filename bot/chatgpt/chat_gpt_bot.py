@@ -1,4 +1,5 @@
 # encoding:utf-8
+import asyncio
 import base64
 import fcntl
 import json
@@ -17,10 +18,18 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from channel.common_utils import Utils
+from channel.message_classifier import (
+    INTENT_BLEND,
+    INTENT_CHANGE,
+    INTENT_DESCRIBE,
+    INTENT_SIMPLE_CHANGE,
+    classify_context,
+    remove_prefix_mj_sd,
+)
+from common.async_runner import AsyncRunner
 from common.log import logger
 from common.token_bucket import TokenBucket
-from config import conf, load_config
+from config import conf, load_config, snapshot, subscribe
 from lib import itchat
 
 
@@ -29,28 +38,66 @@ class ChatGPTBot(Bot, OpenAIImage):
 
     def __init__(self):
         super().__init__()
+        self.tb4chatgpt = None
+        self.sessions = SessionManager(ChatGPTSession, summarizer=self.summarize, model=conf().get("model") or "gpt-3.5-turbo")
+        self._apply_config(snapshot())
+        subscribe(self._apply_config)  # 重新加载配置后立即生效
+
+    def _apply_config(self, config):
         # set the default api_key
-        openai.api_key = conf().get("open_ai_api_key")
-        if conf().get("open_ai_api_base"):
-            openai.api_base = conf().get("open_ai_api_base")
-        proxy = conf().get("proxy")
+        openai.api_key = config.get("open_ai_api_key")
+        if config.get("open_ai_api_base"):
+            openai.api_base = config.get("open_ai_api_base")
+        proxy = config.get("proxy")
         if proxy:
             openai.proxy = proxy
-        if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
-
-        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
-        self.args = {
-            "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称
-            "temperature": conf().get("temperature", 0.9),  # 值在[0,1]之间，越大表示回复越具有不确定性
+        rate = config.get("rate_limit_chatgpt")
+        if not self.tb4chatgpt or self.tb4chatgpt.capacity != int(rate or 0):
+            old, self.tb4chatgpt = self.tb4chatgpt, TokenBucket(rate) if rate else None
+            if old:
+                old.close()
+        # 整体替换，处理中的请求继续使用旧的参数
+        self.args = self._build_args(config)
+
+    def _build_args(self, config):
+        return {
+            "model": config.get("model") or "gpt-3.5-turbo",  # 对话模型的名称
+            "temperature": config.get("temperature", 0.9),  # 值在[0,1]之间，越大表示回复越具有不确定性
             # "max_tokens":4096,  # 回复最大的字符数
-            "top_p": conf().get("top_p", 1),
-            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-            "request_timeout": conf().get("request_timeout", None),  # 请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
-            "timeout": conf().get("request_timeout", None),  # 重试超时时间，在这个时间内，将会自动重试
+            "top_p": config.get("top_p", 1),
+            "frequency_penalty": config.get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": config.get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "request_timeout": config.get("request_timeout", None),  # 请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
+            "timeout": config.get("request_timeout", None),  # 重试超时时间，在这个时间内，将会自动重试
         }
 
+    def summarize(self, summary, messages):
+        """
+        把被丢弃的对话合并进之前的摘要，在SessionManager的后台线程中调用
+        """
+        config = snapshot()
+        lines = []
+        for message in messages:
+            role = "用户" if message["role"] == "user" else "助手"
+            lines.append("{}: {}".format(role, message["content"]))
+        prompt = "之前的摘要：\n{}\n\n新的对话：\n{}".format(summary or "无", "\n".join(lines))
+        args = self.args.copy()
+        if config.conversation_compaction_model:
+            args["model"] = config.conversation_compaction_model
+        args["temperature"] = 0
+        args["max_tokens"] = config.conversation_compaction_max_tokens
+        response = openai.ChatCompletion.create(
+            messages=[
+                {
+                    "role": "system",
+                    "content": "你负责压缩对话记录。把新的对话合并进之前的摘要，保留用户的身份、偏好、需求和已经达成的结论，省略寒暄和重复内容，直接输出新的摘要。",
+                },
+                {"role": "user", "content": prompt},
+            ],
+            **args,
+        )
+        return response.choices[0]["message"]["content"]
+
     def get_http_file_base64(self, url):
         # 发送HTTP请求，下载文件内容
         response = requests.get(url)
@@ -77,21 +124,6 @@ class ChatGPTBot(Bot, OpenAIImage):
         finally:
             return base64_wechat_pic
 
-    def extract_http_local_urls(self, input_string):
-        # 定义图片链接的正则表达式
-        image_urls_pattern = r"http[s]?://[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)"
-
-        # 定义图片链接的正则表达式
-        pattern = r"wechat_tmp/[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)"
-
-        # 使用 re.findall() 查找所有匹配的图片链接
-        image_http_urls = re.findall(image_urls_pattern, input_string, re.IGNORECASE)
-
-        # 使用 re.findall() 查找所有匹配的图片链接和本地文件地址
-        image_local_urls = re.findall(pattern, input_string, re.IGNORECASE)
-
-        return image_http_urls, image_local_urls
-
     def is_just_wechat_pic(self, input_string):
         pattern = r"^wechat_tmp/\d{6}-\d{6}\.png$"
         if re.match(pattern, input_string):
@@ -99,29 +131,11 @@ class ChatGPTBot(Bot, OpenAIImage):
         else:
             return False
 
-    def get_wechat_pic(self, input_string):
-        pattern = r"(wechat_tmp/\d{6}-\d{6}\.png)"
-        match = re.search(pattern, input_string)
-        if match:
-            matched_value = match.group(1)
-            return matched_value
-        else:
-            return None
-
     def remove_wechat_pic_value(self, input_string):
         pattern = r'wechat_tmp/\d+-\d+\.png'
         result = re.sub(pattern, '', input_string)
         return result
 
-    def is_valid_format(self, input_string):
-        # 定义正则表达式匹配模式
-        pattern = r'^\s*\d{16}\s+[UVuV][1-4]\s*$'
-        # 使用re模块的match函数进行匹配
-        if re.match(pattern, input_string):
-            return True
-        else:
-            return False
-
     def extract_number(self, input_string):
         pattern = r'\b\d+\b'  # 匹配一个或多个数字，只匹配单词边界处的数字
         number = re.search(pattern, input_string)
@@ -132,7 +146,11 @@ class ChatGPTBot(Bot, OpenAIImage):
         cleaned_string = re.sub(r'[ \x08]', '', input_string)
         return cleaned_string
 
-    def get_chatgpt_content(self, session_id, query, context):
+    def _prepare_chatgpt_query(self, session_id, query, context):
+        """
+        处理内置指令并把query写入会话
+        :return: (指令的回复, 会话, api_key, 请求参数)，指令的回复不为空时不需要请求openai
+        """
         reply = None
         clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
         if query in clear_memory_commands:
@@ -145,7 +163,7 @@ class ChatGPTBot(Bot, OpenAIImage):
             load_config()
             reply = Reply(ReplyType.INFO, "配置已更新")
         if reply:
-            return reply
+            return reply, None, None, None
         session = self.sessions.session_query(query, session_id)
         logger.info("[CHATGPT] session query={}".format(session.messages))
 
@@ -155,6 +173,12 @@ class ChatGPTBot(Bot, OpenAIImage):
         if model:
             new_args = self.args.copy()
             new_args["model"] = model
+        return None, session, api_key, new_args
+
+    def get_chatgpt_content(self, session_id, query, context):
+        reply, session, api_key, new_args = self._prepare_chatgpt_query(session_id, query, context)
+        if reply:
+            return reply
         # if context.get('stream'):
         # reply in stream
         # return self.reply_text_stream(query, new_query, session_id)
@@ -169,39 +193,75 @@ class ChatGPTBot(Bot, OpenAIImage):
         )
         return reply_content
 
+    async def aget_chatgpt_content(self, session_id, query, context):
+        # 读写会话和重新加载配置都是阻塞的文件或网络操作(会话存储可能是sqlite或redis)，放到线程池中执行
+        reply, session, api_key, new_args = await AsyncRunner().run_sync(self._prepare_chatgpt_query, session_id, query, context)
+        if reply:
+            return reply
+        reply_content = await self.areply_text(session, api_key, args=new_args)
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        return reply_content
+
+    def _build_text_reply(self, session_id, reply_content):
+        if isinstance(reply_content, Reply):  # 内置指令的回复
+            return reply_content
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.info("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def _notify(self, context, content):
+        """
+        推送作图进度等中间消息，交给channel的发送调度，与最终回复保持顺序
+        """
+        channel = context.get("channel")
+        if channel is not None:
+            channel.deliver(Reply(ReplyType.TEXT, content), context)
+        else:
+            itchat.send_msg(content, toUserName=context["receiver"])
+
+    async def areply(self, query, context=None):
+        if context.type == ContextType.TEXT:
+            logger.info("[CHATGPT] query={}".format(query))
+            session_id = context["session_id"]
+            reply_content = await self.aget_chatgpt_content(session_id, query, context)
+            return await AsyncRunner().run_sync(self._build_text_reply, session_id, reply_content)
+        # 作图等流程仍然是同步实现，放到有界线程池中执行
+        return await super().areply(query, context)
+
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
             logger.info("[CHATGPT] query={}".format(query))
             session_id = context["session_id"]
             reply_content = self.get_chatgpt_content(session_id, query, context)
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.info("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._build_text_reply(session_id, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
             mj_success = False
             mj_image_url = ""
             prompts_desc = None
-            use_mj_prefix = Utils.check_prefix_mj(query)
-            use_sd_prefix = Utils.check_prefix_sd(query)
-            check_prefix_mj_u = Utils.check_prefix_mj_u(query)
-            check_prefix_mj_v = Utils.check_prefix_mj_v(query)
-            check_prefix_mj_r = Utils.check_prefix_mj_r(query)
+            # 复用_compose_context中的分类结果，query被插件修改过时重新分类
+            info = classify_context(context, query)
             try:
-                image_http_urls, image_local_urls = self.extract_http_local_urls(query)
-                logger.info(f"{image_http_urls} {image_local_urls}")
-                wechat_pic_path = self.get_wechat_pic(query)
-                wechat_http_path = Utils.get_http_pic(query)
-                use_simple_change = self.is_valid_format(query)
+                image_http_urls, image_local_urls = info.http_urls, info.local_urls
+                logger.info(f"{info}")
+                wechat_pic_path = info.wechat_pic
+                wechat_http_path = info.http_pic
                 base64_wechat_pic = None
-                if Utils.is_just_desc_wechat_pic(query) or Utils.is_just_desc_http_pic(query):
+                if info.intent == INTENT_DESCRIBE:
                     if wechat_pic_path:
                         base64_wechat_pic = f"data:image/png;base64,{self.get_local_wechat_pic_base64(wechat_pic_path)}"
                     elif wechat_http_path:
@@ -213,8 +273,7 @@ class ChatGPTBot(Bot, OpenAIImage):
                     code = response.json()["code"]
                     result_id = response.json()["result"]
                     description = response.json()["description"]
-                elif (len(image_http_urls) > 0 and len(image_local_urls) > 0) or len(image_http_urls) > 1 or len(
-                        image_local_urls) > 1:
+                elif info.intent == INTENT_BLEND:
                     url = "http://192.168.0.104:8080/mj/submit/blend"
                     headers = {"Content-Type": "application/json", "Accept": "application/json"}
                     base64_array = []
@@ -232,7 +291,7 @@ class ChatGPTBot(Bot, OpenAIImage):
                     code = response.json()["code"]
                     result_id = response.json()["result"]
                     description = response.json()["description"]
-                elif use_simple_change:
+                elif info.intent == INTENT_SIMPLE_CHANGE:
                     url = "http://192.168.0.104:8080/mj/submit/simple-change"
                     headers = {"Content-Type": "application/json", "Accept": "application/json"}
                     response = requests.request("POST", url, headers=headers,
@@ -241,27 +300,12 @@ class ChatGPTBot(Bot, OpenAIImage):
                     code = response.json()["code"]
                     result_id = response.json()["result"]
                     description = response.json()["description"]
-                elif (use_mj_prefix is True or use_sd_prefix is True) and (
-                        check_prefix_mj_u or check_prefix_mj_v or check_prefix_mj_r):
+                elif info.intent == INTENT_CHANGE:
                     url = "http://192.168.0.104:8080/mj/submit/change"
-                    action = None
-                    index = None
-                    if check_prefix_mj_u:
-                        action = "UPSCALE"
-                        index = Utils.extract_mj_u_v_index(query)
-                    elif check_prefix_mj_v:
-                        action = "VARIATION"
-                        index = Utils.extract_mj_u_v_index(query)
-                    else:
-                        action = "REROLL"
-                    task_id = None
-                    task_id = Utils.extract_ref_msg_mj_task_id(query)
-                    if task_id is None:
-                        task_id = Utils.extract_mj_task_id(query)
-                    params = {"action": action}
-                    if index is not None:
-                        params["index"] = index
-                    params["taskId"] = task_id
+                    params = {"action": info.mj_action}
+                    if info.mj_index is not None:
+                        params["index"] = info.mj_index
+                    params["taskId"] = info.mj_task_id
                     headers = {"Content-Type": "application/json", "Accept": "application/json"}
                     response = requests.request("POST", url, headers=headers, data=json.dumps(params))
                     logger.info(f"[change] query: {query}, params: {json.dumps(params)}, response: {response.json()} ")
@@ -273,8 +317,8 @@ class ChatGPTBot(Bot, OpenAIImage):
                         base64_wechat_pic = f"data:image/png;base64,{self.get_local_wechat_pic_base64(wechat_pic_path)}"
                     elif wechat_http_path:
                         base64_wechat_pic = f"data:image/png;base64,{self.get_http_file_base64(wechat_http_path)}"
-                    if use_mj_prefix is True or use_sd_prefix is True:
-                        query = Utils.remove_prefix_mj_sd(query)
+                    if info.mj or info.sd:
+                        query = remove_prefix_mj_sd(query)
                     url = "http://192.168.0.104:8080/mj/submit/imagine"
                     headers = {"Content-Type": "application/json", "Accept": "application/json"}
                     if base64_wechat_pic:
@@ -310,9 +354,8 @@ class ChatGPTBot(Bot, OpenAIImage):
                                     mj_success = json_data.get("status") == "SUCCESS"
                                     if mj_success and json_data.get("action") == "DESCRIBE":
                                         prompts_desc = json_data.get("prompt")
-                                        itchat.send_msg(f"任务ID: {result_id} {prompt}... 进度100%",
-                                                        toUserName=context["receiver"])
-                                        itchat.send_msg(json_data.get("imageUrl"), toUserName=context["receiver"])
+                                        self._notify(context, f"任务ID: {result_id} {prompt}... 进度100%")
+                                        self._notify(context, json_data.get("imageUrl"))
                                         os.remove(file_name)
                                         break
                                     mj_image_url = json_data.get("imageUrl")
@@ -330,19 +373,19 @@ class ChatGPTBot(Bot, OpenAIImage):
                                     progress_tip = f"任务ID: {result_id} {prompt}... 进度{progress_json}"
 
                                     if 0 < progress_value < 20 and progress_0_20_once:
-                                        itchat.send_msg(progress_tip, toUserName=context["receiver"])
+                                        self._notify(context, progress_tip)
                                         progress_0_20_once = False
                                     elif 40 < progress_value < 50 and progress_30_50_once:
-                                        itchat.send_msg(progress_tip, toUserName=context["receiver"])
+                                        self._notify(context, progress_tip)
                                         progress_30_50_once = False
                                     elif 60 < progress_value < 80 and progress_60_80_once:
-                                        itchat.send_msg(progress_tip, toUserName=context["receiver"])
+                                        self._notify(context, progress_tip)
                                         progress_60_80_once = False
                                     elif 90 < progress_value <= 100 and progress_90_100_once:
-                                        itchat.send_msg(progress_tip, toUserName=context["receiver"])
+                                        self._notify(context, progress_tip)
                                         progress_90_100_once = False
                                     elif progress_value == 0 and progress_init_tip_once:
-                                        itchat.send_msg(progress_tip, toUserName=context["receiver"])
+                                        self._notify(context, progress_tip)
                                         progress_init_tip_once = False
                                 finally:
                                     fcntl.flock(file, fcntl.LOCK_UN)  # 释放锁
@@ -364,13 +407,12 @@ class ChatGPTBot(Bot, OpenAIImage):
                 logger.info(f"An IOError occurred while reading the file: {e}")
             except Exception as e:
                 os.remove(file_name)
-                itchat.send_msg(f"出现了异常: {e}", toUserName=context["receiver"])
+                self._notify(context, f"出现了异常: {e}")
                 logger.info(f"An Exception: {e}")
 
             if prompts_desc:
-                itchat.send_msg(prompts_desc, toUserName=context["receiver"])
-                time.sleep(2)
-                itchat.send_msg("正在翻译成中文", toUserName=context["receiver"])
+                self._notify(context, prompts_desc)
+                self._notify(context, "正在翻译成中文")
                 session_id = context["session_id"]
                 reply_content = self.get_chatgpt_content(session_id, f"翻译以下内容：{prompts_desc}", context)
                 if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
@@ -379,7 +421,7 @@ class ChatGPTBot(Bot, OpenAIImage):
                     reply = reply_content["content"]
                 else:
                     reply = prompts_desc
-                itchat.send_msg(reply, toUserName=context["receiver"])
+                self._notify(context, reply)
                 current_thread = threading.current_thread()
                 thread_name = current_thread.name
                 logger.info(f"当前线程的名字是：{thread_name}")
@@ -387,9 +429,9 @@ class ChatGPTBot(Bot, OpenAIImage):
             elif mj_success:
                 ok = mj_success
                 ret_string = mj_image_url
-                itchat.send_msg(ret_string, toUserName=context["receiver"])
+                self._notify(context, ret_string)
             else:
-                itchat.send_msg(f"任务ID: {result_id} 作图出现了异常：{description}", toUserName=context["receiver"])
+                self._notify(context, f"任务ID: {result_id} 作图出现了异常：{description}")
             reply = None
             if ok:
                 reply = Reply(ReplyType.IMAGE_URL, ret_string)
@@ -407,7 +449,8 @@ class ChatGPTBot(Bot, OpenAIImage):
         :return: {}
         """
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            tb4chatgpt = self.tb4chatgpt
+            if tb4chatgpt and not tb4chatgpt.get_token():
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
             # if api_key == None, the default openai.api_key will be used
             if args is None:
@@ -415,43 +458,76 @@ class ChatGPTBot(Bot, OpenAIImage):
             response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
             # logger.info("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            return self._completion_result(response)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
-            else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
+            result, retry_delay, clear_session = self._handle_text_error(e, retry_count)
+            if clear_session:
                 self.sessions.clear_session(session.session_id)
+            if retry_delay is None:
+                return result
+            time.sleep(retry_delay)
+            logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+            return self.reply_text(session, api_key, args, retry_count + 1)
 
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
+    async def areply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+        """
+        async version of reply_text, call openai's ChatCompletion.acreate without blocking a thread
+        """
+        runner = AsyncRunner()
+        try:
+            tb4chatgpt = self.tb4chatgpt
+            if tb4chatgpt and not await runner.run_sync(tb4chatgpt.get_token):
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            if args is None:
+                args = self.args
+            response = await openai.ChatCompletion.acreate(api_key=api_key, messages=session.messages, **args)
+            return self._completion_result(response)
+        except Exception as e:
+            result, retry_delay, clear_session = self._handle_text_error(e, retry_count)
+            if clear_session:  # 会话存储可能是sqlite或redis，不在事件循环中执行
+                await runner.run_sync(self.sessions.clear_session, session.session_id)
+            if retry_delay is None:
                 return result
+            await asyncio.sleep(retry_delay)
+            logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+            return await self.areply_text(session, api_key, args, retry_count + 1)
+
+    @staticmethod
+    def _completion_result(response):
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_text_error(self, e, retry_count):
+        """
+        reply_text和areply_text共用的错误处理
+        :return: (返回给用户的结果, 重试前等待的秒数(不重试时为None), 是否清除会话)
+        """
+        need_retry = retry_count < 2
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        retry_delay = None
+        clear_session = False
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            retry_delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            retry_delay = 5
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            retry_delay = 10
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            clear_session = True
+        return result, retry_delay if need_retry else None, clear_session
 
 
 class AzureChatGPTBot(ChatGPTBot):
@@ -459,7 +535,11 @@ class AzureChatGPTBot(ChatGPTBot):
         super().__init__()
         openai.api_type = "azure"
         openai.api_version = "2023-03-15-preview"
-        self.args["deployment_id"] = conf().get("azure_deployment_id")
+
+    def _build_args(self, config):
+        args = super()._build_args(config)
+        args["deployment_id"] = config.get("azure_deployment_id")
+        return args
 
     def create_img(self, query, retry_count=0, api_key=None):
         api_version = "2022-08-03-preview"
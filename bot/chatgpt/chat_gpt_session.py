@@ -1,4 +1,7 @@
+import functools
+
 from bot.session_manager import Session
+from common import tokenizer
 from common.log import logger
 
 """
@@ -20,7 +23,9 @@ class ChatGPTSession(Session):
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
-            cur_tokens = self.calc_tokens()
+            # 总token数等于每条消息的token数之和加上固定的3个，丢弃消息时直接减去该消息的token数
+            tokens = self.message_tokens(message_token_counter(self.model), key=self.model)
+            cur_tokens = sum(tokens) + 3
         except Exception as e:
             precise = False
             if cur_tokens is None:
@@ -32,7 +37,7 @@ class ChatGPTSession(Session):
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
                 self.messages.pop(1)
                 if precise:
-                    cur_tokens = self.calc_tokens()
+                    cur_tokens -= tokens.pop(1)
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
@@ -43,30 +48,42 @@ class ChatGPTSession(Session):
                 logger.info("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
             if precise:
-                cur_tokens = self.calc_tokens()
+                cur_tokens -= tokens.pop(1)
             else:
                 cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        return sum(self.message_tokens(message_token_counter(self.model), key=self.model)) + 3
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
-    import tiktoken
+    count = message_token_counter(model)
+    num_tokens = 0
+    for message in messages:
+        num_tokens += count(message)
+    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return num_tokens
+
 
+@functools.lru_cache(maxsize=None)
+def message_token_counter(model):
+    """
+    返回计算单条消息token数的函数，num_tokens_from_messages的结果等于各条消息之和加3
+    每个模型只解析一次，编码加载失败时抛出异常且不缓存
+    """
     if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo"]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+        return message_token_counter(model="gpt-3.5-turbo")
     elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k"]:
-        return num_tokens_from_messages(messages, model="gpt-4")
+        return message_token_counter(model="gpt-4")
 
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        encoding_name = tokenizer.encoding_name_for_model(model)
     except KeyError:
         logger.info("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        encoding_name = tokenizer.DEFAULT_ENCODING
     if model == "gpt-3.5-turbo":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
@@ -75,13 +92,15 @@ def num_tokens_from_messages(messages, model):
         tokens_per_name = 1
     else:
         logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
+        return message_token_counter(model="gpt-3.5-turbo")
+    tokenizer.get_encoding(encoding_name)
+
+    def count(message):
+        num_tokens = tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            num_tokens += tokenizer.count_tokens(value, encoding_name)
             if key == "name":
                 num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+        return num_tokens
+
+    return count
@@ -1,4 +1,7 @@
+import functools
+
 from bot.session_manager import Session
+from common import tokenizer
 from common.log import logger
 
 
@@ -15,37 +18,26 @@ class OpenAISession(Session):
               A: xxx
               Q: xxx
         """
-        prompt = ""
-        for item in self.messages:
-            if item["role"] == "system":
-                prompt += item["content"] + "<|endoftext|>\n\n\n"
-            elif item["role"] == "user":
-                prompt += "Q: " + item["content"] + "\n"
-            elif item["role"] == "assistant":
-                prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
-
-        if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
-            prompt += "A: "
-        return prompt
+        return build_prompt(self.messages)
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
-            cur_tokens = self.calc_tokens()
+            count = string_token_counter(self.model)
+            cur_tokens = count(str(self))
         except Exception as e:
             precise = False
             if cur_tokens is None:
                 raise e
             logger.info("Exception when counting tokens precisely for query: {}".format(e))
+        if precise:
+            return self._discard_precisely(max_tokens, cur_tokens, count)
         while cur_tokens > max_tokens:
             if len(self.messages) > 1:
                 self.messages.pop(0)
             elif len(self.messages) == 1 and self.messages[0]["role"] == "assistant":
                 self.messages.pop(0)
-                if precise:
-                    cur_tokens = self.calc_tokens()
-                else:
-                    cur_tokens = len(str(self))
+                cur_tokens = len(str(self))
                 break
             elif len(self.messages) == 1 and self.messages[0]["role"] == "user":
                 logger.warn("user question exceed max_tokens. total_tokens={}".format(cur_tokens))
@@ -53,21 +45,75 @@ class OpenAISession(Session):
             else:
                 logger.info("max_tokens={}, total_tokens={}, len(conversation)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
-            if precise:
-                cur_tokens = self.calc_tokens()
+            cur_tokens = len(str(self))
+        return cur_tokens
+
+    def _discard_precisely(self, max_tokens, cur_tokens, count):
+        """
+        找到需要从前面丢弃的最少消息数k，使剩下的消息拼成的prompt不超过max_tokens
+        拼接处的空白可能与相邻片段合并成一个token，各片段token数之和只是估算，先用缓存的估算值确定k，再用完整prompt的token数校正
+        """
+        if cur_tokens <= max_tokens:
+            return cur_tokens
+        messages = self.messages
+        n = len(messages)
+        estimates = self.message_tokens(lambda message: count(build_prompt([message], tail=False)), key=self.model)
+        estimate = cur_tokens
+        k = 0
+        while k < n - 1 and estimate > max_tokens:
+            estimate -= estimates[k]
+            k += 1
+        if k > 0:
+            cur_tokens = count(build_prompt(messages[k:]))
+        while k < n - 1 and cur_tokens > max_tokens:
+            k += 1
+            cur_tokens = count(build_prompt(messages[k:]))
+        while k > 0:
+            prev_tokens = count(build_prompt(messages[k - 1 :]))
+            if prev_tokens > max_tokens:
+                break
+            k -= 1
+            cur_tokens = prev_tokens
+        del messages[:k]
+        if cur_tokens > max_tokens:
+            if len(messages) == 1 and messages[0]["role"] == "assistant":
+                messages.pop(0)
+                cur_tokens = count(str(self))
+            elif len(messages) == 1 and messages[0]["role"] == "user":
+                logger.warn("user question exceed max_tokens. total_tokens={}".format(cur_tokens))
             else:
-                cur_tokens = len(str(self))
+                logger.info("max_tokens={}, total_tokens={}, len(conversation)={}".format(max_tokens, cur_tokens, len(messages)))
         return cur_tokens
 
     def calc_tokens(self):
         return num_tokens_from_string(str(self), self.model)
 
 
+def build_prompt(messages, tail=True):
+    """
+    拼接对话模型的输入，tail为True且最后一条是用户消息时加上"A: "
+    """
+    parts = []
+    for item in messages:
+        if item["role"] == "system":
+            parts.append(item["content"] + "<|endoftext|>\n\n\n")
+        elif item["role"] == "user":
+            parts.append("Q: " + item["content"] + "\n")
+        elif item["role"] == "assistant":
+            parts.append("\n\nA: " + item["content"] + "<|endoftext|>\n")
+    if tail and len(messages) > 0 and messages[-1]["role"] == "user":
+        parts.append("A: ")
+    return "".join(parts)
+
+
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_string(string: str, model: str) -> int:
     """Returns the number of tokens in a text string."""
-    import tiktoken
+    return string_token_counter(model)(string)
+
 
-    encoding = tiktoken.encoding_for_model(model)
-    num_tokens = len(encoding.encode(string, disallowed_special=()))
-    return num_tokens
+@functools.lru_cache(maxsize=None)
+def string_token_counter(model):
+    # 完整的prompt每次都不同，直接编码，不经过tokenizer的字符串缓存
+    encoding = tokenizer.encoding_for_model(model)
+    return lambda string: len(encoding.encode(string, disallowed_special=()))
@@ -1,6 +1,13 @@
-from common.expired_dict import ExpiredDict
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bot.session_store import SessionConflict, create_session_store
 from common.log import logger
-from config import conf
+from config import conf, snapshot
+
+SUMMARY_PREFIX = "以下是之前对话的摘要，回答时可以参考：\n"
+UPDATE_RETRIES = 10  # 会话被其他进程修改时重新读取并修改的次数
 
 
 class Session(object):
@@ -11,12 +18,43 @@ class Session(object):
             self.system_prompt = conf().get("character_desc", "")
         else:
             self.system_prompt = system_prompt
+        self.token_cache = {}  # id(message) -> (message, 消息内容, token数)
+        self.token_cache_key = None
+        self.summary = ""  # 被丢弃的对话压缩成的摘要，附加在system消息后
+        # 重置会话后加1，之前提交的压缩结果不再使用；从随机值开始，删除后重新创建的会话也不会使用
+        self.summary_epoch = random.getrandbits(32)
+        self.version = 0  # 会话存储中的版本号，未保存过为0
 
     # 重置会话
     def reset(self):
+        self.summary = ""
+        self.summary_epoch += 1
         system_item = {"role": "system", "content": self.system_prompt}
         self.messages = [system_item]
 
+    def set_summary(self, summary, epoch):
+        """
+        用新的摘要替换system消息，会话在压缩期间被重置时返回False
+        """
+        if epoch != self.summary_epoch or not self.messages or self.messages[0]["role"] != "system":
+            return False
+        self.summary = summary
+        content = self.system_prompt + "\n\n" + SUMMARY_PREFIX + summary if summary else self.system_prompt
+        self.messages[0] = {"role": "system", "content": content}
+        return True
+
+    def dump(self):
+        """
+        返回保存到会话存储中的内容
+        """
+        return {"system_prompt": self.system_prompt, "messages": self.messages, "summary": self.summary, "summary_epoch": self.summary_epoch}
+
+    def restore(self, data):
+        self.system_prompt = data["system_prompt"]
+        self.messages = data["messages"]
+        self.summary = data["summary"]
+        self.summary_epoch = data["summary_epoch"]
+
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
         self.reset()
@@ -35,57 +73,166 @@ class Session(object):
     def calc_tokens(self):
         raise NotImplementedError
 
+    def message_tokens(self, count, key=None):
+        """
+        返回每条消息的token数，内容没有变化的消息使用上次的结果，只对新增或修改过的消息调用count
+        key为计算方式的标识(比如模型名)，变化时清空缓存
+        """
+        if key != self.token_cache_key:
+            self.token_cache = {}
+            self.token_cache_key = key
+        cache = self.token_cache
+        new_cache = {}
+        tokens = []
+        for message in self.messages:
+            items = tuple(message.items())
+            entry = cache.get(id(message))
+            if entry is None or entry[0] is not message or entry[1] != items:
+                entry = (message, items, count(message))
+            new_cache[id(message)] = entry  # 缓存中保留message的引用，id不会被其他对象复用
+            tokens.append(entry[2])
+        self.token_cache = new_cache
+        return tokens
+
 
 class SessionManager(object):
-    def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            sessions = dict()
-        self.sessions = sessions
+    def __init__(self, sessioncls, summarizer=None, store=None, **session_args):
+        """
+        summarizer(summary, messages)返回把messages合并进摘要summary后的新摘要，开启conversation_compaction时，
+        超出conversation_max_tokens被丢弃的对话在后台交给summarizer压缩，摘要保留在system消息中，不影响回复的耗时
+        只支持system消息固定在第一条、从第二条开始丢弃的会话(ChatGPTSession)
+        store为会话存储，默认按配置中的session_store创建
+        """
+        self.store = store or create_session_store(sessioncls, session_args, on_evict=self._on_session_expired)
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.summarizer = summarizer
+        self.compaction_pool = None  # 单线程执行，同一会话的压缩按丢弃的顺序进行
+        self.compaction_pending = {}  # session_id -> [(epoch, 待压缩的消息), ...]，同一会话排队中的压缩合并成一次
+        self.compaction_lock = threading.Lock()
+
+    def _on_session_expired(self, session_id, session, reason):
+        logger.debug("[Session] session {} {}".format(session_id, reason))
+
+    def _update(self, session_id, update, system_prompt=None):
+        """
+        读取会话(不存在时创建)，执行update(session, created)后保存，update返回False时不保存
+        保存时会话已经被其他进程修改，重新读取后再执行update，返回(session, update的返回值)
+        """
+        if session_id is None:  # 不保存的临时会话
+            session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            return session, update(session, True)
+        for _ in range(UPDATE_RETRIES):
+            session = self.store.load(session_id)
+            created = session is None
+            if created:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            result = update(session, created)
+            if result is False:
+                return session, result
+            try:
+                self.store.save(session)
+                return session, result
+            except SessionConflict:
+                logger.debug("[Session] session {} was modified by another worker, retry".format(session_id))
+        raise SessionConflict("session {} is modified too frequently".format(session_id))
 
     def build_session(self, session_id, system_prompt=None):
         """
         如果session_id不在sessions中，创建一个新的session并添加到sessions中
         如果system_prompt不会空，会更新session的system_prompt并重置session
         """
-        if session_id is None:
-            return self.sessioncls(session_id, system_prompt, **self.session_args)
 
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
-        elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
+        def update(session, created):
+            if created:
+                return True
+            if system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
+                session.set_system_prompt(system_prompt)
+                return True
+            return False
+
+        session, _ = self._update(session_id, update, system_prompt)
         return session
 
     def session_query(self, query, session_id):
-        session = self.build_session(session_id)
-        session.add_query(query)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.info("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.info("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        session, before = self._update(session_id, lambda session, created: self._append(session, query, True, None))
+        self._after_discard(session, before)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
-        session = self.build_session(session_id)
-        session.add_reply(reply)
+        session, before = self._update(session_id, lambda session, created: self._append(session, reply, False, total_tokens))
+        self._after_discard(session, before)
+        return session
+
+    def _append(self, session, content, is_query, total_tokens):
+        """
+        添加消息并丢弃超出conversation_max_tokens的对话，需要压缩时返回丢弃前的消息列表
+        """
+        if is_query:
+            session.add_query(content)
+        else:
+            session.add_reply(content)
+        before = self._before_discard(session)
         try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
+            max_tokens = snapshot().conversation_max_tokens
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.info("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            if is_query:
+                logger.info("prompt tokens used={}".format(tokens_cnt))
+            else:
+                logger.info("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
-            logger.info("Exception when counting tokens precisely for session: {}".format(str(e)))
-        return session
+            logger.info("Exception when counting tokens precisely for {}: {}".format("prompt" if is_query else "session", str(e)))
+        return before
+
+    def _before_discard(self, session):
+        if self.summarizer is None or not snapshot().conversation_compaction or session.session_id is None:
+            return None
+        return list(session.messages)
+
+    def _after_discard(self, session, before):
+        """
+        找出discard_exceeding丢弃的对话，交给后台线程压缩进摘要
+        """
+        if before is None:
+            return
+        kept = set(id(message) for message in session.messages)
+        evicted = [message for message in before if id(message) not in kept and message["role"] != "system"]
+        if not evicted:
+            return
+        with self.compaction_lock:
+            pending = self.compaction_pending.get(session.session_id)
+            if pending is not None:  # 前一次压缩还在排队，合并到一起
+                pending.append((session.summary_epoch, evicted))
+                return
+            self.compaction_pending[session.session_id] = [(session.summary_epoch, evicted)]
+            if self.compaction_pool is None:
+                self.compaction_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+            self.compaction_pool.submit(self._compact, session.session_id)
+
+    def _compact(self, session_id):
+        with self.compaction_lock:
+            pending = self.compaction_pending.pop(session_id, [])
+        if not pending:
+            return
+        epoch = pending[-1][0]
+        messages = [message for e, evicted in pending if e == epoch for message in evicted]
+        # 重新读取会话，在最新的摘要上合并；会话已经被清除或重置时不再压缩
+        session = self.store.load(session_id)
+        if session is None or session.summary_epoch != epoch:
+            return
+        try:
+            summary = self.summarizer(session.summary, messages)
+        except Exception as e:
+            logger.warning("[Session] compaction failed, {} messages discarded, session_id={}: {}".format(len(messages), session_id, e))
+            return
+        if not summary:
+            return
+        _, applied = self._update(session_id, lambda s, created: not created and s.set_summary(summary.strip(), epoch))
+        if applied:
+            logger.info("[Session] {} messages compacted into summary, session_id={}, summary={}".format(len(messages), session_id, summary))
 
     def clear_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        self.store.delete(session_id)
 
     def clear_all_session(self):
-        self.sessions.clear()
+        self.store.clear()
@@ -0,0 +1,276 @@
+"""
+会话的存储
+
+memory: 保存在进程内，与原来的行为一致
+sqlite: 保存在本地的SQLite数据库中(WAL模式)，重启后上下文不丢失，同一台机器上的多个进程可以共享
+redis: 保存在Redis或兼容Redis协议的服务中，多台机器上的进程可以共享
+
+每个会话带有版本号，保存时存储中的版本号与读取时不一致，说明会话已经被其他进程修改，抛出SessionConflict，
+由SessionManager重新读取后再执行修改(乐观锁)；sqlite和redis按最后一次保存的时间计算过期
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.resp import RespClient
+from config import conf, get_appdata_dir
+
+LOCAL_CACHE_SECONDS = 3600  # 未设置过期时间时，本地保留反序列化后会话的时间
+
+
+class SessionConflict(Exception):
+    pass
+
+
+class SessionStore(object):
+    def __init__(self, sessioncls, session_args, ttl=0):
+        """
+        :param ttl: 会话多少秒未修改后过期，0表示不过期
+        """
+        self.sessioncls = sessioncls
+        self.session_args = session_args
+        self.ttl = ttl
+
+    def load(self, session_id):
+        """
+        返回会话，不存在或已过期时返回None
+        """
+        raise NotImplementedError
+
+    def save(self, session):
+        """
+        保存会话并更新session.version，存储中的版本号与session.version不一致时抛出SessionConflict
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    读取返回的是保存的会话对象本身，修改直接生效，只有两个线程同时创建同一个会话时会冲突
+    """
+
+    def __init__(self, sessioncls, session_args, ttl=0, on_evict=None):
+        super().__init__(sessioncls, session_args, ttl)
+        self.sessions = ExpiredDict(ttl, on_evict=on_evict) if ttl else dict()
+        self.lock = threading.Lock()
+
+    def load(self, session_id):
+        return self.sessions.get(session_id)
+
+    def save(self, session):
+        with self.lock:
+            current = self.sessions.get(session.session_id)
+            if current is not None and current is not session:
+                raise SessionConflict(session.session_id)
+            session.version += 1
+            self.sessions[session.session_id] = session
+
+    def delete(self, session_id):
+        with self.lock:
+            if session_id in self.sessions:
+                del self.sessions[session_id]
+
+    def clear(self):
+        self.sessions.clear()
+
+
+class SerializedSessionStore(SessionStore):
+    """
+    以json保存会话的存储，子类实现_get、_put、delete和clear
+    内容没有变化时复用上次反序列化的会话，保留消息的token数缓存；读取返回的是副本，修改后需要save才会生效
+    """
+
+    def __init__(self, sessioncls, session_args, ttl=0):
+        super().__init__(sessioncls, session_args, ttl)
+        self.local = ExpiredDict(ttl or LOCAL_CACHE_SECONDS)  # session_id -> (version, 序列化后的内容, 会话)
+
+    def _get(self, session_id):
+        """
+        返回(版本号, 序列化后的内容)，不存在或已过期时返回None
+        """
+        raise NotImplementedError
+
+    def _put(self, session_id, version, data):
+        """
+        存储中的版本号等于version时写入data，返回新的版本号，否则抛出SessionConflict；不存在或已过期的会话版本号为0
+        """
+        raise NotImplementedError
+
+    def _copy(self, session):
+        # 消息本身不会被原地修改，浅拷贝消息列表即可，token数缓存仍然有效
+        copied = self.sessioncls.__new__(self.sessioncls)
+        copied.__dict__.update(session.__dict__)
+        copied.messages = list(session.messages)
+        return copied
+
+    def load(self, session_id):
+        row = self._get(session_id)
+        if row is None:
+            self.local.pop(session_id, None)
+            return None
+        version, data = row
+        cached = self.local.get(session_id)
+        # 删除后重新创建的会话版本号会重复，同时比较内容
+        if cached is not None and cached[0] == version and cached[1] == data:
+            return self._copy(cached[2])
+        session = self.sessioncls(session_id, **self.session_args)
+        session.restore(json.loads(data))
+        session.version = version
+        self.local[session_id] = (version, data, session)
+        return self._copy(session)
+
+    def save(self, session):
+        data = json.dumps(session.dump(), ensure_ascii=False)
+        try:
+            version = self._put(session.session_id, session.version, data)
+        except Exception:
+            self.local.pop(session.session_id, None)
+            raise
+        session.version = version
+        self.local[session.session_id] = (version, data, self._copy(session))
+
+    def delete(self, session_id):
+        self.local.pop(session_id, None)
+
+    def clear(self):
+        self.local.clear()
+
+
+class SqliteSessionStore(SerializedSessionStore):
+    def __init__(self, sessioncls, session_args, ttl=0, path=None):
+        super().__init__(sessioncls, session_args, ttl)
+        self.path = path or os.path.join(get_appdata_dir(), "sessions.db")
+        self.kind = sessioncls.__name__  # 不同类型的会话(比如ChatGPT和OpenAI)互不影响
+        self.conns = threading.local()
+        self.purged_at = 0
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS sessions (kind TEXT NOT NULL, session_id TEXT NOT NULL, version INTEGER NOT NULL, "
+            "data TEXT NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (kind, session_id))"
+        )
+
+    def _conn(self):
+        conn = getattr(self.conns, "conn", None)
+        if conn is None:
+            # isolation_level=None时由下面的BEGIN IMMEDIATE显式开启事务，其余语句自动提交
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")  # 读写互不阻塞，多个进程可以同时读取
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.conns.conn = conn
+        return conn
+
+    def _expired(self, updated_at, now):
+        return self.ttl and updated_at < now - self.ttl
+
+    def _get(self, session_id):
+        row = self._conn().execute("SELECT version, data, updated_at FROM sessions WHERE kind=? AND session_id=?", (self.kind, session_id)).fetchone()
+        if row is None or self._expired(row[2], time.time()):
+            return None
+        return row[0], row[1]
+
+    def _put(self, session_id, version, data):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")  # 开始时就获取写锁，读取版本号和写入之间不会被其他进程修改
+        try:
+            row = conn.execute("SELECT version, updated_at FROM sessions WHERE kind=? AND session_id=?", (self.kind, session_id)).fetchone()
+            current = 0 if row is None or self._expired(row[1], now) else row[0]
+            if current != version:
+                raise SessionConflict(session_id)
+            # 过期后重新创建的会话继续递增版本号，其他进程缓存的旧会话不会被误用
+            new_version = (row[0] if row else 0) + 1
+            conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)", (self.kind, session_id, new_version, data, now))
+            if self.ttl and now - self.purged_at > self.ttl:
+                conn.execute("DELETE FROM sessions WHERE kind=? AND updated_at<?", (self.kind, now - self.ttl))
+                self.purged_at = now
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return new_version
+
+    def delete(self, session_id):
+        super().delete(session_id)
+        self._conn().execute("DELETE FROM sessions WHERE kind=? AND session_id=?", (self.kind, session_id))
+
+    def clear(self):
+        super().clear()
+        self._conn().execute("DELETE FROM sessions WHERE kind=?", (self.kind,))
+
+
+class RedisSessionStore(SerializedSessionStore):
+    """
+    每个会话保存为一个hash(version, data)，过期由Redis处理，修改时用WATCH/MULTI/EXEC保证版本号未变
+    """
+
+    def __init__(self, sessioncls, session_args, ttl=0, url="redis://localhost:6379/0", prefix="chatgpt-on-wechat:session:"):
+        super().__init__(sessioncls, session_args, ttl)
+        self.client = RespClient(url)
+        self.prefix = "{}{}:".format(prefix, sessioncls.__name__)
+
+    def _get(self, session_id):
+        version, data = self.client.execute("HMGET", self.prefix + session_id, "version", "data")
+        if version is None or data is None:
+            return None
+        return int(version), data
+
+    def _put(self, session_id, version, data):
+        key = self.prefix + session_id
+        try:
+            _, current = self.client.pipeline([("WATCH", key), ("HGET", key, "version")])
+            current = int(current) if current is not None else 0
+            if current != version:
+                raise SessionConflict(session_id)
+            commands = [("MULTI",), ("HSET", key, "version", current + 1, "data", data)]
+            if self.ttl:
+                commands.append(("PEXPIRE", key, int(self.ttl * 1000)))
+            commands.append(("EXEC",))
+            if self.client.pipeline(commands)[-1] is None:  # WATCH之后key被其他客户端修改，事务没有执行
+                raise SessionConflict(session_id)
+        except SessionConflict:
+            self.client.execute("UNWATCH")
+            raise
+        return current + 1
+
+    def delete(self, session_id):
+        super().delete(session_id)
+        self.client.execute("DEL", self.prefix + session_id)
+
+    def clear(self):
+        super().clear()
+        cursor = "0"
+        while True:
+            cursor, keys = self.client.execute("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 500)
+            if keys:
+                self.client.execute("DEL", *keys)
+            if cursor == "0":
+                break
+
+
+def create_session_store(sessioncls, session_args, on_evict=None):
+    """
+    按配置中的session_store创建会话存储
+    """
+    backend = conf().get("session_store", "memory")
+    ttl = conf().get("expires_in_seconds") or 0
+    if backend == "sqlite":
+        store = SqliteSessionStore(sessioncls, session_args, ttl, path=conf().get("session_store_path") or None)
+        logger.info("[Session] sessions are stored in sqlite: {}".format(store.path))
+        return store
+    if backend == "redis":
+        store = RedisSessionStore(sessioncls, session_args, ttl, url=conf().get("session_store_redis_url"))
+        logger.info("[Session] sessions are stored in redis: {}:{}".format(store.client.host, store.client.port))
+        return store
+    if backend != "memory":
+        logger.warning("[Session] unknown session_store {}, use memory".format(backend))
+    return MemorySessionStore(sessioncls, session_args, ttl, on_evict=on_evict)
@@ -2,6 +2,7 @@ from bot.bot_factory import create_bot
 from bridge.context import Context
 from bridge.reply import Reply
 from common import const
+from common.async_runner import AsyncRunner
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -54,3 +55,15 @@ class Bridge(object):
 
     def fetch_translate(self, text, from_lang="", to_lang="en") -> Reply:
         return self.get_bot("translate").translate(text, from_lang, to_lang)
+
+    async def afetch_reply_content(self, query, context: Context) -> Reply:
+        return await self.get_bot("chat").areply(query, context)
+
+    async def afetch_voice_to_text(self, voiceFile) -> Reply:
+        return await AsyncRunner().run_sync(self.fetch_voice_to_text, voiceFile)
+
+    async def afetch_text_to_voice(self, text) -> Reply:
+        return await AsyncRunner().run_sync(self.fetch_text_to_voice, text)
+
+    async def afetch_translate(self, text, from_lang="", to_lang="en") -> Reply:
+        return await AsyncRunner().run_sync(self.fetch_translate, text, from_lang, to_lang)
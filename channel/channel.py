@@ -9,6 +9,7 @@ from bridge.reply import *
 
 class Channel(object):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE, ReplyType.IMAGE]
+    channel_type = ""  # 由channel_factory设置，用于区分指标等
 
     def startup(self):
         """
@@ -41,3 +42,12 @@ class Channel(object):
 
     def build_text_to_voice(self, text) -> Reply:
         return Bridge().fetch_text_to_voice(text)
+
+    async def abuild_reply_content(self, query, context: Context = None) -> Reply:
+        return await Bridge().afetch_reply_content(query, context)
+
+    async def abuild_voice_to_text(self, voice_file) -> Reply:
+        return await Bridge().afetch_voice_to_text(voice_file)
+
+    async def abuild_text_to_voice(self, text) -> Reply:
+        return await Bridge().afetch_text_to_voice(text)
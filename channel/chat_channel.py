@@ -1,19 +1,27 @@
+import functools
+import heapq
 import os
 import re
 import threading
 import time
 from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import Future
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.checkpoint import load_checkpoint, save_checkpoint
+from channel.delivery import DeliveryScheduler
+from channel.message_classifier import QUOTE_MARK, classify_context, parse_quote
+from common.async_runner import AsyncRunner
 from common.dequeue import Dequeue
 from common.log import logger
-from config import conf
-from lib import itchat
+from common.metrics import POOL_TASKS, QUEUE_MESSAGES, SHED_TOTAL, STAGE_SECONDS
+from common.stage_pool import AdaptiveStagePool, StagePool
+from common.trigger_matcher import get_trigger_matcher
+from config import conf, snapshot, subscribe
 from plugins import *
-from channel.common_utils import Utils
 
 try:
     from voice.audio_convert import any_to_wav
@@ -21,21 +29,119 @@ except Exception as e:
     pass
 
 
+# 消息的优先级分类，数值越小优先级越高
+PRIORITY_ADMIN = 0
+PRIORITY_WHITE_LIST = 1
+PRIORITY_NORMAL = 2
+PRIORITY_NAMES = ("admin", "white_list", "normal")
+DEFAULT_PRIORITY_WEIGHTS = (4, 2, 1)
+
+# 各处理阶段的线程池：chat处理文字对话，voice处理语音识别，image处理作图(MJ轮询可能持续数分钟)，send负责发送回复
+DEFAULT_STAGE_POOL_SIZES = {"chat": 8, "voice": 4, "image": 4, "send": 4}
+
+
+# 统计被装饰方法的耗时，记录到chat_stage_seconds
+def timed_stage(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with STAGE_SECONDS.time(channel=self.channel_type, stage=stage):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
 class ChatChannel(Channel):
     name = None  # 登录的用户名
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
-    handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+    lock = threading.RLock()  # 用于控制对sessions的访问
+    ready_cond = threading.Condition(lock)  # 有session就绪时唤醒消费者线程
+    ready_sessions = (deque(), deque(), deque())  # 按优先级划分的就绪队列，只包含有待处理消息且可能有空闲并发名额的session_id
+    ready_set = set()  # 与ready_sessions同步，避免同一session重复入队
 
     def __init__(self):
+        self.async_mode = conf().get("async_mode", False)  # 开启后消息处理流程以协程的方式运行在事件循环中
+        self.queued_count = 0  # 所有session排队中的消息数
+        self.in_flight = 0  # 已提交处理但未完成的消息数
+        # 按权重轮转各优先级的就绪队列，高优先级获得更多的调度机会，低优先级也不会饿死
+        self.ready_schedule = self._build_ready_schedule(conf().get("priority_weights", {}))
+        self.ready_cursor = 0
+        self.delayed = []  # 等待合并窗口结束的session，(到期时间, session_id)组成的小顶堆
+        self.delayed_set = set()
+        self.running_contexts = {}  # 处理中的任务对应的context，退出时未处理完的需要保存
+        self.draining = False
+        # 慢的任务只会占满自己阶段的线程池，不会阻塞文字回复
+        pool_sizes = conf().get("stage_pool_sizes", {})
+        self.stage_pools = {name: self._create_stage_pool(name, pool_sizes.get(name, size)) for name, size in DEFAULT_STAGE_POOL_SIZES.items()}
+        self.handler_pool = self.stage_pools["chat"]  # 处理消息的线程池
+        self.delivery = DeliveryScheduler(self, self.stage_pools["send"])
+        POOL_TASKS.set_function(self._pool_metrics)
+        QUEUE_MESSAGES.set_function(self._queue_metrics)
+        subscribe(self._apply_config)  # 重新加载配置后调整线程池大小和调度权重
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
 
+    def _create_stage_pool(self, name, size):
+        if not conf().get("stage_pool_autoscale", False):
+            return StagePool(name, size)
+        # 开启自动伸缩时，stage_pool_sizes作为线程数下限，stage_pool_max_sizes作为上限
+        max_size = conf().get("stage_pool_max_sizes", {}).get(name, size * 4)
+        return AdaptiveStagePool(
+            name,
+            size,
+            max_size,
+            interval=conf().get("stage_pool_scale_interval", 5),
+            wait_target=conf().get("stage_pool_wait_target", 0.5),
+        )
+
+    @staticmethod
+    def _build_ready_schedule(weights):
+        schedule = []
+        for priority, name in enumerate(PRIORITY_NAMES):
+            schedule += [priority] * max(int(weights.get(name, DEFAULT_PRIORITY_WEIGHTS[priority])), 1)
+        return schedule
+
+    def _apply_config(self, config):
+        pool_sizes = config.get("stage_pool_sizes", {})
+        for name, pool in self.stage_pools.items():
+            size = pool_sizes.get(name, DEFAULT_STAGE_POOL_SIZES[name])
+            if isinstance(pool, AdaptiveStagePool):
+                max_size = config.get("stage_pool_max_sizes", {}).get(name, size * 4)
+                pool.resize(size, max_size, config.stage_pool_scale_interval, config.stage_pool_wait_target)
+            else:
+                pool.resize(size)
+        with self.lock:
+            self.ready_schedule = self._build_ready_schedule(config.get("priority_weights", {}))
+            self.ready_cursor = 0
+
+    def _record_latency(self, context: Context, start):
+        latency = time.time() - start
+        STAGE_SECONDS.observe(latency, channel=self.channel_type, stage="bot")
+        pool = self.stage_pools[self._select_stage(context)]
+        if isinstance(pool, AdaptiveStagePool):
+            pool.record_latency(latency)
+
+    def _pool_metrics(self):
+        samples = []
+        for stats in self.stage_stats():
+            for state in ("max_workers", "pending", "active"):
+                samples.append(({"channel": self.channel_type, "pool": stats["name"], "state": state}, stats[state]))
+        return samples
+
+    def _queue_metrics(self):
+        return [
+            ({"channel": self.channel_type, "state": "queued"}, self.queued_count),
+            ({"channel": self.channel_type, "state": "in_flight"}, self.in_flight),
+        ]
+
     # 根据消息构造context，消息内容相关的触发项写在这里
+    @timed_stage("compose")
     def _compose_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
@@ -46,9 +152,10 @@ class ChatChannel(Channel):
             context["origin_ctype"] = ctype
         # context首次传入时，receiver是None，根据类型设置receiver
         first_in = "receiver" not in context
+        config = snapshot()  # 处理一条消息时使用同一份配置
+        matcher = get_trigger_matcher()
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
-            config = conf()
             cmsg = context["msg"]
             user_data = conf().get_user_data(cmsg.from_user_id)
             context["openai_api_key"] = user_data.get("openai_api_key")
@@ -57,23 +164,9 @@ class ChatChannel(Channel):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if matcher.is_group_in_white_list(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if matcher.is_group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     return None
@@ -92,23 +185,19 @@ class ChatChannel(Channel):
 
         # 消息内容匹配过程，并处理content
         if ctype == ContextType.TEXT:
-            if first_in and "」\n- - - - - - - - - - - - - - -" in content:  # 初次匹配 过滤引用消息
-                try:
-                    logger.info(f"[引用消息]>>>>>{content}")
-                    content_in_brackets = re.search("「(.*)」", content, flags=re.DOTALL).group(1)
-                    # 使用正则表达式匹配 - - - - - - - - - - - - - - - 后面的文字内容
-                    pattern_dashes = r'- - - - - - - - - - - - - - -\n(.+)'
-                    content_after_dashes = re.findall(pattern_dashes, content)
-                    content = f"{content_after_dashes[0]} {content_in_brackets.split('：', 1)[1]}"
-                    logger.info(f"[引用消息处理后的]：{content}")
-                except Exception as e:
-                    logger.info(f"An Exception: {e}")
+            # 引用消息只需要检查标记，不需要完整分类
+            if first_in and QUOTE_MARK in content:  # 初次匹配 过滤引用消息
+                logger.info(f"[引用消息]>>>>>{content}")
+                _, quote_content = parse_quote(content)
+                if quote_content is None:
+                    logger.info("[引用消息]格式不正确")
                     return None
+                content = quote_content
+                logger.info(f"[引用消息处理后的]：{content}")
 
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix, match_contain = matcher.match_group(content)
                 flag = False
 
                 if match_prefix is not None or match_contain is not None:
@@ -116,22 +205,24 @@ class ChatChannel(Channel):
                     if match_prefix:
                         content = content.replace(match_prefix, "", 1).strip()
 
-                if Utils.check_prefix_mj(content) is True or Utils.check_prefix_sd(content):
-                    flag = True
-
                 if context["msg"].is_at:
                     logger.info("[WX]receive group at")
-                    if not conf().get("group_at_off", False):
+                    if not config.group_at_off:
                         flag = True
                     pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
                     content = re.sub(pattern, r"", content)
 
+                if not flag:
+                    # 只有没有匹配到前缀和@时才需要按作图指令判断，分类结果缓存在context["message_info"]中，后面直接复用
+                    info = classify_context(context, content.strip())
+                    flag = info.mj or info.sd
+
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
                         logger.info("[WX]receive group voice, but checkprefix didn't match")
                     return None
             else:  # 单聊
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.match_single(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     # content = content.replace(match_prefix, "", 1).strip()
                     pass
@@ -141,45 +232,27 @@ class ChatChannel(Channel):
                     # return None 以后可以根据情况 放开这里否
                     pass
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix"))
-            image_http_urls, image_local_urls = self.extract_http_local_urls(content)
+            img_match_prefix = matcher.match_image(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
-            elif Utils.is_just_desc_wechat_pic(content) or Utils.is_just_desc_http_pic(content):
-                context.type = ContextType.IMAGE_CREATE
-            elif (len(image_http_urls) > 0 and len(image_local_urls) > 0) or len(image_http_urls) > 1 or len(image_local_urls) > 1:
-                context.type = ContextType.IMAGE_CREATE
-            elif Utils.check_prefix_mj(content) is True or Utils.check_prefix_sd(content):
+            elif classify_context(context, content).is_image_create():
                 context.type = ContextType.IMAGE_CREATE
             else:
                 context.type = ContextType.TEXT
             context.content = content.strip()
-            if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            # 消息只按最终内容分类一次(上面已经分类过的内容直接使用缓存)，结果保存在context["message_info"]，bot中直接使用
+            classify_context(context)
+            if "desire_rtype" not in context and config.always_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.voice_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         elif context.type == ContextType.IMAGE:
             logger.info(f"{context}")
-            itchat.send_msg(context.content, toUserName=context["receiver"])
+            self.deliver(Reply(ReplyType.TEXT, context.content), context)
         return context
 
-    def extract_http_local_urls(self, input_string):
-        # 定义图片链接的正则表达式
-        image_urls_pattern = r"http[s]?://[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)"
-
-        # 定义图片链接的正则表达式
-        pattern = r"wechat_tmp/[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)"
-
-        # 使用 re.findall() 查找所有匹配的图片链接
-        image_http_urls = re.findall(image_urls_pattern, input_string, re.IGNORECASE)
-
-        # 使用 re.findall() 查找所有匹配的图片链接和本地文件地址
-        image_local_urls = re.findall(pattern, input_string, re.IGNORECASE)
-
-        return image_http_urls, image_local_urls
-
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
@@ -189,7 +262,8 @@ class ChatChannel(Channel):
 
         logger.info("[WX] ready to decorate reply: {}".format(reply))
         # reply的包装步骤
-        reply = self._decorate_reply(context, reply)
+        with STAGE_SECONDS.time(channel=self.channel_type, stage="decorate"):
+            reply = self._decorate_reply(context, reply)
 
         # reply的发送步骤
         self._send_reply(context, reply)
@@ -207,19 +281,22 @@ class ChatChannel(Channel):
             if e_context.is_break():
                 context["generate_breaked_by"] = e_context["breaked_by"]
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+                start = time.time()
                 reply = super().build_reply_content(context.content, context)
+                self._record_latency(context, start)
             elif context.type == ContextType.VOICE:  # 语音消息
                 cmsg = context["msg"]
                 cmsg.prepare()
                 file_path = context.content
                 wav_path = os.path.splitext(file_path)[0] + ".wav"
-                try:
-                    any_to_wav(file_path, wav_path)
-                except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
-                    logger.warning("[WX]any to wav error, use raw path. " + str(e))
-                    wav_path = file_path
-                # 语音识别
-                reply = super().build_voice_to_text(wav_path)
+                with STAGE_SECONDS.time(channel=self.channel_type, stage="voice"):
+                    try:
+                        any_to_wav(file_path, wav_path)
+                    except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
+                        logger.warning("[WX]any to wav error, use raw path. " + str(e))
+                        wav_path = file_path
+                    # 语音识别
+                    reply = super().build_voice_to_text(wav_path)
                 # 删除临时文件
                 try:
                     os.remove(file_path)
@@ -261,14 +338,10 @@ class ChatChannel(Channel):
                 if reply.type == ReplyType.TEXT:
                     reply_text = reply.content
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
-                        reply = super().build_text_to_voice(reply.content)
+                        with STAGE_SECONDS.time(channel=self.channel_type, stage="voice"):
+                            reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
-                    if context.get("isgroup", False):
-                        reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
-                    else:
-                        reply_text = reply_text + conf().get("single_chat_reply_suffix", "")
-                    reply.content = reply_text
+                    reply.content = self._decorate_reply_text(context, reply_text)
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE:
@@ -280,6 +353,15 @@ class ChatChannel(Channel):
                 logger.warning("[WX] desire_rtype: {}, but reply type: {}".format(context.get("desire_rtype"), reply.type))
             return reply
 
+    def _decorate_reply_text(self, context: Context, reply_text):
+        config = snapshot()
+        if context.get("isgroup", False):
+            reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
+            reply_text = config.group_chat_reply_prefix + reply_text + config.group_chat_reply_suffix
+        else:
+            reply_text = reply_text + config.single_chat_reply_suffix
+        return reply_text
+
     def _send_reply(self, context: Context, reply: Reply):
         if reply and reply.type:
             e_context = PluginManager().emit_event(
@@ -291,19 +373,140 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.info("[WX] ready to send reply: {}, context: {}".format(reply, context))
-                self._send(reply, context)
-
-    def _send(self, reply: Reply, context: Context, retry_cnt=0):
-        try:
-            self.send(reply, context)
-        except Exception as e:
-            logger.error("[WX] sendMsg error: {}".format(str(e)))
-            if isinstance(e, NotImplementedError):
+                self._after_send(context, self.deliver(reply, context))
+
+    # 回复交给发送调度异步发送，处理线程不再等待发送完成，同一receiver的回复按提交顺序发送
+    # 插件和bot需要在回复之外推送消息时也应调用deliver，而不是直接调用send
+    def deliver(self, reply: Reply, context: Context) -> Future:
+        return self.delivery.submit(reply, context)
+
+    def _after_send(self, context: Context, future: Future):
+        """
+        发送成功后把AFTER_SEND_REPLY事件交给插件管理器在后台分发，发送线程只负责入队
+        """
+
+        def func(future: Future):
+            if future.cancelled() or future.exception() is not None:
                 return
-            logger.exception(e)
-            if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+            PluginManager().emit_event_background(EventContext(Event.AFTER_SEND_REPLY, {"channel": self, "context": context, "reply": future.result()}))
+
+        future.add_done_callback(func)
+
+    def _send(self, reply: Reply, context: Context):
+        with STAGE_SECONDS.time(channel=self.channel_type, stage="send"):
+            return self.send(reply, context)
+
+    # 以下是async_mode下的消息处理流程，与上面的同步流程一一对应
+    # bot和语音的调用是协程，同步的插件事件和文件转换通过AsyncRunner的有界线程池桥接，回复同样交给send线程池发送
+    async def _ahandle(self, context: Context):
+        if context is None or not context.content:
+            return
+        logger.info("[WX] ready to handle context: {}".format(context))
+        reply = await self._agenerate_reply(context)
+
+        logger.info("[WX] ready to decorate reply: {}".format(reply))
+        with STAGE_SECONDS.time(channel=self.channel_type, stage="decorate"):
+            reply = await self._adecorate_reply(context, reply)
+
+        await self._asend_reply(context, reply)
+
+    async def _aemit_event(self, e_context: EventContext) -> EventContext:
+        return await AsyncRunner().run_sync(PluginManager().emit_event, e_context)
+
+    async def _agenerate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        e_context = await self._aemit_event(
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            )
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.info("[WX] ready to handle context: type={}, content={}".format(context.type, context.content))
+            if e_context.is_break():
+                context["generate_breaked_by"] = e_context["breaked_by"]
+            if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+                start = time.time()
+                reply = await self.abuild_reply_content(context.content, context)
+                self._record_latency(context, start)
+            elif context.type == ContextType.VOICE:  # 语音消息
+                cmsg = context["msg"]
+                await AsyncRunner().run_sync(cmsg.prepare)
+                file_path = context.content
+                wav_path = os.path.splitext(file_path)[0] + ".wav"
+                with STAGE_SECONDS.time(channel=self.channel_type, stage="voice"):
+                    try:
+                        await AsyncRunner().run_sync(any_to_wav, file_path, wav_path)
+                    except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
+                        logger.warning("[WX]any to wav error, use raw path. " + str(e))
+                        wav_path = file_path
+                    # 语音识别
+                    reply = await self.abuild_voice_to_text(wav_path)
+                # 删除临时文件
+                try:
+                    os.remove(file_path)
+                    if wav_path != file_path:
+                        os.remove(wav_path)
+                except Exception as e:
+                    pass
+
+                if reply.type == ReplyType.TEXT:
+                    new_context = await AsyncRunner().run_sync(self._compose_context, ContextType.TEXT, reply.content, **context.kwargs)
+                    if new_context:
+                        reply = await self._agenerate_reply(new_context)
+                    else:
+                        return
+            elif context.type == ContextType.IMAGE:  # 图片消息，当前无默认逻辑
+                logger.info(context)
+            else:
+                logger.error("[WX] unknown context type: {}".format(context.type))
+        return reply
+
+    async def _adecorate_reply(self, context: Context, reply: Reply) -> Reply:
+        if reply and reply.type:
+            e_context = await self._aemit_event(
+                EventContext(
+                    Event.ON_DECORATE_REPLY,
+                    {"channel": self, "context": context, "reply": reply},
+                )
+            )
+            reply = e_context["reply"]
+            desire_rtype = context.get("desire_rtype")
+            if not e_context.is_pass() and reply and reply.type:
+                if reply.type in self.NOT_SUPPORT_REPLYTYPE:
+                    logger.error("[WX]reply type not support: " + str(reply.type))
+                    reply.type = ReplyType.ERROR
+                    reply.content = "不支持发送的消息类型: " + str(reply.type)
+
+                if reply.type == ReplyType.TEXT:
+                    if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+                        with STAGE_SECONDS.time(channel=self.channel_type, stage="voice"):
+                            reply = await self.abuild_text_to_voice(reply.content)
+                        return await self._adecorate_reply(context, reply)
+                    reply.content = self._decorate_reply_text(context, reply.content)
+                elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
+                    reply.content = "[" + str(reply.type) + "]\n" + reply.content
+                elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE:
+                    pass
+                else:
+                    logger.error("[WX] unknown reply type: {}".format(reply.type))
+                    return
+            if desire_rtype and desire_rtype != reply.type and reply.type not in [ReplyType.ERROR, ReplyType.INFO]:
+                logger.warning("[WX] desire_rtype: {}, but reply type: {}".format(context.get("desire_rtype"), reply.type))
+            return reply
+
+    async def _asend_reply(self, context: Context, reply: Reply):
+        if reply and reply.type:
+            e_context = await self._aemit_event(
+                EventContext(
+                    Event.ON_SEND_REPLY,
+                    {"channel": self, "context": context, "reply": reply},
+                )
+            )
+            reply = e_context["reply"]
+            if not e_context.is_pass() and reply and reply.type:
+                logger.info("[WX] ready to send reply: {}, context: {}".format(reply, context))
+                self._after_send(context, self.deliver(reply, context))
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.info("Worker return success, session_id = {}".format(session_id))
@@ -324,67 +527,310 @@ class ChatChannel(Channel):
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
+                self.in_flight -= 1
+                self.running_contexts.pop(worker, None)
                 self.sessions[session_id][1].release()
+                self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
+                if not self.sessions[session_id][0].empty():
+                    self._mark_ready(session_id)  # 释放了并发名额，队列里还有消息，重新就绪
+                else:
+                    self._release_session_if_idle(session_id)
+                self.ready_cond.notify_all()  # 可能此前因为达到max_in_flight而暂停了调度，或者checkpoint在等待处理完成
 
         return func
 
+    def _select_stage(self, context: Context):
+        if context.type == ContextType.IMAGE_CREATE:
+            return "image"
+        elif context.type == ContextType.VOICE:
+            return "voice"
+        return "chat"
+
+    def stage_stats(self):
+        return [pool.stats() for pool in self.stage_pools.values()]
+
+    def _context_priority(self, context: Context):
+        cmsg = context.get("msg")
+        if cmsg is None:
+            return PRIORITY_NORMAL
+        if context.get("isgroup", False):
+            user_keys = (cmsg.actual_user_id, cmsg.actual_user_nickname)
+        else:
+            user_keys = (cmsg.from_user_id, cmsg.from_user_nickname)
+        config = snapshot()
+        if any(key in config.priority_admin_users for key in user_keys if key):
+            return PRIORITY_ADMIN
+        if any(key in config.priority_white_list_users for key in user_keys if key):
+            return PRIORITY_WHITE_LIST
+        return PRIORITY_NORMAL
+
+    # 以下函数需要在持有self.lock时调用
+    def _mark_ready(self, session_id):
+        if session_id not in self.ready_set:
+            self.ready_set.add(session_id)
+            self.ready_sessions[self.sessions[session_id][2]].append(session_id)
+            self.ready_cond.notify()
+
+    def _pop_ready_session(self):
+        for _ in range(len(self.ready_schedule)):
+            priority = self.ready_schedule[self.ready_cursor]
+            self.ready_cursor = (self.ready_cursor + 1) % len(self.ready_schedule)
+            if self.ready_sessions[priority]:
+                session_id = self.ready_sessions[priority].popleft()
+                self.ready_set.discard(session_id)
+                return session_id
+        return None
+
+    def _promote_delayed(self):
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, session_id = heapq.heappop(self.delayed)
+            self.delayed_set.discard(session_id)
+            if session_id in self.sessions:  # 到期后重新就绪，是否还需要等待由consume再次判断
+                self._mark_ready(session_id)
+
+    def _next_delay(self):
+        if not self.delayed:
+            return None
+        return max(self.delayed[0][0] - time.time(), 0)
+
+    def _delay_session(self, session_id, due):
+        if session_id not in self.delayed_set:
+            self.delayed_set.add(session_id)
+            heapq.heappush(self.delayed, (due, session_id))
+
+    def _can_dispatch(self):
+        max_in_flight = snapshot().max_in_flight
+        if self.draining:  # 退出前不再处理新的消息
+            return False
+        return len(self.ready_set) > 0 and (max_in_flight <= 0 or self.in_flight < max_in_flight)
+
+    def _release_session_if_idle(self, session_id):
+        context_queue, semaphore, _ = self.sessions[session_id]
+        if context_queue.empty() and semaphore._initial_value == semaphore._value:  # 没有排队的消息，也没有处理中的任务
+            self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+            assert len(self.futures[session_id]) == 0, "thread pool error"
+            del self.futures[session_id]
+            del self.sessions[session_id]
+
+    # 消息合并：同一个人连续发送的多条文字消息，在coalesce_window_seconds内合并为一条再交给bot
+    def _can_coalesce(self, context: Context):
+        if context.type != ContextType.TEXT or self._is_command(context):  # 管理命令不合并
+            return False
+        return context.content not in snapshot().clear_memory_commands
+
+    def _sender_id(self, context: Context):
+        cmsg = context.get("msg")
+        if cmsg is None:
+            return None
+        return cmsg.actual_user_id if context.get("isgroup", False) else cmsg.from_user_id
+
+    def _can_merge(self, head: Context, context: Context):
+        return self._can_coalesce(context) and self._sender_id(head) == self._sender_id(context) and head.get("receiver") == context.get("receiver")
+
+    def _coalesce_due(self, context_queue):
+        """
+        返回队首消息可以处理的时间，每来一条可合并的消息都会延长等待，最多等待coalesce_max_wait_seconds
+        """
+        config = snapshot()
+        window = config.coalesce_window_seconds
+        head = context_queue.queue[0]
+        if window <= 0 or not self._can_coalesce(head):
+            return 0
+        max_messages = config.coalesce_max_messages
+        last = head
+        for i, context in enumerate(context_queue.queue):
+            if i == 0:
+                continue
+            if i >= max_messages or not self._can_merge(head, context):  # 已经可以合并的消息足够了，或后面有不能合并的消息
+                return 0
+            last = context
+        return min(last["enqueue_time"] + window, head["enqueue_time"] + config.coalesce_max_wait_seconds)
+
+    def _coalesce(self, context_queue, context: Context):
+        config = snapshot()
+        if config.coalesce_window_seconds <= 0 or not self._can_coalesce(context):
+            return context
+        contents = [context.content]
+        max_messages = config.coalesce_max_messages
+        while len(contents) < max_messages and not context_queue.empty() and self._can_merge(context, context_queue.queue[0]):
+            contents.append(context_queue.get().content)
+            self.queued_count -= 1
+        if len(contents) > 1:
+            context.content = "\n".join(contents)
+            context["coalesced"] = len(contents)
+            logger.info("[WX] coalesced {} messages in session {}".format(len(contents), context.get("session_id")))
+        return context
+
+    # 队列超出限制或等待超时的消息不再处理，回复一条提示
+    def _shed(self, context: Context, reason):
+        logger.warning("[WX] context shed ({}), session_id={}, content={}".format(reason, context.get("session_id"), context.content))
+        SHED_TOTAL.inc(channel=self.channel_type, reason=reason)
+        shed_reply = snapshot().queue_shed_reply
+        if shed_reply:
+            # 在发送线程池中发送，不和导致丢弃的消息一起在chat线程池中排队
+            self.stage_pools["send"].submit(self._send_shed_reply, context, shed_reply)
+
+    def _send_shed_reply(self, context: Context, shed_reply):
+        reply = self._decorate_reply(context, Reply(ReplyType.INFO, shed_reply))
+        self._send_reply(context, reply)
+
+    @staticmethod
+    def _is_command(context: Context):
+        return context.type == ContextType.TEXT and context.content.startswith("#")
+
+    def _pop_oldest_droppable(self, context_queue):
+        """
+        取出队列中最早的一条可以丢弃的消息，管理命令(放在队首)不会被丢弃，没有可以丢弃的消息时返回None
+        """
+        with context_queue.mutex:
+            for i, queued in enumerate(context_queue.queue):
+                if not self._is_command(queued):
+                    del context_queue.queue[i]
+                    return queued
+        return None
+
     def produce(self, context: Context):
         session_id = context["session_id"]
+        priority = self._context_priority(context)
+        is_command = self._is_command(context)
+        context["enqueue_time"] = time.time()
+        context["channel"] = self  # bot和插件通过它推送中间消息
+        shed = None
+        config = snapshot()
         with self.lock:
             if session_id not in self.sessions:
                 self.sessions[session_id] = [
                     Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+                    threading.BoundedSemaphore(config.get("concurrency_in_session", 4)),
+                    priority,
                 ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
-            else:
-                self.sessions[session_id][0].put(context)
-
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+            context_queue = self.sessions[session_id][0]
+            self.sessions[session_id][2] = min(self.sessions[session_id][2], priority)
+            session_queue_max_size = config.session_queue_max_size
+            total_queue_max_size = config.total_queue_max_size
+            session_full = 0 < session_queue_max_size <= context_queue.qsize()
+            total_full = 0 < total_queue_max_size <= self.queued_count
+            if (session_full or total_full) and not is_command and priority != PRIORITY_ADMIN:  # 管理命令和管理员的消息不受限制
+                if config.queue_shed_policy == "drop_oldest":
+                    shed = self._pop_oldest_droppable(context_queue)
+                if shed is not None:
+                    self.queued_count -= 1
+                else:
+                    shed = context
+            if shed is not context:
+                if is_command:
+                    context_queue.putleft(context)  # 优先处理管理命令
+                else:
+                    context_queue.put(context)
+                self.queued_count += 1
+                self._mark_ready(session_id)
+        if shed:
+            self._shed(shed, "queue full")
+
+    # 消费者函数，单独线程，用于从就绪队列中取出session并处理其消息
+    # 只在produce和任务完成时被唤醒，每次只处理有消息且有空闲并发名额的session
     def consume(self):
         while True:
+            expired = []
             with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.info("[WX] consume context: {}".format(context))
-                            future: Future = self.handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
+                while True:
+                    self._promote_delayed()
+                    if self._can_dispatch():
+                        break
+                    self.ready_cond.wait(self._next_delay())
+                session_id = self._pop_ready_session()
+                if session_id is None or session_id not in self.sessions:
+                    continue
+                context_queue, semaphore, _ = self.sessions[session_id]
+                max_wait = snapshot().queue_max_wait_seconds
+                while max_wait > 0 and not context_queue.empty() and time.time() - context_queue.queue[0]["enqueue_time"] > max_wait:
+                    expired.append(context_queue.get())  # 等待太久的消息不再处理
+                    self.queued_count -= 1
+                due = self._coalesce_due(context_queue) if not context_queue.empty() else 0
+                if context_queue.empty():  # 消息已被取消
+                    self._release_session_if_idle(session_id)
+                elif due > time.time():  # 合并窗口内，等待后续消息
+                    self._delay_session(session_id, due)
+                elif semaphore.acquire(blocking=False):  # 并发名额已满时，等任务完成时的回调重新就绪
+                    context = context_queue.get()
+                    self.queued_count -= 1
+                    context = self._coalesce(context_queue, context)
+                    logger.info("[WX] consume context: {}".format(context))
+                    STAGE_SECONDS.observe(time.time() - context["enqueue_time"], channel=self.channel_type, stage="queue_wait")
+                    stage = self._select_stage(context)
+                    if self.async_mode and stage == "chat":
+                        future: Future = AsyncRunner().submit(self._ahandle(context))
+                    else:
+                        future: Future = self.stage_pools[stage].submit(self._handle, context)
+                    self.in_flight += 1
+                    if session_id not in self.futures:
+                        self.futures[session_id] = []
+                    self.futures[session_id].append(future)
+                    self.running_contexts[future] = context
+                    future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+                    if not context_queue.empty():  # 可能还有空闲并发名额
+                        self._mark_ready(session_id)
+            for context in expired:
+                self._shed(context, "wait timeout")
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in list(self.futures.get(session_id, [])):  # 取消时回调会同步执行并修改futures
                     future.cancel()
+                if session_id not in self.sessions:
+                    return
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.queued_count -= cnt
                 self.sessions[session_id][0] = Dequeue()
+                self._release_session_if_idle(session_id)
+
+    # 退出时调用，停止调度新的消息，等待处理中的消息和回复完成，然后保存仍未完成的消息
+    def checkpoint(self, timeout=None):
+        if timeout is None:
+            timeout = snapshot().shutdown_drain_seconds
+        deadline = time.time() + timeout
+        with self.lock:
+            self.draining = True
+            while self.in_flight > 0 and time.time() < deadline:
+                self.ready_cond.wait(deadline - time.time())
+        while self.delivery.pending() > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        with self.lock:
+            contexts = list(self.running_contexts.values())  # 超时仍未完成的消息，重启后重新处理
+            for context_queue, _, _ in self.sessions.values():
+                contexts += list(context_queue.queue)
+        return save_checkpoint(self.channel_type, contexts)
+
+    # 启动后、接收新消息前调用，重新处理上次退出时保存的消息
+    def after_login(self):
+        """
+        登录成功、开始接收消息前调用
+        """
+        if snapshot().plugin_prewarm:
+            PluginManager().prewarm_plugins()
+        self.replay_checkpoint()
+
+    def replay_checkpoint(self):
+        if not snapshot().checkpoint_on_exit or not self._can_replay_checkpoint():
+            return
+        contexts = load_checkpoint(self.channel_type, snapshot().checkpoint_max_age_seconds)
+        for context in contexts:
+            self.produce(context)
+        if contexts:
+            logger.info("[WX] replay {} contexts from checkpoint".format(len(contexts)))
+
+    def _can_replay_checkpoint(self):
+        return True
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            for session_id in list(self.sessions.keys()):
+                self.cancel_session(session_id)
 
 
 def check_prefix(content, prefix_list):
@@ -0,0 +1,109 @@
+"""
+退出时保存未处理完的消息，重启后重新处理
+
+context中的channel、原始消息对象和准备函数等无法序列化，只保存ChatMessage的基本字段和可以pickle的参数
+"""
+
+import os
+import pickle
+import time
+
+from bridge.context import Context, ContextType
+from channel.chat_message import ChatMessage
+from common.log import logger
+from config import get_appdata_dir
+
+MSG_FIELDS = (
+    "msg_id",
+    "create_time",
+    "ctype",
+    "content",
+    "from_user_id",
+    "from_user_nickname",
+    "to_user_id",
+    "to_user_nickname",
+    "other_user_id",
+    "other_user_nickname",
+    "is_group",
+    "is_at",
+    "actual_user_id",
+    "actual_user_nickname",
+)
+SKIP_KWARGS = ("msg", "channel", "last_delivery")
+
+
+def checkpoint_path(channel_type):
+    return os.path.join(get_appdata_dir(), "checkpoint_{}.pkl".format(channel_type or "default"))
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+        return True
+    except Exception:
+        return False
+
+
+def dump_context(context: Context):
+    """
+    把context转换成只包含基本类型的dict，不能恢复的context返回None
+    """
+    cmsg = context.get("msg")
+    if context.type != ContextType.TEXT and context.type != ContextType.IMAGE_CREATE:
+        # 语音等需要下载文件的消息，未下载时无法在重启后重新下载
+        if not isinstance(context.content, str) or not os.path.exists(context.content):
+            return None
+    data = {
+        "type": context.type.value,
+        "content": context.content,
+        "kwargs": {k: v for k, v in context.kwargs.items() if k not in SKIP_KWARGS and _picklable(v)},
+        "msg": {field: getattr(cmsg, field, None) for field in MSG_FIELDS} if cmsg is not None else None,
+    }
+    return data
+
+
+def load_context(data) -> Context:
+    kwargs = dict(data["kwargs"])
+    if data["msg"] is not None:
+        cmsg = ChatMessage(None)
+        for field, value in data["msg"].items():
+            setattr(cmsg, field, value)
+        cmsg._prepared = True
+        kwargs["msg"] = cmsg
+    return Context(ContextType(data["type"]), data["content"], kwargs)
+
+
+def save_checkpoint(channel_type, contexts):
+    items = []
+    for context in contexts:
+        data = dump_context(context)
+        if data is None:
+            logger.warning("[Checkpoint] skip context that can not be restored: {}".format(context))
+            continue
+        items.append(data)
+    path = checkpoint_path(channel_type)
+    with open(path, "wb") as f:
+        pickle.dump({"time": time.time(), "contexts": items}, f)
+    logger.info("[Checkpoint] {} contexts saved to {}".format(len(items), path))
+    return len(items)
+
+
+def load_checkpoint(channel_type, max_age=0):
+    """
+    读取并删除checkpoint文件，返回可以重新处理的context列表
+    """
+    path = checkpoint_path(channel_type)
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+    except Exception as e:
+        logger.warning("[Checkpoint] load {} failed: {}".format(path, e))
+        return []
+    finally:
+        os.remove(path)
+    if max_age > 0 and time.time() - data["time"] > max_age:
+        logger.info("[Checkpoint] checkpoint is too old, {} contexts discarded".format(len(data["contexts"])))
+        return []
+    return [load_context(item) for item in data["contexts"]]
@@ -0,0 +1,164 @@
+"""
+回复的发送调度
+
+每个receiver一个先进先出的发送队列，同一receiver同一时间只有一条回复在发送，保证顺序
+发送失败、分段发送的间隔和限速都通过定时器延后执行，不占用发送线程
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from common.log import logger
+from common.token_bucket import LazyTokenBucket
+from config import snapshot
+
+_global_bucket = None
+_global_bucket_lock = threading.Lock()
+
+
+def _get_global_bucket():
+    """所有channel共享的发送限速，send_rate_limit为每分钟最多发送的消息数，0表示不限制"""
+    global _global_bucket
+    with _global_bucket_lock:
+        rate = snapshot().send_rate_limit
+        if rate <= 0:
+            return None
+        if _global_bucket is None or _global_bucket.rpm != rate:
+            _global_bucket = LazyTokenBucket(rate)
+        return _global_bucket
+
+
+class Continuation(object):
+    """
+    channel.send可以只发送一部分，返回Continuation表示delay秒后继续调用func(*args, **kwargs)发送剩下的部分
+    func同样可以返回Continuation，在此期间同一receiver的后续回复保持等待
+    """
+
+    def __init__(self, delay, func, *args, **kwargs):
+        self.delay = delay
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+
+class _Delivery(object):
+    __slots__ = ("reply", "context", "step", "retry_cnt", "reserved", "future")
+
+    def __init__(self, reply, context):
+        self.reply = reply
+        self.context = context
+        self.step = None  # 待执行的Continuation，为None时调用send发送reply
+        self.retry_cnt = 0
+        self.reserved = False  # 是否已经预约了限速令牌
+        self.future = Future()
+
+
+class DeliveryScheduler(object):
+    def __init__(self, channel, executor, max_retry=2):
+        self.channel = channel
+        self.executor = executor
+        self.max_retry = max_retry
+        self.queues = {}  # receiver -> deque[_Delivery]
+        self.lock = threading.Lock()
+        self.timers = []  # (到期时间, 序号, receiver)组成的小顶堆
+        self.timer_cond = threading.Condition(self.lock)
+        self.counter = itertools.count()
+        self.channel_bucket = None
+        _thread = threading.Thread(target=self._timer_loop, name="delivery_timer")
+        _thread.setDaemon(True)
+        _thread.start()
+
+    def submit(self, reply, context) -> Future:
+        receiver = context.get("receiver")
+        delivery = _Delivery(reply, context)
+        with self.lock:
+            if receiver in self.queues:  # 前面还有未发完的回复，排在后面
+                self.queues[receiver].append(delivery)
+            else:
+                self.queues[receiver] = deque([delivery])
+                self._schedule(receiver, 0)
+        return delivery.future
+
+    def pending(self):
+        with self.lock:
+            return sum(len(q) for q in self.queues.values())
+
+    # 需要在持有self.lock时调用
+    def _schedule(self, receiver, delay):
+        if delay <= 0:
+            self.executor.submit(self._run, receiver)
+        else:
+            heapq.heappush(self.timers, (time.time() + delay, next(self.counter), receiver))
+            self.timer_cond.notify()
+
+    def _timer_loop(self):
+        with self.timer_cond:
+            while True:
+                if not self.timers:
+                    self.timer_cond.wait()
+                    continue
+                delay = self.timers[0][0] - time.time()
+                if delay > 0:
+                    self.timer_cond.wait(delay)
+                    continue
+                _, _, receiver = heapq.heappop(self.timers)
+                self.executor.submit(self._run, receiver)
+
+    def _buckets(self):
+        rate = snapshot().channel_send_rate_limits.get(self.channel.channel_type, 0)
+        if rate <= 0:
+            self.channel_bucket = None
+        elif self.channel_bucket is None or self.channel_bucket.rpm != rate:
+            self.channel_bucket = LazyTokenBucket(rate)
+        return [bucket for bucket in (_get_global_bucket(), self.channel_bucket) if bucket]
+
+    def _run(self, receiver):
+        with self.lock:
+            delivery = self.queues[receiver][0]
+            if not delivery.reserved:
+                delivery.reserved = True
+                wait = max([bucket.reserve() for bucket in self._buckets()], default=0)
+                if wait > 0:  # 超出发送速率，到时间后再发送
+                    self._schedule(receiver, wait)
+                    return
+        try:
+            if delivery.step is None:
+                result = self.channel._send(delivery.reply, delivery.context)
+            else:
+                result = delivery.step.func(*delivery.step.args, **delivery.step.kwargs)
+        except Exception as e:
+            logger.error("[WX] sendMsg error: {}".format(str(e)))
+            if not isinstance(e, NotImplementedError):
+                logger.exception(e)
+                if delivery.retry_cnt < self.max_retry:
+                    with self.lock:
+                        delivery.retry_cnt += 1
+                        delivery.reserved = False
+                        self._schedule(receiver, 3 + 3 * (delivery.retry_cnt - 1))
+                    return
+            self._finish(receiver, delivery, exception=e)
+            return
+        if isinstance(result, Continuation):
+            with self.lock:
+                delivery.step = result
+                delivery.reserved = False
+                self._schedule(receiver, result.delay)
+            return
+        self._finish(receiver, delivery)
+
+    def _finish(self, receiver, delivery, exception=None):
+        with self.lock:
+            queue = self.queues[receiver]
+            queue.popleft()
+            if queue:
+                self._schedule(receiver, 0)
+            else:
+                del self.queues[receiver]
+        if exception is None:
+            delivery.future.set_result(delivery.reply)
+        else:
+            delivery.future.set_exception(exception)
@@ -0,0 +1,158 @@
+"""
+消息分类
+
+作图指令(MJ/SD)、图片链接、引用消息等判断原来分散在Utils和ChatGPTBot中，每条消息会重复执行多次未编译的正则
+这里把所有规则编译一次，每条消息只分类一次，结果保存在context["message_info"]中，_compose_context和bot直接复用
+"""
+
+import re
+
+# 作图接口的类型，与ChatGPTBot中调用的MJ接口对应
+INTENT_TEXT = "text"
+INTENT_DESCRIBE = "describe"  # desc + 一张图片，图生文
+INTENT_BLEND = "blend"  # 多张图片混合
+INTENT_SIMPLE_CHANGE = "simple_change"  # "任务ID U1"形式的放大/变换
+INTENT_CHANGE = "change"  # mju/mjv/mjr
+INTENT_IMAGINE = "imagine"  # $mj、$sd等作图指令
+
+QUOTE_MARK = "」\n- - - - - - - - - - - - - - -"
+
+HTTP_PIC_PATTERN = re.compile(r"http[s]?://[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)")
+HTTP_URLS_PATTERN = re.compile(HTTP_PIC_PATTERN.pattern, re.IGNORECASE)
+LOCAL_URLS_PATTERN = re.compile(r"wechat_tmp/[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)", re.IGNORECASE)
+WECHAT_PIC_PATTERN = re.compile(r"(wechat_tmp/\d{6}-\d{6}\.png)")
+DESC_WECHAT_PIC_PATTERN = re.compile(r"^desc wechat_tmp/\d{6}-\d{6}\.png$")
+DESC_HTTP_PIC_PATTERN = re.compile(r"^desc http[s]?://[^\s]+(?:jpg|jpeg|png|gif|bmp|svg)$")
+SIMPLE_CHANGE_PATTERN = re.compile(r"^\s*\d{16}\s+[UVuV][1-4]\s*$")
+MJ_U_V_INDEX_PATTERN = re.compile(r"[u|v](\d)")
+MJ_TASK_ID_PATTERN = re.compile(r"[uvr]\s?(\d+)")
+REF_MSG_TASK_ID_PATTERN = re.compile(r"任务ID: (\d+)")
+QUOTE_PATTERN = re.compile(r"「(.*)」", re.DOTALL)
+QUOTE_REPLY_PATTERN = re.compile(r"- - - - - - - - - - - - - - -\n(.+)")
+
+MJ_PREFIXES = ("$mj", "mj ", "mju", "mjv", "mjr")
+MJ_ACTIONS = (("mju", "UPSCALE"), ("$mju", "UPSCALE"), ("mjv", "VARIATION"), ("$mjv", "VARIATION"), ("mjr", "REROLL"), ("$mjr", "REROLL"))
+
+
+class MessageInfo(object):
+    """
+    一条文本消息的分类结果，text为分类时的内容，内容被修改后需要重新分类
+    """
+
+    __slots__ = (
+        "text",
+        "intent",
+        "mj",
+        "sd",
+        "mj_action",
+        "mj_index",
+        "mj_task_id",
+        "http_urls",
+        "local_urls",
+        "http_pic",
+        "wechat_pic",
+        "is_quote",
+        "quoted_text",
+        "quote_content",
+    )
+
+    def __init__(self, text):
+        self.text = text
+        self.mj_action = None  # UPSCALE、VARIATION、REROLL
+        self.mj_index = None
+        self.mj_task_id = None
+        self.http_urls = ()
+        self.local_urls = ()
+        self.http_pic = None
+        self.wechat_pic = None
+        self.is_quote = False
+        self.quoted_text = None  # 被引用的消息内容
+        self.quote_content = None  # 回复内容 + 被引用的消息内容，引用消息格式不正确时为None
+
+    def is_image_create(self):
+        """
+        不考虑image_create_prefix时，是否需要作为IMAGE_CREATE处理
+        """
+        return self.mj or self.sd or self.intent in (INTENT_DESCRIBE, INTENT_BLEND)
+
+    def __repr__(self):
+        return "MessageInfo(intent={}, mj={}, sd={}, mj_action={}, mj_index={}, mj_task_id={}, http_urls={}, local_urls={}, is_quote={})".format(
+            self.intent, self.mj, self.sd, self.mj_action, self.mj_index, self.mj_task_id, len(self.http_urls), len(self.local_urls), self.is_quote
+        )
+
+
+def classify(text) -> MessageInfo:
+    info = MessageInfo(text)
+    # 图片链接都包含"/"，没有时跳过所有链接相关的正则
+    if "/" in text:
+        info.http_urls = tuple(HTTP_URLS_PATTERN.findall(text))
+        info.local_urls = tuple(LOCAL_URLS_PATTERN.findall(text))
+        match = HTTP_PIC_PATTERN.search(text)
+        info.http_pic = match.group(0) if match else None
+        match = WECHAT_PIC_PATTERN.search(text)
+        info.wechat_pic = match.group(1) if match else None
+    describe = text.startswith("desc ") and (DESC_WECHAT_PIC_PATTERN.match(text) is not None or DESC_HTTP_PIC_PATTERN.match(text) is not None)
+    info.mj = text.startswith(MJ_PREFIXES) or describe
+    info.sd = text.startswith("$sd")
+    for prefix, action in MJ_ACTIONS:
+        if text.startswith(prefix):
+            info.mj_action = action
+            break
+
+    http_count, local_count = len(info.http_urls), len(info.local_urls)
+    if describe:
+        info.intent = INTENT_DESCRIBE
+    elif (http_count > 0 and local_count > 0) or http_count > 1 or local_count > 1:
+        info.intent = INTENT_BLEND
+    elif SIMPLE_CHANGE_PATTERN.match(text):
+        info.intent = INTENT_SIMPLE_CHANGE
+    elif (info.mj or info.sd) and info.mj_action:
+        info.intent = INTENT_CHANGE
+    elif info.mj or info.sd:
+        info.intent = INTENT_IMAGINE
+    else:
+        info.intent = INTENT_TEXT
+
+    if info.intent == INTENT_CHANGE:
+        if info.mj_action != "REROLL":
+            match = MJ_U_V_INDEX_PATTERN.search(text)
+            info.mj_index = match.group(1) if match else None
+        match = REF_MSG_TASK_ID_PATTERN.search(text) or MJ_TASK_ID_PATTERN.search(text)
+        info.mj_task_id = match.group(1) if match else None
+
+    if QUOTE_MARK in text:
+        info.is_quote = True
+        info.quoted_text, info.quote_content = parse_quote(text)
+    return info
+
+
+def parse_quote(text):
+    """
+    解析引用消息，返回(被引用的消息内容, 回复内容 + 被引用的消息内容)，格式不正确时返回(None, None)
+    """
+    match = QUOTE_PATTERN.search(text)
+    reply = QUOTE_REPLY_PATTERN.search(text)
+    if match and reply and "：" in match.group(1):
+        quoted_text = match.group(1).split("：", 1)[1]
+        return quoted_text, f"{reply.group(1)} {quoted_text}"
+    return None, None
+
+
+def classify_context(context, content=None) -> MessageInfo:
+    """
+    返回context中缓存的分类结果，content与分类时的内容不同(比如被插件修改)时重新分类
+    """
+    if content is None:
+        content = context.content
+    info = context.get("message_info")
+    if info is None or info.text != content:
+        info = classify(content)
+        context["message_info"] = info
+    return info
+
+
+def remove_prefix_mj_sd(text):
+    for prefix in ("$mj", "mj ", "$sd", "sd "):
+        if text.startswith(prefix):
+            return text[len(prefix) :]
+    return text
@@ -63,6 +63,7 @@ class TerminalChannel(ChatChannel):
     def startup(self):
         context = Context()
         logger.setLevel("WARN")
+        self.after_login()
         print("\nPlease input your question:\nUser:", end="")
         sys.stdout.flush()
         msg_id = 0
@@ -15,14 +15,19 @@ import requests
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
+from channel.message_classifier import QUOTE_MARK
 from channel.wechat.wechat_message import *
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
-from config import conf, get_appdata_dir
+from common.trigger_matcher import get_trigger_matcher
+from config import conf, get_appdata_dir, snapshot
 from lib import itchat
 from lib.itchat.content import *
+from plugins import *
+
+MJ_SD_PREFIXES = ("$mj", "mj", "$sd", "desc ")  # 作图指令可能的开头，见message_classifier.classify
 
 
 @itchat.msg_register([TEXT, VOICE, PICTURE, NOTE])
@@ -38,6 +43,8 @@ def handler_single_msg(msg):
 
 @itchat.msg_register([TEXT, VOICE, PICTURE, NOTE], isGroupChat=True)
 def handler_group_msg(msg):
+    if not WechatChannel().prefilter_group_msg(msg):
+        return None
     try:
         cmsg = WechatMessage(msg, True)
     except NotImplementedError as e:
@@ -106,6 +113,38 @@ class WechatChannel(ChatChannel):
     def __init__(self):
         super().__init__()
         self.receivedMsgs = ExpiredDict(60 * 60 * 24)
+        self.group_white_list_cache = {}  # group_id -> (群名, 触发词匹配器, 是否在白名单中)
+
+    def _is_group_in_white_list(self, group_id, group_name, matcher):
+        cached = self.group_white_list_cache.get(group_id)
+        if cached is not None and cached[0] == group_name and cached[1] is matcher:
+            return cached[2]
+        allowed = matcher.is_group_in_white_list(group_name)
+        self.group_white_list_cache[group_id] = (group_name, matcher, allowed)
+        return allowed
+
+    def prefilter_group_msg(self, msg):
+        """
+        群消息的预筛选，只使用原始消息的字段，判断消息是否可能触发回复，不可能触发的直接丢弃，不再构造WechatMessage和context
+        判断条件比_compose_context宽松，被丢弃的消息一定不会触发回复
+        """
+        if not snapshot().group_msg_prefilter:
+            return True
+        user = msg.get("User")
+        if not user or not user.get("UserName"):
+            return True
+        matcher = get_trigger_matcher()
+        if not self._is_group_in_white_list(user["UserName"], user.get("NickName"), matcher):
+            return False  # 不在白名单中的群，任何消息都不会处理
+        if msg["Type"] != TEXT or msg.get("IsAt"):
+            return True
+        if PluginManager().listening_plugins.get(Event.ON_RECEIVE_MESSAGE):  # 有插件需要接收白名单群中的所有消息
+            return True
+        content = msg.get("Text") or ""
+        if content.startswith(MJ_SD_PREFIXES) or QUOTE_MARK in content:  # 作图指令和引用消息
+            return True
+        match_prefix, match_contain = matcher.match_group(content)
+        return match_prefix is not None or match_contain is not None
 
     def startup(self):
         itchat.instance.receivingRetryCount = 600  # 修改断线超时时间
@@ -121,9 +160,13 @@ class WechatChannel(ChatChannel):
         self.user_id = itchat.instance.storageClass.userName
         self.name = itchat.instance.storageClass.nickName
         logger.info("Wechat login success, user_id: {}, nickname: {}".format(self.user_id, self.name))
+        self.after_login()
         # start message listener
         itchat.run()
 
+    def _can_replay_checkpoint(self):
+        return conf().get("hot_reload", False)  # 重新扫码登录后用户的id会变化，之前保存的消息无法回复
+
     # handle_* 系列函数处理收到的消息后构造Context，然后传入produce函数中处理Context和发送回复
     # Context包含了消息的所有信息，包括以下属性
     #   type 消息类型, 包括TEXT、VOICE、IMAGE_CREATE
@@ -18,6 +18,7 @@ from bridge.context import Context
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechat.wechaty_message import WechatyMessage
+from common.async_runner import AsyncRunner
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -44,7 +45,10 @@ class WechatyChannel(ChatChannel):
     async def main(self):
         loop = asyncio.get_event_loop()
         # 将asyncio的loop传入处理线程
-        self.handler_pool._initializer = lambda: asyncio.set_event_loop(loop)
+        for pool in self.stage_pools.values():
+            pool._initializer = lambda: asyncio.set_event_loop(loop)
+        if self.async_mode:
+            AsyncRunner().set_executor_initializer(lambda: asyncio.set_event_loop(loop))
         self.bot = Wechaty()
         self.bot.on("login", self.on_login)
         self.bot.on("message", self.on_message)
@@ -54,6 +58,7 @@ class WechatyChannel(ChatChannel):
         self.user_id = contact.contact_id
         self.name = contact.name
         logger.info("[WX] login user={}".format(contact))
+        self.after_login()
 
     # 统一的发送函数，每个Channel自行实现，根据reply的type字段发送不同类型的消息
     def send(self, reply: Reply, context: Context):
@@ -1,7 +1,6 @@
 # -*- coding=utf-8 -*-
 import io
 import os
-import time
 
 import requests
 import web
@@ -13,6 +12,7 @@ from wechatpy.exceptions import InvalidSignatureException, WeChatClientException
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
+from channel.delivery import Continuation
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
 from common.log import logger
@@ -43,6 +43,7 @@ class WechatComAppChannel(ChatChannel):
         self.client = WechatComAppClient(self.corp_id, self.secret)
 
     def startup(self):
+        self.after_login()
         # start message listener
         urls = ("/wxcomapp", "channel.wechatcom.wechatcomapp_channel.Query")
         app = web.application(urls, globals(), autoreload=False)
@@ -56,11 +57,8 @@ class WechatComAppChannel(ChatChannel):
             texts = split_string_by_utf8_length(reply_text, MAX_UTF8_LEN)
             if len(texts) > 1:
                 logger.info("[wechatcom] text too long, split into {} parts".format(len(texts)))
-            for i, text in enumerate(texts):
-                self.client.message.send_text(self.agent_id, receiver, text)
-                if i != len(texts) - 1:
-                    time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
             logger.info("[wechatcom] Do send text to {}: {}".format(receiver, reply_text))
+            return self._send_texts(receiver, texts)
         elif reply.type == ReplyType.VOICE:
             try:
                 media_ids = []
@@ -83,10 +81,8 @@ class WechatComAppChannel(ChatChannel):
                     os.remove(amr_file)
             except Exception:
                 pass
-            for media_id in media_ids:
-                self.client.message.send_voice(self.agent_id, receiver, media_id)
-                time.sleep(1)
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
+            return self._send_voices(receiver, media_ids)
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
             pic_res = requests.get(img_url, stream=True)
@@ -125,6 +121,17 @@ class WechatComAppChannel(ChatChannel):
             self.client.message.send_image(self.agent_id, receiver, response["media_id"])
             logger.info("[wechatcom] sendImage, receiver={}".format(receiver))
 
+    # 分段发送时，每段之间间隔一段时间，防止发送过快乱序，间隔由发送调度的定时器完成，不占用发送线程
+    def _send_texts(self, receiver, texts):
+        self.client.message.send_text(self.agent_id, receiver, texts[0])
+        if len(texts) > 1:
+            return Continuation(0.5, self._send_texts, receiver, texts[1:])
+
+    def _send_voices(self, receiver, media_ids):
+        if media_ids:
+            self.client.message.send_voice(self.agent_id, receiver, media_ids[0])
+            return Continuation(1, self._send_voices, receiver, media_ids[1:])
+
 
 class Query:
     def GET(self):
@@ -4,7 +4,6 @@ import imghdr
 import io
 import os
 import threading
-import time
 
 import requests
 import web
@@ -14,6 +13,7 @@ from wechatpy.exceptions import WeChatClientException
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
+from channel.delivery import Continuation
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_client import WechatMPClient
 from common.log import logger
@@ -58,6 +58,7 @@ class WechatMPChannel(ChatChannel):
             t.start()
 
     def startup(self):
+        self.after_login()
         if self.passive_reply:
             urls = ("/wx", "channel.wechatmp.passive_reply.Query")
         else:
@@ -92,14 +93,14 @@ class WechatMPChannel(ChatChannel):
                         logger.info("[wechatmp] upload voice response: {}".format(response))
                         # 根据文件大小估计一个微信自动审核的时间，审核结束前返回将会导致语音无法播放，这个估计有待验证
                         f_size = os.fstat(f.fileno()).st_size
-                        time.sleep(1.0 + 2 * f_size / 1024 / 1024)
+                        review_time = 1.0 + 2 * f_size / 1024 / 1024
                         # todo check media_id
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload voice failed: {}".format(e))
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver] = ("voice", media_id)
+                return Continuation(review_time, self._cache_reply, receiver, ("voice", media_id))  # 审核结束后再放入缓存
 
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
@@ -141,11 +142,8 @@ class WechatMPChannel(ChatChannel):
                 texts = split_string_by_utf8_length(reply_text, MAX_UTF8_LEN)
                 if len(texts) > 1:
                     logger.info("[wechatmp] text too long, split into {} parts".format(len(texts)))
-                for i, text in enumerate(texts):
-                    self.client.message.send_text(receiver, text)
-                    if i != len(texts) - 1:
-                        time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
                 logger.info("[wechatmp] Do send text to {}: {}".format(receiver, reply_text))
+                return self._send_texts(receiver, texts)
             elif reply.type == ReplyType.VOICE:
                 try:
                     file_path = reply.content
@@ -204,10 +202,32 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
         return
 
+    # 分段发送时，每段之间间隔0.5秒，防止发送过快乱序
+    def _send_texts(self, receiver, texts):
+        self.client.message.send_text(receiver, texts[0])
+        if len(texts) > 1:
+            return Continuation(0.5, self._send_texts, receiver, texts[1:])
+
+    def _can_replay_checkpoint(self):
+        return not self.passive_reply  # 被动回复只能在用户请求时返回
+
+    def _cache_reply(self, receiver, reply):
+        self.cache_dict[receiver] = reply
+
+    def deliver(self, reply: Reply, context: Context):
+        future = super().deliver(reply, context)
+        if self.passive_reply:
+            context["last_delivery"] = future  # 回复是异步放入缓存的，需要等放入缓存后才结束running状态
+        return future
+
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
         logger.info("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
-            self.running.remove(session_id)
+            future = context.get("last_delivery")
+            if future is None:
+                self.running.remove(session_id)
+            else:
+                future.add_done_callback(lambda f: self.running.remove(session_id))
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
@@ -0,0 +1,39 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+
+@singleton
+class AsyncRunner(object):
+    """
+    进程内共享的事件循环，运行在单独的线程中
+    协程通过submit提交，返回concurrent.futures.Future，可以和线程池的Future一样添加回调、取消
+    同步的插件和bot通过run_sync桥接到有界线程池中执行，避免阻塞事件循环
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=conf().get("async_executor_workers", 16), thread_name_prefix="async_bridge")
+        self.loop.set_default_executor(self.executor)
+        _thread = threading.Thread(target=self._run, name="async_runner")
+        _thread.setDaemon(True)
+        _thread.start()
+        logger.info("[AsyncRunner] event loop started, executor workers={}".format(self.executor._max_workers))
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def set_executor_initializer(self, initializer):
+        self.executor._initializer = initializer
+
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run_sync(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,215 @@
+"""
+进程内的指标统计，按Prometheus文本格式导出
+只依赖标准库，开启metrics_enabled后通过内置的http服务在 /metrics 提供查询
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.log import logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+
+class _Metric(object):
+    type = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._functions = []
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def set_function(self, func):
+        """
+        func在每次导出时调用，返回[(labels, value), ...]，用于线程池、队列等实时状态
+        """
+        with self._lock:
+            self._functions.append(func)
+
+    def _function_samples(self, suffix):
+        with self._lock:
+            functions = list(self._functions)
+        samples = []
+        for func in functions:
+            try:
+                samples += [(suffix, self._key(labels), None, value) for labels, value in func()]
+            except Exception as e:
+                logger.warning("[Metrics] collect {} failed: {}".format(self.name, e))
+        return samples
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, labels, extra, value in self._samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, _format_labels(self.labelnames, labels, extra), _format_value(value)))
+        return "\n".join(lines)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            samples = [("_total", key, None, value) for key, value in self._values.items()]
+        return samples + self._function_samples("_total")
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        with self._lock:
+            samples = [("", key, None, value) for key, value in self._values.items()]
+        return samples + self._function_samples("")
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, cnt in zip(self.buckets, counts):
+                    cumulative += cnt
+                    samples.append(("_bucket", key, ("le", _format_value(float(bound))), cumulative))
+                samples.append(("_sum", key, None, total))
+                samples.append(("_count", key, None, count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("metric {} already registered as {}".format(name, metric.type))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# 各处理阶段的耗时，stage: queue_wait, compose, bot, voice, decorate, send
+STAGE_SECONDS = REGISTRY.histogram("chat_stage_seconds", "Time spent in each stage of a context", ("channel", "stage"))
+PLUGIN_EVENT_SECONDS = REGISTRY.histogram("chat_plugin_event_seconds", "Time spent dispatching a plugin event", ("channel", "event"))
+# 每个插件处理函数的调用次数、累计耗时、最大耗时和异常次数，由PluginManager在导出时提供
+PLUGIN_HANDLER_CALLS = REGISTRY.counter("chat_plugin_handler_calls", "Calls of each plugin handler", ("plugin", "event"))
+PLUGIN_HANDLER_SECONDS = REGISTRY.counter("chat_plugin_handler_seconds", "Cumulative time spent in each plugin handler", ("plugin", "event"))
+PLUGIN_HANDLER_MAX_SECONDS = REGISTRY.gauge("chat_plugin_handler_max_seconds", "Slowest call of each plugin handler", ("plugin", "event"))
+PLUGIN_HANDLER_ERRORS = REGISTRY.counter("chat_plugin_handler_errors", "Exceptions raised by each plugin handler", ("plugin", "event"))
+PLUGIN_EVENT_DROPPED = REGISTRY.counter("chat_plugin_event_dropped", "Background plugin events dropped because the queue was full", ("event",))
+SHED_TOTAL = REGISTRY.counter("chat_shed", "Contexts dropped by admission control", ("channel", "reason"))
+POOL_TASKS = REGISTRY.gauge("chat_stage_pool_tasks", "Tasks and worker limit of each stage pool", ("channel", "pool", "state"))
+QUEUE_MESSAGES = REGISTRY.gauge("chat_queue_messages", "Queued and in-flight contexts", ("channel", "state"))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="0.0.0.0"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    _thread = threading.Thread(target=server.serve_forever, name="metrics_server")
+    _thread.setDaemon(True)
+    _thread.start()
+    logger.info("[Metrics] serving on http://{}:{}/metrics".format(host, port))
+    return server
@@ -0,0 +1,123 @@
+"""
+Redis协议(RESP2)的最小客户端，只用于会话存储，不需要额外安装redis依赖
+
+每个线程使用自己的连接，WATCH/MULTI/EXEC等依赖连接状态的命令可以直接在同一线程中依次执行
+"""
+
+import socket
+import threading
+from urllib.parse import unquote, urlparse
+
+
+class RespError(Exception):
+    pass
+
+
+class RespConnection(object):
+    def __init__(self, host, port, password=None, db=0, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.request([("AUTH", password)], raise_error=True)
+        if db:
+            self.request([("SELECT", db)], raise_error=True)
+
+    @staticmethod
+    def _encode(args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, bytes):
+                data = arg
+            elif isinstance(arg, str):
+                data = arg.encode("utf-8")
+            else:
+                data = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            return RespError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("connection closed by server")
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read() for _ in range(length)]
+        raise ConnectionError("unknown reply type {}".format(line))
+
+    def request(self, commands, raise_error=False):
+        """
+        一次发送多条命令(pipeline)，按顺序返回每条命令的结果，错误结果以RespError返回，raise_error为True时抛出
+        """
+        self.sock.sendall(b"".join(self._encode(args) for args in commands))
+        replies = [self._read() for _ in commands]
+        if raise_error:
+            for reply in replies:
+                if isinstance(reply, RespError):
+                    raise reply
+        return replies
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except Exception:
+            pass
+
+
+class RespClient(object):
+    def __init__(self, url="redis://localhost:6379/0", timeout=5):
+        """
+        :param url: redis://[:password@]host[:port][/db]
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", ""):
+            raise ValueError("unsupported redis url: {}".format(url))
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        path = parsed.path.strip("/")
+        self.db = int(path) if path else 0
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = RespConnection(self.host, self.port, self.password, self.db, self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def pipeline(self, commands, raise_error=True):
+        try:
+            return self.connection().request(commands, raise_error=raise_error)
+        except (OSError, ConnectionError):
+            # 连接出错后丢弃，下次调用重新连接，WATCH等连接状态随之失效
+            self.close()
+            raise
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            self.local.conn = None
+            conn.close()
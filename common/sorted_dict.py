@@ -1,7 +1,14 @@
-import heapq
+import bisect
+
+_MISSING = object()
 
 
 class SortedDict(dict):
+    """
+    按sort_func(key, value)排序的dict，排序值相同时按key排序，reverse为True时从大到小
+    用二分查找维护有序的(排序值, key)列表，插入、修改和删除不需要重新排序，遍历时使用缓存的key列表
+    """
+
     def __init__(self, sort_func=lambda k, v: k, init_dict=None, reverse=False):
         if init_dict is None:
             init_dict = []
@@ -10,53 +17,85 @@ class SortedDict(dict):
         self.sort_func = sort_func
         self.sorted_keys = None
         self.reverse = reverse
-        self.heap = []
+        self.order = []  # 从小到大排列的(排序值, key)
+        self.priorities = {}  # key -> 排序值
         for k, v in init_dict:
             self[k] = v
 
     def __setitem__(self, key, value):
-        if key in self:
-            super().__setitem__(key, value)
-            for i, (priority, k) in enumerate(self.heap):
-                if k == key:
-                    self.heap[i] = (self.sort_func(key, value), key)
-                    heapq.heapify(self.heap)
-                    break
-            self.sorted_keys = None
-        else:
-            super().__setitem__(key, value)
-            heapq.heappush(self.heap, (self.sort_func(key, value), key))
-            self.sorted_keys = None
+        super().__setitem__(key, value)
+        self._place(key, self.sort_func(key, value))
 
     def __delitem__(self, key):
         super().__delitem__(key)
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                del self.heap[i]
-                heapq.heapify(self.heap)
-                break
+        self._remove(key, self.priorities.pop(key))
+        self.sorted_keys = None
+
+    def _place(self, key, priority):
+        old = self.priorities.get(key, _MISSING)
+        if old is not _MISSING:
+            if old == priority:
+                return
+            self._remove(key, old)
+        bisect.insort(self.order, (priority, key))
+        self.priorities[key] = priority
         self.sorted_keys = None
 
+    def _remove(self, key, priority):
+        del self.order[bisect.bisect_left(self.order, (priority, key))]
+
+    def _update_heap(self, key):
+        """
+        value是可变对象、排序值在外部被修改后调用，重新确定key的位置
+        """
+        self._place(key, self.sort_func(key, self[key]))
+
     def keys(self):
         if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
+            sorted_keys = [k for _, k in self.order]
+            if self.reverse:
+                sorted_keys.reverse()
+            self.sorted_keys = sorted_keys
         return self.sorted_keys
 
     def items(self):
-        if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
-        sorted_items = [(k, self[k]) for k in self.sorted_keys]
-        return sorted_items
+        return [(k, self[k]) for k in self.keys()]
 
-    def _update_heap(self, key):
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                new_priority = self.sort_func(key, self[key])
-                if new_priority != priority:
-                    self.heap[i] = (new_priority, key)
-                    heapq.heapify(self.heap)
-                    self.sorted_keys = None
-                break
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def pop(self, key, default=_MISSING):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def popitem(self):
+        """
+        弹出遍历顺序中的最后一项
+        """
+        if not self.order:
+            raise KeyError("popitem(): dictionary is empty")
+        key = self.order[0 if self.reverse else -1][1]
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        super().clear()
+        self.order = []
+        self.priorities = {}
+        self.sorted_keys = None
 
     def __iter__(self):
         return iter(self.keys())
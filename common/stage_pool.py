@@ -0,0 +1,280 @@
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from concurrent.futures.thread import BrokenThreadPool
+
+from common.log import logger
+
+
+class StagePool(ThreadPoolExecutor):
+    """
+    记录排队和执行中任务数的线程池，每个处理阶段使用独立的StagePool，便于观察各阶段的负载
+    """
+
+    def __init__(self, name, max_workers, initializer=None):
+        super().__init__(max_workers=max_workers, thread_name_prefix="{}_pool".format(name), initializer=initializer)
+        self.name = name
+        self.pending = 0  # 已提交但未开始执行的任务数
+        self.active = 0  # 执行中的任务数
+        self.completed = 0  # 已完成的任务数
+        self._stats_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self.pending += 1
+        future = super().submit(self._run, fn, *args, **kwargs)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _run(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self.pending -= 1
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self.active -= 1
+                self.completed += 1
+
+    def _on_done(self, future):
+        if future.cancelled():  # 未开始执行就被取消的任务
+            with self._stats_lock:
+                self.pending -= 1
+
+    def resize(self, max_workers):
+        """
+        调整线程数上限，扩容在之后提交任务时生效；缩容时已创建的线程不会退出，只是不再创建新的线程
+        """
+        with self._stats_lock:
+            self._max_workers = max(int(max_workers), 1)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "name": self.name,
+                "max_workers": self._max_workers,
+                "pending": self.pending,
+                "active": self.active,
+                "completed": self.completed,
+            }
+
+
+class AdaptiveStagePool(Executor):
+    """
+    可以自动伸缩的线程池，线程数在[min_workers, max_workers]之间调整
+    控制线程定期根据任务排队时间、执行中的任务数以及上游(如openai)的响应时间计算目标线程数：
+        需要的线程数 ≈ 任务到达速率 × 单个任务耗时 (利特尔法则)
+    排队时间超过wait_target时立即扩容，空闲时逐步缩容，每次调整都会记录原因
+    """
+
+    def __init__(self, name, min_workers, max_workers, initializer=None, interval=5, wait_target=0.5):
+        self.name = name
+        self.min_workers = max(int(min_workers), 1)
+        self.max_workers = max(int(max_workers), self.min_workers)
+        self._max_workers = self.min_workers  # 当前的目标线程数，与ThreadPoolExecutor保持同名便于统计
+        self._initializer = initializer
+        self.interval = interval
+        self.wait_target = wait_target
+        self.pending = 0
+        self.active = 0
+        self.completed = 0
+        self.workers = 0
+        self.idle = 0
+        self.decisions = deque(maxlen=20)  # 最近的扩缩容决策
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._broken = False  # initializer失败后与ThreadPoolExecutor一致，线程池不再可用
+        # 以下统计在每个调整周期内累计
+        self._arrivals = 0
+        self._wait_sum = 0.0
+        self._wait_cnt = 0
+        self._task_time = None  # 任务耗时的指数移动平均
+        self._upstream_latency = None  # 上游响应时间的指数移动平均
+        _thread = threading.Thread(target=self._control_loop, name="{}_pool_ctl".format(name))
+        _thread.setDaemon(True)
+        _thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            if self._broken:
+                raise BrokenThreadPool(self._broken)
+            self.pending += 1
+            self._arrivals += 1
+            self._queue.put((future, fn, args, kwargs, time.time()))
+            self._fill_workers()  # 排队的任务多于空闲线程时补充线程，同时到达的一批任务可以并行执行
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        if future.cancelled():
+            with self._lock:
+                self.pending -= 1
+
+    def _fill_workers(self):
+        """
+        在目标线程数以内，为没有空闲线程处理的排队任务补充线程，返回新建的线程数，调用时需要持有self._lock
+        """
+        if self._broken:
+            return 0
+        count = max(min(self._max_workers - self.workers, self.pending - self.idle), 0)
+        for _ in range(count):
+            self._spawn_worker()
+        return count
+
+    def _spawn_worker(self):
+        self.workers += 1
+        _thread = threading.Thread(target=self._worker, name="{}_pool_{}".format(self.name, self.workers))
+        _thread.setDaemon(True)
+        _thread.start()
+
+    def _initializer_failed(self, e):
+        """
+        initializer抛出异常时调用，标记线程池不可用，排队中的任务以BrokenThreadPool结束
+        """
+        logger.exception("[{}_pool] worker initializer failed: {}".format(self.name, e))
+        failed = []
+        with self._lock:
+            self.workers -= 1
+            self._broken = "A thread initializer failed, the thread pool is not usable anymore"
+            while True:
+                try:
+                    failed.append(self._queue.get_nowait()[0])
+                except queue.Empty:
+                    break
+        for future in failed:
+            if future.set_running_or_notify_cancel():  # 已取消的任务在_on_done中扣减了pending
+                with self._lock:
+                    self.pending -= 1
+                future.set_exception(BrokenThreadPool(self._broken))
+
+    def _worker(self):
+        if self._initializer:
+            try:
+                self._initializer()
+            except BaseException as e:
+                self._initializer_failed(e)
+                return
+        while True:
+            with self._lock:
+                if self.workers > self._max_workers or self._shutdown or self._broken:  # 缩容时多余的线程直接退出
+                    self.workers -= 1
+                    return
+                self.idle += 1
+            try:
+                item = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                item = None
+            with self._lock:
+                self.idle -= 1
+            if item is None:
+                continue
+            future, fn, args, kwargs, submit_time = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.time()
+            with self._lock:
+                self.pending -= 1
+                self.active += 1
+                self._wait_sum += start - submit_time
+                self._wait_cnt += 1
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                cost = time.time() - start
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+                    self._task_time = cost if self._task_time is None else 0.8 * self._task_time + 0.2 * cost
+
+    def record_latency(self, latency):
+        """记录一次上游调用的耗时，用于估计后续任务的耗时"""
+        with self._lock:
+            self._upstream_latency = latency if self._upstream_latency is None else 0.8 * self._upstream_latency + 0.2 * latency
+
+    def _control_loop(self):
+        while not self._shutdown:
+            time.sleep(self.interval)
+            self._adjust()
+
+    def _adjust(self):
+        with self._lock:
+            arrival_rate = self._arrivals / self.interval
+            avg_wait = self._wait_sum / self._wait_cnt if self._wait_cnt else 0.0
+            service_time = max(self._task_time or 0.0, self._upstream_latency or 0.0)
+            self._arrivals, self._wait_sum, self._wait_cnt = 0, 0.0, 0
+            old = self._max_workers
+            needed = math.ceil(arrival_rate * service_time)
+            shortfall = self.pending - self.idle  # 没有空闲线程处理的排队任务数
+            if avg_wait > self.wait_target and shortfall > 0:
+                # 有任务在排队，按实际的线程数补足，线程数还没有达到目标时先补充线程，不抬高目标
+                target = max(needed, old, self.workers + shortfall)
+                reason = "queue wait {:.2f}s".format(avg_wait)
+            elif needed < old and self.active + self.pending < old:
+                target = max(needed, self.active + self.pending, old - max(old // 4, 1))  # 逐步缩容，避免抖动
+                reason = "idle"
+            else:
+                target = max(needed, old)
+                reason = "demand"
+            target = min(max(target, self.min_workers), self.max_workers)
+            self._max_workers = target
+            spawned = self._fill_workers()
+            if target == old and not spawned:
+                return
+            decision = {
+                "time": time.time(),
+                "from": old,
+                "to": target,
+                "reason": reason,
+                "avg_wait": round(avg_wait, 3),
+                "arrival_rate": round(arrival_rate, 2),
+                "service_time": round(service_time, 3),
+                "in_flight": self.active,
+                "pending": self.pending,
+                "spawned": spawned,
+            }
+            self.decisions.append(decision)
+        logger.info("[{}_pool] resize {} -> {}, {}".format(self.name, old, target, decision))
+
+    def resize(self, min_workers, max_workers, interval=None, wait_target=None):
+        """
+        调整线程数的范围，当前线程数超出范围时立即调整，多余的线程在空闲时退出
+        """
+        with self._lock:
+            self.min_workers = max(int(min_workers), 1)
+            self.max_workers = max(int(max_workers), self.min_workers)
+            if interval is not None:
+                self.interval = interval
+            if wait_target is not None:
+                self.wait_target = wait_target
+            old = self._max_workers
+            self._max_workers = min(max(old, self.min_workers), self.max_workers)
+            self._fill_workers()
+        if old != self._max_workers:
+            logger.info("[{}_pool] resize {} -> {}, config changed".format(self.name, old, self._max_workers))
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "max_workers": self._max_workers,
+                "pending": self.pending,
+                "active": self.active,
+                "completed": self.completed,
+                "workers": self.workers,
+                "min_workers": self.min_workers,
+                "limit": self.max_workers,
+            }
@@ -36,6 +36,31 @@ class TokenBucket:
         self.is_running = False
 
 
+class LazyTokenBucket:
+    """
+    不需要生成令牌线程的令牌桶，在取令牌时按经过的时间补充
+    reserve总是预约成功，返回预约的令牌可以使用前需要等待的秒数
+    """
+
+    def __init__(self, rpm, capacity=None):
+        self.rpm = rpm
+        self.rate = rpm / 60  # 令牌每秒生成速率
+        self.capacity = capacity if capacity is not None else max(self.rate, 1)  # 令牌桶容量，默认允许1秒的突发
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, n=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n  # 令牌数可以为负，表示已经被预约
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
 if __name__ == "__main__":
     token_bucket = TokenBucket(20, None)  # 创建一个每分钟生产20个tokens的令牌桶
     # token_bucket = TokenBucket(20, 0.1)
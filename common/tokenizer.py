@@ -0,0 +1,150 @@
+"""
+tiktoken编码的注册表
+
+模型到编码的映射只解析一次，编码加载后在进程内共享；BPE文件保存在tiktoken_cache_dir中，
+构建镜像时可以先执行 python -m common.tokenizer 下载好，运行时不再访问网络
+启动时在后台预先加载当前模型的编码，第一条消息不需要等待下载；加载失败后一段时间内不再重试，避免每条消息都卡在网络请求上
+"""
+
+import argparse
+import functools
+import os
+import threading
+import time
+
+from common.log import logger
+from config import get_appdata_dir, snapshot
+
+DEFAULT_ENCODING = "cl100k_base"
+PREFETCH_ENCODINGS = ("cl100k_base", "p50k_base")  # gpt-3.5/gpt-4和text-davinci-003使用的编码
+RETRY_INTERVAL = 60  # 加载失败后多少秒内直接抛出上次的异常
+COUNT_CACHE_SIZE = 4096  # 缓存token数的字符串数量，character_desc、角色设定等会被反复计算
+
+_encodings = {}
+_failures = {}  # 编码名 -> (失败时间, 异常)
+_lock = threading.Lock()
+
+
+def cache_dir():
+    return snapshot().tiktoken_cache_dir or os.path.join(get_appdata_dir(), "tiktoken_cache")
+
+
+def _prepare_cache_dir(path=None):
+    # tiktoken从TIKTOKEN_CACHE_DIR读取和保存BPE文件，已经通过环境变量指定时不覆盖
+    if path is None and ("TIKTOKEN_CACHE_DIR" in os.environ or "DATA_GYM_CACHE_DIR" in os.environ):
+        return
+    path = path or cache_dir()
+    os.makedirs(path, exist_ok=True)
+    os.environ["TIKTOKEN_CACHE_DIR"] = path
+
+
+@functools.lru_cache(maxsize=None)
+def encoding_name_for_model(model):
+    """
+    返回模型使用的编码名，未知的模型抛出KeyError
+    """
+    import tiktoken.model
+
+    if hasattr(tiktoken.model, "encoding_name_for_model"):
+        return tiktoken.model.encoding_name_for_model(model)
+    if model in tiktoken.model.MODEL_TO_ENCODING:
+        return tiktoken.model.MODEL_TO_ENCODING[model]
+    for prefix, name in tiktoken.model.MODEL_PREFIX_TO_ENCODING.items():
+        if model.startswith(prefix):
+            return name
+    raise KeyError(model)
+
+
+def get_encoding(name):
+    encoding = _encodings.get(name)
+    if encoding is not None:
+        return encoding
+    with _lock:  # 同一时间只有一个线程加载，其他线程等待结果，不重复下载
+        encoding = _encodings.get(name)
+        if encoding is not None:
+            return encoding
+        failure = _failures.get(name)
+        if failure is not None and time.time() - failure[0] < RETRY_INTERVAL:
+            raise failure[1]
+        import tiktoken
+
+        _prepare_cache_dir()
+        start = time.time()
+        try:
+            encoding = tiktoken.get_encoding(name)
+        except Exception as e:
+            _failures[name] = (time.time(), e)
+            logger.warning("[Tokenizer] load encoding {} failed: {}".format(name, e))
+            raise
+        _failures.pop(name, None)
+        _encodings[name] = encoding
+        logger.info("[Tokenizer] encoding {} loaded in {:.2f}s".format(name, time.time() - start))
+        return encoding
+
+
+def encoding_for_model(model):
+    return get_encoding(encoding_name_for_model(model))
+
+
+@functools.lru_cache(maxsize=COUNT_CACHE_SIZE)
+def _count_tokens(text, encoding_name, disallow_special):
+    encoding = get_encoding(encoding_name)
+    if disallow_special:
+        return len(encoding.encode(text))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(text, encoding_name, disallow_special=True):
+    """
+    返回text的token数，重复出现的字符串直接使用缓存的结果
+    disallow_special与tiktoken的默认行为一致，text中包含<|endoftext|>等特殊标记时抛出异常，为False时作为普通文本计算
+    """
+    return _count_tokens(text, encoding_name, disallow_special)
+
+
+def warmup(models, background=True):
+    """
+    加载models使用的编码，未知的模型使用cl100k_base
+    """
+    names = []
+    for model in models:
+        try:
+            name = encoding_name_for_model(model)
+        except Exception:
+            name = DEFAULT_ENCODING
+        if name not in names:
+            names.append(name)
+
+    def load():
+        for name in names:
+            try:
+                get_encoding(name)
+            except Exception:
+                pass  # get_encoding中已经记录了日志
+
+    if not background:
+        load()
+        return
+    _thread = threading.Thread(target=load, name="tokenizer_warmup", daemon=True)
+    _thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="download tiktoken encodings into the local cache")
+    parser.add_argument("encodings", nargs="*", default=list(PREFETCH_ENCODINGS), help="编码名或模型名")
+    parser.add_argument("--cache-dir", default=None, help="默认为配置中的tiktoken_cache_dir")
+    args = parser.parse_args()
+
+    path = args.cache_dir or cache_dir()
+    _prepare_cache_dir(path)
+    import tiktoken
+
+    for name in args.encodings:
+        if name not in tiktoken.list_encoding_names():
+            name = encoding_name_for_model(name)
+        get_encoding(name)
+    print("encodings cached in {}".format(path))
+
+
+if __name__ == "__main__":
+    main()
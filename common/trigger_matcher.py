@@ -0,0 +1,156 @@
+"""
+触发词匹配
+
+group_chat_prefix、single_chat_prefix、image_create_prefix等前缀用前缀树匹配，group_chat_keyword等关键词用Aho-Corasick自动机匹配，
+每条消息只需要扫描一遍，耗时与配置的触发词数量无关
+匹配器根据配置快照构建一次，订阅配置的变化，重新加载(load_config/#更新配置)或修改配置后自动重建
+"""
+
+import threading
+from collections import deque
+
+from config import snapshot, subscribe
+
+
+class PrefixTrie(object):
+    """
+    与check_prefix的结果一致：返回列表中最靠前的、content以之开头的前缀
+    """
+
+    def __init__(self, prefixes):
+        self.root = {}
+        self.root_index = None  # 空字符串前缀在列表中的位置
+        self.prefixes = list(prefixes or [])
+        for index, prefix in enumerate(self.prefixes):
+            if not prefix:
+                if self.root_index is None:
+                    self.root_index = index
+                continue
+            node = self.root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            if None not in node:  # None键保存以该节点结尾的前缀的位置
+                node[None] = index
+
+    def match(self, content):
+        best = self.root_index
+        node = self.root
+        for ch in content:
+            node = node.get(ch)
+            if node is None:
+                break
+            index = node.get(None)
+            if index is not None and (best is None or index < best):
+                best = index
+        return None if best is None else self.prefixes[best]
+
+
+class AhoCorasick(object):
+    """
+    多关键词匹配，返回content中最先出现(结束位置最靠前)的关键词，没有则返回None
+    """
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        self.match_empty = False  # 与check_contain一致，空字符串可以匹配任何内容
+        for keyword in keywords or []:
+            if not keyword:
+                self.match_empty = True
+                continue
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.goto[state][ch] = nxt
+                state = nxt
+            if self.output[state] is None:
+                self.output[state] = keyword
+        # 按广度优先计算失败指针，output继承失败指针指向状态的关键词
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(ch, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                if self.output[nxt] is None:
+                    self.output[nxt] = self.output[self.fail[nxt]]
+
+    def search(self, content):
+        if self.match_empty:
+            return ""
+        if len(self.goto) == 1:
+            return None
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class TriggerMatcher(object):
+    def __init__(self, config):
+        self.group_prefix = PrefixTrie(config.get("group_chat_prefix"))
+        self.group_keyword = AhoCorasick(config.get("group_chat_keyword"))
+        self.single_prefix = PrefixTrie(config.get("single_chat_prefix", [""]))
+        self.image_prefix = PrefixTrie(config.get("image_create_prefix"))
+        self.group_name_keyword = AhoCorasick(config.get("group_name_keyword_white_list"))
+        self.group_name_white_list = frozenset(config.get("group_name_white_list", []))
+        self.group_chat_in_one_session = frozenset(config.get("group_chat_in_one_session", []))
+
+    def match_group(self, content):
+        """
+        返回(匹配的前缀, 匹配的关键词)
+        """
+        return self.group_prefix.match(content), self.group_keyword.search(content)
+
+    def match_single(self, content):
+        return self.single_prefix.match(content)
+
+    def match_image(self, content):
+        return self.image_prefix.match(content)
+
+    def is_group_in_white_list(self, group_name):
+        return (
+            "ALL_GROUP" in self.group_name_white_list
+            or group_name in self.group_name_white_list
+            or (group_name is not None and self.group_name_keyword.search(group_name) is not None)
+        )
+
+    def is_group_in_one_session(self, group_name):
+        return "ALL_GROUP" in self.group_chat_in_one_session or group_name in self.group_chat_in_one_session
+
+
+_matcher = None
+_lock = threading.Lock()
+
+
+def get_trigger_matcher() -> TriggerMatcher:
+    global _matcher
+    matcher = _matcher
+    if matcher is None:
+        with _lock:
+            if _matcher is None:
+                _matcher = TriggerMatcher(snapshot())
+            matcher = _matcher
+    return matcher
+
+
+@subscribe
+def _on_config_change(config):
+    global _matcher
+    with _lock:
+        _matcher = TriggerMatcher(config)
@@ -0,0 +1,227 @@
+"""
+带过期时间的缓存
+
+每次读写都会把过期时间刷新为当前时间 + ttl，所有key的ttl相同，所以按最近访问排序的OrderedDict同时也是按过期时间排序的：
+读写只需要move_to_end，清理时从头部弹出已经过期的项即可，不需要堆或时间轮
+后台的清理线程由所有缓存共享，定期清理没有再被访问的项；可以限制项数和估算的内存占用，超出时淘汰最久未访问的项
+"""
+
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from common.log import logger
+
+SWEEP_INTERVAL = 60  # 清理线程最长的检查间隔，秒
+
+EXPIRED = "expired"
+EVICTED = "evicted"  # 超出max_entries或max_bytes被淘汰
+
+
+def default_sizeof(key, value):
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class TTLCache(object):
+    def __init__(self, ttl, max_entries=0, max_bytes=0, sizeof=default_sizeof, on_evict=None):
+        """
+        :param ttl: 多少秒未访问后过期
+        :param max_entries: 最多保存的项数，0表示不限制
+        :param max_bytes: 最多占用的字节数，按sizeof(key, value)估算，0表示不限制
+        :param on_evict: 过期或被淘汰时调用on_evict(key, value, reason)，在锁外调用，可能运行在清理线程中
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.data = OrderedDict()  # key -> [value, 过期时间, 估算的字节数]，按过期时间从早到晚排列
+        self.bytes = 0
+        self.lock = threading.RLock()
+        self.sweeper = _Sweeper.instance()
+        self.sweeper.register(self)
+
+    def _pop_expired(self, now):
+        removed = []
+        data = self.data
+        while data:
+            key, entry = next(iter(data.items()))
+            if entry[1] >= now:
+                break
+            del data[key]
+            self.bytes -= entry[2]
+            removed.append((key, entry[0], EXPIRED))
+        return removed
+
+    def _notify(self, removed):
+        if self.on_evict is None:
+            return
+        for key, value, reason in removed:
+            try:
+                self.on_evict(key, value, reason)
+            except Exception as e:
+                logger.warning("[TTLCache] on_evict failed for {}: {}".format(key, e))
+
+    def _touch(self, key, now):
+        """
+        返回未过期的项并刷新过期时间，没有或已过期时返回None
+        """
+        entry = self.data.get(key)
+        if entry is None:
+            return None, ()
+        if entry[1] < now:
+            del self.data[key]
+            self.bytes -= entry[2]
+            return None, ((key, entry[0], EXPIRED),)
+        entry[1] = now + self.ttl
+        self.data.move_to_end(key)
+        return entry, ()
+
+    def __getitem__(self, key):
+        with self.lock:
+            entry, removed = self._touch(key, time.monotonic())
+        self._notify(removed)
+        if entry is None:
+            raise KeyError("expired {}".format(key) if removed else key)
+        return entry[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        # 与原来的ExpiredDict一致，判断是否存在时也会刷新过期时间
+        with self.lock:
+            entry, removed = self._touch(key, time.monotonic())
+        self._notify(removed)
+        return entry is not None
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(key, value) if self.max_bytes else 0
+        now = time.monotonic()
+        with self.lock:
+            wake = not self.data
+            old = self.data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self.data[key] = [value, now + self.ttl, size]
+            self.bytes += size
+            removed = self._pop_expired(now)
+            while len(self.data) > 1 and ((self.max_entries and len(self.data) > self.max_entries) or (self.max_bytes and self.bytes > self.max_bytes)):
+                old_key, entry = self.data.popitem(last=False)
+                self.bytes -= entry[2]
+                removed.append((old_key, entry[0], EVICTED))
+        if wake:
+            # 空缓存中的第一项可能比清理线程下次醒来的时间更早过期
+            self.sweeper.wake()
+        self._notify(removed)
+
+    def __delitem__(self, key):
+        with self.lock:
+            entry = self.data.pop(key)
+            self.bytes -= entry[2]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+        return value
+
+    def sweep(self):
+        """
+        清理已经过期的项，返回下一项过期的时间(time.monotonic)，缓存为空时返回None
+        """
+        with self.lock:
+            removed = self._pop_expired(time.monotonic())
+            next_expiry = next(iter(self.data.values()))[1] if self.data else None
+        self._notify(removed)
+        return next_expiry
+
+    def keys(self):
+        # 遍历只返回未过期的项，不刷新它们的过期时间
+        self.sweep()
+        with self.lock:
+            return list(self.data.keys())
+
+    def values(self):
+        self.sweep()
+        with self.lock:
+            return [entry[0] for entry in self.data.values()]
+
+    def items(self):
+        self.sweep()
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self.data.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        self.sweep()
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def __repr__(self):
+        return "{}(ttl={}, entries={}, bytes={})".format(type(self).__name__, self.ttl, len(self.data), self.bytes)
+
+
+class _Sweeper(object):
+    """
+    所有TTLCache共享的清理线程，只保存缓存的弱引用，不影响缓存被回收
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.caches = weakref.WeakSet()
+        self.cond = threading.Condition()
+        _thread = threading.Thread(target=self._loop, name="ttl_cache_sweeper", daemon=True)
+        _thread.start()
+
+    def register(self, cache):
+        with self.cond:
+            self.caches.add(cache)
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                caches = list(self.caches)
+            wait = SWEEP_INTERVAL
+            for cache in caches:
+                try:
+                    next_expiry = cache.sweep()
+                except Exception as e:
+                    logger.warning("[TTLCache] sweep failed: {}".format(e))
+                    continue
+                if next_expiry is not None:
+                    wait = min(wait, max(next_expiry - time.monotonic(), 0) + 0.01)
+            del caches
+            with self.cond:
+                self.cond.wait(wait)
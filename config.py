@@ -1,14 +1,18 @@
 # encoding:utf-8
 
+import inspect
 import json
 import logging
 import os
 import pickle
+import threading
+import weakref
+from types import MappingProxyType
 
 from common.log import logger
 
 # 将所有可用的配置项写在字典里, 请使用小写字母
-# 此处的配置值无实际意义，程序不会读取此处的配置，仅用于提示格式，请将配置加入到config.json中
+# 此处的配置值用于提示格式，并作为ConfigSnapshot属性的默认值，请将配置加入到config.json中
 available_setting = {
     # openai api配置
     "open_ai_api_key": "",  # openai api key
@@ -29,16 +33,50 @@ available_setting = {
     "group_chat_keyword": [],  # 群聊时包含该关键词则会触发机器人回复
     "group_at_off": False,  # 是否关闭群聊时@bot的触发
     "group_name_white_list": ["ChatGPT测试群", "ChatGPT测试群2"],  # 开启自动回复的群名称列表
+    "group_msg_prefilter": True,  # 是否在构造消息对象前丢弃不可能触发回复的群消息，仅个人微信(wx)有效
     "group_name_keyword_white_list": [],  # 开启自动回复的群名称关键词列表
     "group_chat_in_one_session": ["ChatGPT测试群"],  # 支持会话上下文共享的群名称
     "trigger_by_self": False,  # 是否允许机器人触发
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "session_queue_max_size": 0,  # 每个会话最多排队的消息数，0表示不限制
+    "total_queue_max_size": 0,  # 所有会话最多排队的消息总数，0表示不限制
+    "max_in_flight": 0,  # 同时处理中的消息总数上限，0表示不限制
+    "queue_max_wait_seconds": 0,  # 消息排队的最长时间，超时后不再处理，0表示不限制
+    "queue_shed_policy": "reject",  # 队列满时的处理策略，reject: 拒绝新消息，drop_oldest: 丢弃该会话最早的消息
+    "queue_shed_reply": "当前排队的消息太多了，请稍后再试",  # 消息被丢弃时的提示，为空则不提示
+    "priority_admin_users": [],  # 最高优先级的用户id或昵称
+    "priority_white_list_users": [],  # 次高优先级的用户id或昵称
+    "priority_weights": {"admin": 4, "white_list": 2, "normal": 1},  # 各优先级的调度权重，按权重轮转调度
+    "send_rate_limit": 0,  # 所有channel每分钟最多发送的消息数，超出后延后发送，0表示不限制
+    "channel_send_rate_limits": {},  # 各channel每分钟最多发送的消息数，如{"wx": 20}
+    "checkpoint_on_exit": False,  # 退出时是否保存排队中和处理中的消息，重启后重新处理
+    "shutdown_drain_seconds": 5,  # 退出时等待处理中的消息完成的时间，单位秒
+    "checkpoint_max_age_seconds": 600,  # 保存时间超过该值(秒)的消息重启后不再处理
+    "coalesce_window_seconds": 0,  # 同一个人连续发送的文字消息，间隔小于该值(秒)时合并为一条再回复，0表示不合并
+    "coalesce_max_messages": 5,  # 最多合并的消息条数
+    "coalesce_max_wait_seconds": 5,  # 合并时第一条消息最多等待的时间，单位秒
+    "stage_pool_sizes": {"chat": 8, "voice": 4, "image": 4, "send": 4},  # 各处理阶段的线程池大小，chat:文字对话，voice:语音识别，image:作图，send:发送回复
+    "stage_pool_autoscale": False,  # 是否根据排队时间和上游响应时间自动调整各阶段线程池的大小，开启后stage_pool_sizes作为线程数下限
+    "stage_pool_max_sizes": {"chat": 32, "voice": 16, "image": 16, "send": 16},  # 自动调整时各阶段线程池的上限
+    "stage_pool_scale_interval": 5,  # 自动调整的检查间隔，单位秒
+    "stage_pool_wait_target": 0.5,  # 任务排队时间超过该值(秒)时扩容
+    "metrics_enabled": False,  # 是否开启内置的指标服务，以Prometheus格式在 /metrics 提供各阶段耗时、队列和线程池状态
+    "metrics_host": "0.0.0.0",  # 指标服务监听的地址
+    "metrics_port": 9464,  # 指标服务监听的端口
+    "async_mode": False,  # 是否以asyncio协程的方式处理消息，开启后大量并发的回复不再各自占用一个线程
+    "async_executor_workers": 16,  # async_mode下，同步的插件和bot桥接使用的线程池大小
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",  # 人格描述
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "conversation_compaction": False,  # 是否把超出conversation_max_tokens的对话在后台压缩成摘要保留，而不是直接丢弃
+    "conversation_compaction_model": "",  # 生成摘要使用的模型，为空时与对话使用的模型相同
+    "conversation_compaction_max_tokens": 300,  # 摘要的最大token数
+    "session_store": "memory",  # 会话的存储方式，memory: 进程内; sqlite: 本地SQLite数据库，重启后保留上下文; redis: Redis，多个进程可以共享会话
+    "session_store_path": "",  # sqlite数据库的路径，为空时使用数据目录下的sessions.db
+    "session_store_redis_url": "redis://localhost:6379/0",  # redis的地址，格式为 redis://[:password@]host[:port][/db]
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
@@ -101,6 +139,11 @@ available_setting = {
     "appdata_dir": "",  # 数据目录
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
+    "tiktoken_cache_dir": "",  # tiktoken编码文件的缓存目录，为空时使用数据目录下的tiktoken_cache，可以先执行python -m common.tokenizer下载
+    "tokenizer_warmup": True,  # 启动时是否在后台预先加载当前模型的tiktoken编码
+    "plugin_prewarm": False,  # 登录后是否在后台提前加载按manifest.json延迟加载的插件
+    "plugin_background_queue_size": 1000,  # AFTER_SEND_REPLY等后台分发的插件事件最多排队的数量，超出后丢弃
+    "plugin_background_workers": 1,  # 后台分发插件事件的线程数
     # 知识库平台配置
     "use_linkai": False,
     "linkai_api_key": "",
@@ -126,15 +169,14 @@ class Config(dict):
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
-        return super().__setitem__(key, value)
+        super().__setitem__(key, value)
+        if self is config:  # 运行中修改配置时，重新生成快照并通知订阅者
+            _publish()
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError as e:
-            return default
-        except Exception as e:
-            raise e
+        if key not in available_setting:
+            raise Exception("key {} not in available_setting".format(key))
+        return super().get(key, default)
 
     # Make sure to return a dictionary to ensure atomic
     def get_user_data(self, user) -> dict:
@@ -162,7 +204,86 @@ class Config(dict):
             logger.info("[Config] User datas error: {}".format(e))
 
 
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    return value
+
+
+class ConfigSnapshot(object):
+    """
+    某一时刻配置的只读快照，load_config或修改配置时整体替换，读取时不需要加锁
+    available_setting中的每一项都是属性，未配置的项取available_setting中的值；列表转换为tuple，dict转换为只读的mapping
+    get(key, default)与Config.get的结果一致，未配置的项返回传入的default
+    """
+
+    __slots__ = ("_values", "version") + tuple(available_setting)
+
+    def __init__(self, values, version=0):
+        frozen = {key: _freeze(value) for key, value in values.items()}
+        object.__setattr__(self, "_values", frozen)
+        object.__setattr__(self, "version", version)
+        for key, default in available_setting.items():
+            object.__setattr__(self, key, frozen[key] if key in frozen else _freeze(default))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("ConfigSnapshot is read-only")
+
+    def __delattr__(self, key):
+        raise AttributeError("ConfigSnapshot is read-only")
+
+    def get(self, key, default=None):
+        if key not in available_setting:
+            raise Exception("key {} not in available_setting".format(key))
+        return self._values.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._values
+
+
 config = Config()
+_snapshot = ConfigSnapshot(config)
+_subscribers = []  # 返回callback的函数，对象的方法使用弱引用，对象被回收后自动失效
+_publish_lock = threading.RLock()
+
+
+def snapshot() -> ConfigSnapshot:
+    """
+    返回当前配置的快照，处理一条消息时取一次快照，各配置项直接作为属性读取
+    """
+    return _snapshot
+
+
+def subscribe(callback):
+    """
+    配置重新加载或修改后调用callback(snapshot)，可以用于重建依赖配置的对象，如请求参数、限流器、线程池大小等
+    callback是对象的方法时只保存弱引用，不影响对象的回收
+    """
+    ref = weakref.WeakMethod(callback) if inspect.ismethod(callback) else (lambda: callback)
+    with _publish_lock:
+        _subscribers.append(ref)
+    return callback
+
+
+def _publish():
+    global _snapshot
+    with _publish_lock:  # 串行发布，订阅者按发布的顺序收到快照
+        _snapshot = ConfigSnapshot(config, _snapshot.version + 1)
+        current = _snapshot
+        callbacks = []
+        for ref in list(_subscribers):
+            callback = ref()
+            if callback is None:
+                _subscribers.remove(ref)
+            else:
+                callbacks.append(callback)
+        for callback in callbacks:
+            try:
+                callback(current)
+            except Exception as e:
+                logger.exception("[Config] apply config to {} failed: {}".format(callback, e))
 
 
 def load_config():
@@ -175,8 +296,8 @@ def load_config():
     config_str = read_file(config_path)
     logger.info("[INIT] config str: {}".format(config_str))
 
-    # 将json字符串反序列化为dict类型
-    config = Config(json.loads(config_str))
+    # 将json字符串反序列化为dict类型，全部处理完成后再替换全局的config
+    new_config = Config(json.loads(config_str))
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
@@ -185,14 +306,18 @@ def load_config():
         if name in available_setting:
             logger.info("[INIT] override config by environ args: {}={}".format(name, value))
             try:
-                config[name] = eval(value)
+                new_config[name] = eval(value)
             except:
                 if value == "false":
-                    config[name] = False
+                    new_config[name] = False
                 elif value == "true":
-                    config[name] = True
+                    new_config[name] = True
                 else:
-                    config[name] = value
+                    new_config[name] = value
+
+    config = new_config
+    config.load_user_datas()
+    _publish()
 
     if config.get("debug", False):
         logger.setLevel(logging.DEBUG)
@@ -200,8 +325,6 @@ def load_config():
 
     logger.info("[INIT] load config: {}".format(config))
 
-    config.load_user_datas()
-
 
 def get_root():
     return os.path.dirname(os.path.abspath(__file__))
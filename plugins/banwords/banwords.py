@@ -44,7 +44,7 @@ class Banwords(Plugin):
                     if word:
                         words.append(word)
             self.searchr.SetKeywords(words)
-            self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+            self.register_handler(Event.ON_HANDLE_CONTEXT, self.on_handle_context, [ContextType.TEXT, ContextType.IMAGE_CREATE])
             if conf.get("reply_filter", True):
                 self.handlers[Event.ON_DECORATE_REPLY] = self.on_decorate_reply
                 self.reply_action = conf.get("reply_action", "ignore")
@@ -54,14 +54,8 @@ class Banwords(Plugin):
             raise e
 
     def on_handle_context(self, e_context: EventContext):
-        if e_context["context"].type not in [
-            ContextType.TEXT,
-            ContextType.IMAGE_CREATE,
-        ]:
-            return
-
         content = e_context["context"].content
-        logger.info("[Banwords] on_handle_context. content: %s" % content)
+        logger.debug("[Banwords] on_handle_context. content: %s" % content)
         if self.action == "ignore":
             f = self.searchr.FindFirst(content)
             if f:
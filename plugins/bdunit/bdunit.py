@@ -41,18 +41,15 @@ class BDunit(Plugin):
             self.api_key = conf["api_key"]
             self.secret_key = conf["secret_key"]
             self.access_token = self.get_token()
-            self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+            self.register_handler(Event.ON_HANDLE_CONTEXT, self.on_handle_context, [ContextType.TEXT])
             logger.info("[BDunit] inited")
         except Exception as e:
             logger.warn("[BDunit] init failed, ignore ")
             raise e
 
     def on_handle_context(self, e_context: EventContext):
-        if e_context["context"].type != ContextType.TEXT:
-            return
-
         content = e_context["context"].content
-        logger.info("[BDunit] on_handle_context. content: %s" % content)
+        logger.debug("[BDunit] on_handle_context. content: %s" % content)
         parsed = self.getUnit2(content)
         intent = self.getIntent(parsed)
         if intent:  # 找到意图
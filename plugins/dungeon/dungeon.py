@@ -52,17 +52,26 @@ class StoryTeller:
 class Dungeon(Plugin):
     def __init__(self):
         super().__init__()
-        self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+        # 有会话在冒险时才需要处理其他文字消息
+        self.register_handler(
+            Event.ON_HANDLE_CONTEXT,
+            self.on_handle_context,
+            [ContextType.TEXT],
+            prefixes=["{trigger_prefix}停止冒险", "{trigger_prefix}开始冒险"],
+            free_form=False,
+        )
         logger.info("[Dungeon] inited")
-        # 目前没有设计session过期事件，这里先暂时使用过期字典
+        # 目前没有设计session过期事件，这里先暂时使用过期字典，最后一局游戏过期后不再接收其他文字消息
         if conf().get("expires_in_seconds"):
-            self.games = ExpiredDict(conf().get("expires_in_seconds"))
+            self.games = ExpiredDict(conf().get("expires_in_seconds"), on_evict=self.on_game_expired)
         else:
             self.games = dict()
 
+    def on_game_expired(self, sessionid, game, reason):
+        logger.debug("[Dungeon] game of {} {}".format(sessionid, reason))
+        self.set_free_form(Event.ON_HANDLE_CONTEXT, len(self.games) > 0)
+
     def on_handle_context(self, e_context: EventContext):
-        if e_context["context"].type != ContextType.TEXT:
-            return
         bottype = Bridge().get_bot_type("chat")
         if bottype not in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI]:
             return
@@ -70,12 +79,13 @@ class Dungeon(Plugin):
         content = e_context["context"].content[:]
         clist = e_context["context"].content.split(maxsplit=1)
         sessionid = e_context["context"]["session_id"]
-        logger.info("[Dungeon] on_handle_context. content: %s" % clist)
+        logger.debug("[Dungeon] on_handle_context. content: %s" % clist)
         trigger_prefix = conf().get("plugin_trigger_prefix", "$")
         if clist[0] == f"{trigger_prefix}停止冒险":
             if sessionid in self.games:
                 self.games[sessionid].reset()
                 del self.games[sessionid]
+                self.set_free_form(Event.ON_HANDLE_CONTEXT, len(self.games) > 0)
                 reply = Reply(ReplyType.INFO, "冒险结束!")
                 e_context["reply"] = reply
                 e_context.action = EventAction.BREAK_PASS
@@ -86,6 +96,7 @@ class Dungeon(Plugin):
                 else:
                     story = "你在树林里冒险，指不定会从哪里蹦出来一些奇怪的东西，你握紧手上的手枪，希望这次冒险能够找到一些值钱的东西，你往树林深处走去。"
                 self.games[sessionid] = StoryTeller(bot, sessionid, story)
+                self.set_free_form(Event.ON_HANDLE_CONTEXT, True)
                 reply = Reply(ReplyType.INFO, "冒险开始，你可以输入任意内容，让故事继续下去。故事背景是：" + story)
                 e_context["reply"] = reply
                 e_context.action = EventAction.BREAK_PASS  # 事件结束，并跳过处理context的默认逻辑
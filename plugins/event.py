@@ -24,7 +24,10 @@ class Event(Enum):
     e_context = {  "channel": 消息channel, "context" : 本次消息的context, "reply" : 目前的回复 }
     """
 
-    # AFTER_SEND_REPLY = 5    # 发送回复后
+    AFTER_SEND_REPLY = 5  # 回复发送成功后，在后台线程中分发，不影响回复的发送
+    """
+    e_context = {  "channel": 消息channel, "context" : 本次消息的context, "reply" : 已发送的回复 }
+    """
 
 
 class EventAction(Enum):
@@ -19,15 +19,12 @@ from plugins import *
 class Finish(Plugin):
     def __init__(self):
         super().__init__()
-        self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+        self.register_handler(Event.ON_HANDLE_CONTEXT, self.on_handle_context, [ContextType.TEXT], prefixes=["{trigger_prefix}"], free_form=False)
         logger.info("[Finish] inited")
 
     def on_handle_context(self, e_context: EventContext):
-        if e_context["context"].type != ContextType.TEXT:
-            return
-
         content = e_context["context"].content
-        logger.info("[Finish] on_handle_context. content: %s" % content)
+        logger.debug("[Finish] on_handle_context. content: %s" % content)
         trigger_prefix = conf().get("plugin_trigger_prefix", "$")
         if content.startswith(trigger_prefix):
             reply = Reply()
@@ -127,6 +127,15 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "pools": {
+        "alias": ["pools", "线程池"],
+        "desc": "查看各处理阶段线程池的负载",
+    },
+    "pstats": {
+        "alias": ["pstats", "插件耗时"],
+        "args": ["数量或reset"],
+        "desc": "查看累计耗时最多的插件，reset清空统计",
+    },
 }
 
 
@@ -204,7 +213,8 @@ class Godcmd(Plugin):
         self.admin_users = gconf["admin_users"]  # 预存的管理员账号，这些账号不需要认证。itchat的用户名每次都会变，不可用
         self.isrunning = True  # 机器人是否运行中
 
-        self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+        # 运行中只需要处理#开头的指令，暂停服务后需要拦截所有消息
+        self.register_handler(Event.ON_HANDLE_CONTEXT, self.on_handle_context, prefixes=["#"], free_form=not self.isrunning)
         logger.info("[Godcmd] inited")
 
     def on_handle_context(self, e_context: EventContext):
@@ -215,7 +225,7 @@ class Godcmd(Plugin):
             return
 
         content = e_context["context"].content
-        logger.info("[Godcmd] on_handle_context. content: %s" % content)
+        logger.debug("[Godcmd] on_handle_context. content: %s" % content)
         if content.startswith("#"):
             if len(content) == 1:
                 reply = Reply()
@@ -312,9 +322,11 @@ class Godcmd(Plugin):
                         cmd = next(c for c, info in ADMIN_COMMANDS.items() if cmd in info["alias"])
                         if cmd == "stop":
                             self.isrunning = False
+                            self.set_free_form(Event.ON_HANDLE_CONTEXT, True)
                             ok, result = True, "服务已暂停"
                         elif cmd == "resume":
                             self.isrunning = True
+                            self.set_free_form(Event.ON_HANDLE_CONTEXT, False)
                             ok, result = True, "服务已恢复"
                         elif cmd == "reconf":
                             load_config()
@@ -329,6 +341,28 @@ class Godcmd(Plugin):
                         elif cmd == "debug":
                             logger.setLevel("DEBUG")
                             ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "pools":
+                            ok = True
+                            result = "线程池状态：\n"
+                            for stats in channel.stage_stats():
+                                result += "{name}: 线程数{max_workers} 执行中{active} 排队{pending} 已完成{completed}\n".format(**stats)
+                        elif cmd == "pstats":
+                            if len(args) == 1 and args[0] == "reset":
+                                PluginManager().reset_plugin_stats()
+                                ok, result = True, "插件统计已清空"
+                            elif len(args) > 1 or (len(args) == 1 and not args[0].isdigit()):
+                                ok, result = False, "请提供要查看的数量或reset"
+                            else:
+                                items = PluginManager().plugin_stats(top=int(args[0]) if args else 10)
+                                ok = True
+                                if not items:
+                                    result = "暂无插件统计"
+                                else:
+                                    result = "插件耗时(按累计耗时排序)：\n"
+                                    for item in items:
+                                        result += "{plugin}.{event}: 调用{calls}次 累计{seconds:.3f}s 平均{avg_ms:.1f}ms 最大{max_ms:.1f}ms 异常{errors}次\n".format(
+                                            avg_ms=item["avg_seconds"] * 1000, max_ms=item["max_seconds"] * 1000, **item
+                                        )
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
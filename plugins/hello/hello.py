@@ -19,17 +19,16 @@ from plugins import *
 class Hello(Plugin):
     def __init__(self):
         super().__init__()
-        self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+        self.register_handler(
+            Event.ON_HANDLE_CONTEXT,
+            self.on_handle_context,
+            [ContextType.TEXT, ContextType.JOIN_GROUP, ContextType.PATPAT],
+            keywords=["Hello", "Hi", "End"],
+            free_form=False,
+        )
         logger.info("[Hello] inited")
 
     def on_handle_context(self, e_context: EventContext):
-        if e_context["context"].type not in [
-            ContextType.TEXT,
-            ContextType.JOIN_GROUP,
-            ContextType.PATPAT,
-        ]:
-            return
-
         if e_context["context"].type == ContextType.JOIN_GROUP:
             e_context["context"].type = ContextType.TEXT
             msg: ChatMessage = e_context["context"]["msg"]
@@ -45,7 +44,7 @@ class Hello(Plugin):
             return
 
         content = e_context["context"].content
-        logger.info("[Hello] on_handle_context. content: %s" % content)
+        logger.debug("[Hello] on_handle_context. content: %s" % content)
         if content == "Hello":
             reply = Reply()
             reply.type = ReplyType.TEXT
@@ -38,18 +38,15 @@ class Keyword(Plugin):
             self.keyword = conf["keyword"]
 
             logger.info("[keyword] {}".format(self.keyword))
-            self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+            self.register_handler(Event.ON_HANDLE_CONTEXT, self.on_handle_context, [ContextType.TEXT], keywords=list(self.keyword), free_form=False)
             logger.info("[keyword] inited.")
         except Exception as e:
             logger.warn("[keyword] init failed, ignore or see https://github.com/zhayujie/chatgpt-on-wechat/tree/master/plugins/keyword .")
             raise e
 
     def on_handle_context(self, e_context: EventContext):
-        if e_context["context"].type != ContextType.TEXT:
-            return
-
         content = e_context["context"].content.strip()
-        logger.info("[keyword] on_handle_context. content: %s" % content)
+        logger.debug("[keyword] on_handle_context. content: %s" % content)
         if content in self.keyword:
             logger.info(f"[keyword] 匹配到关键字【{content}】")
             reply_text = self.keyword[content]
@@ -0,0 +1,102 @@
+"""
+按manifest.json延迟加载插件
+
+插件目录中有manifest.json时，扫描插件只读取manifest，不导入插件代码，启用后先用LazyPlugin占位
+LazyPlugin按manifest中声明的事件、消息类型和指令注册处理函数，第一次有消息分发给它时才导入模块、创建真正的插件实例
+"""
+
+import json
+import os
+
+from bridge.context import ContextType
+from common.log import logger
+
+from .event import Event
+from .plugin import Plugin
+
+MANIFEST_FILE = "manifest.json"
+
+
+def load_manifest(plugin_path):
+    """
+    读取插件目录中的manifest.json，没有或格式不正确时返回None，按原来的方式导入插件
+    """
+    manifest_path = os.path.join(plugin_path, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if not manifest.get("name"):
+            raise ValueError("name is required")
+        for event, route in manifest.get("events", {}).items():
+            Event[event]
+            for ctype in route.get("context_types") or []:
+                ContextType[ctype]
+        return manifest
+    except Exception as e:
+        logger.warning("Invalid manifest %s, plugin will be imported directly: %s" % (manifest_path, e))
+        return None
+
+
+def build_lazy_plugin(manifest, plugin_path):
+    """
+    根据manifest生成占位的插件类，属性与@plugins.register设置的一致
+    """
+    return type(
+        "Lazy" + manifest["name"],
+        (LazyPlugin,),
+        {
+            "name": manifest["name"],
+            "priority": manifest.get("priority", 0),
+            "desc": manifest.get("desc"),
+            "author": manifest.get("author"),
+            "path": plugin_path,
+            "version": manifest.get("version", "1.0"),
+            "namecn": manifest.get("namecn", manifest["name"]),
+            "hidden": manifest.get("hidden", False),
+            "enabled": True,
+            "manifest": manifest,
+        },
+    )
+
+
+class LazyPlugin(Plugin):
+    lazy = True
+
+    def __init__(self):
+        super().__init__()
+        for event, route in self.manifest.get("events", {}).items():
+            context_types = route.get("context_types")
+            self.register_handler(
+                Event[event],
+                self._lazy_handler(Event[event]),
+                [ContextType[ctype] for ctype in context_types] if context_types is not None else None,
+                prefixes=route.get("prefixes"),
+                keywords=route.get("keywords"),
+                free_form=route.get("free_form", True),
+            )
+
+    def _lazy_handler(self, event):
+        def handler(e_context, *args, **kwargs):
+            instance = self._realize()
+            if instance is None or event not in instance.handlers:
+                return
+            context = e_context.econtext.get("context")
+            context_types = instance.handler_context_types.get(event)
+            if context is not None and context_types is not None and context.type not in context_types:
+                return
+            instance.handlers[event](e_context, *args, **kwargs)
+
+        return handler
+
+    def _realize(self):
+        from .plugin_manager import PluginManager
+
+        return PluginManager().realize_plugin(self.name.upper())
+
+    def get_help_text(self, **kwargs):
+        instance = self._realize()
+        if instance is None:
+            return ""
+        return instance.get_help_text(**kwargs)
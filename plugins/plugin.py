@@ -1,6 +1,37 @@
 class Plugin:
     def __init__(self):
         self.handlers = {}
+        self.handler_context_types = {}  # event -> 处理的ContextType集合，不在其中的事件处理所有类型
+        self.handler_routes = {}  # event -> (指令前缀, 关键词, 是否接收其他文字消息)，不在其中的事件接收所有文字消息
+
+    def register_handler(self, event, handler, context_types=None, prefixes=None, keywords=None, free_form=True):
+        """
+        注册事件的处理函数，context_types为处理的ContextType列表，为None时处理所有类型
+        PluginManager只把对应类型的消息分发给handler，handler中不需要再判断类型
+        对于文字消息，prefixes为指令前缀(不区分大小写)，keywords为需要完全匹配的关键词，可以使用{trigger_prefix}表示plugin_trigger_prefix
+        free_form为False时，只有以prefixes开头或等于keywords的文字消息才会分发给handler
+        """
+        self.handlers[event] = handler
+        if context_types is None:
+            self.handler_context_types.pop(event, None)
+        else:
+            self.handler_context_types[event] = frozenset(context_types)
+        if prefixes or keywords or not free_form:
+            self.handler_routes[event] = (tuple(prefixes or ()), tuple(keywords or ()), free_form)
+        else:
+            self.handler_routes.pop(event, None)
+
+    def set_free_form(self, event, free_form):
+        """
+        修改handler是否接收指令以外的文字消息，比如进入角色扮演、游戏等需要处理所有消息的状态时开启
+        """
+        prefixes, keywords, old = self.handler_routes.get(event, ((), (), True))
+        if old == free_form:
+            return
+        self.handler_routes[event] = (prefixes, keywords, free_form)
+        from .plugin_manager import PluginManager
+
+        PluginManager().rebuild_dispatch_tables()
 
     def get_help_text(self, **kwargs):
         return "暂无帮助信息"
@@ -4,14 +4,85 @@ import importlib
 import importlib.util
 import json
 import os
+import queue
 import sys
+import threading
+import time
 
+from bridge.context import ContextType
 from common.log import logger
+from common.metrics import (
+    PLUGIN_EVENT_DROPPED,
+    PLUGIN_EVENT_SECONDS,
+    PLUGIN_HANDLER_CALLS,
+    PLUGIN_HANDLER_ERRORS,
+    PLUGIN_HANDLER_MAX_SECONDS,
+    PLUGIN_HANDLER_SECONDS,
+)
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
-from config import conf
+from config import conf, snapshot, subscribe
 
 from .event import *
+from .lazy_plugin import build_lazy_plugin, load_manifest
+
+
+class CommandIndex:
+    """
+    文字消息的指令路由：指令前缀用前缀树、关键词用哈希表找到声明了该指令的插件
+    没有匹配的指令时只分发给接收任意文字消息(free_form)的插件，表是预先计算好的
+    """
+
+    def __init__(self, table, routes, trigger_prefix):
+        self.table = table  # TEXT类型的完整分发表
+        self.trie = {}
+        self.keywords = {}
+        free = set()
+        for index, name, handler in table:
+            route = routes.get(index)
+            if route is None or route[2]:
+                free.add(index)
+            if route is None:
+                continue
+            prefixes, keywords, _ = route
+            for prefix in prefixes:
+                node = self.trie
+                for ch in prefix.replace("{trigger_prefix}", trigger_prefix).lower():
+                    node = node.setdefault(ch, {})
+                node.setdefault(None, set()).add(index)  # None键保存以该节点结尾的前缀所属的插件
+            for keyword in keywords:
+                self.keywords.setdefault(keyword.replace("{trigger_prefix}", trigger_prefix), set()).add(index)
+        self.free = frozenset(free)
+        self.free_table = tuple(entry for entry in table if entry[0] in free)
+
+    def select(self, content):
+        matched = self.keywords.get(content.strip())
+        node = self.trie
+        for ch in content.lstrip():
+            node = node.get(ch.lower())
+            if node is None:
+                break
+            owners = node.get(None)
+            if owners:
+                matched = owners if not matched else matched | owners
+        if not matched:
+            return self.free_table
+        return tuple(entry for entry in self.table if entry[0] in self.free or entry[0] in matched)
+
+
+class HandlerStats:
+    """
+    一个插件处理一个事件的统计，emit_event中直接累加不加锁
+    多个线程同时更新时可能丢失极少量的计数，用来定位耗时的插件足够了
+    """
+
+    __slots__ = ("calls", "seconds", "max_seconds", "errors")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.errors = 0
 
 
 @singleton
@@ -19,10 +90,21 @@ class PluginManager:
     def __init__(self):
         self.plugins = SortedDict(lambda k, v: v.priority, reverse=True)
         self.listening_plugins = {}
+        self.dispatch_tables = {}  # (event, ContextType) -> ((序号, 插件名, handler), ...)，只包含开启的插件，按优先级排序
+        self.command_indexes = {}  # event -> CommandIndex，有插件声明了指令的事件才有
+        self.handler_stats = {}  # (插件名, event) -> HandlerStats
         self.instances = {}
         self.pconf = {}
         self.current_plugin_path = None
         self.loaded = {}
+        self.realize_lock = threading.RLock()
+        self.background_queue = None  # 后台分发的事件队列，第一次使用时创建
+        self.background_lock = threading.Lock()
+        subscribe(self._on_config_change)  # plugin_trigger_prefix修改后重建指令路由
+        PLUGIN_HANDLER_CALLS.set_function(lambda: self._stats_metrics("calls"))
+        PLUGIN_HANDLER_SECONDS.set_function(lambda: self._stats_metrics("seconds"))
+        PLUGIN_HANDLER_MAX_SECONDS.set_function(lambda: self._stats_metrics("max_seconds"))
+        PLUGIN_HANDLER_ERRORS.set_function(lambda: self._stats_metrics("errors"))
 
     def register(self, name: str, desire_priority: int = 0, **kwargs):
         def wrapper(plugincls):
@@ -72,6 +154,15 @@ class PluginManager:
                 # 判断插件是否包含同名__init__.py文件
                 main_module_path = os.path.join(plugin_path, "__init__.py")
                 if os.path.isfile(main_module_path):
+                    # 有manifest.json的插件只读取manifest，第一次用到时再导入
+                    if plugin_path not in self.loaded:
+                        manifest = load_manifest(plugin_path)
+                        if manifest is not None:
+                            if manifest["name"].upper() not in self.plugins:
+                                plugincls = build_lazy_plugin(manifest, plugin_path)
+                                self.plugins[manifest["name"].upper()] = plugincls
+                                logger.info("Plugin %s_v%s registered by manifest, path=%s" % (plugincls.name, plugincls.version, plugin_path))
+                            continue
                     # 导入插件
                     import_path = "plugins.{}".format(plugin_name)
                     try:
@@ -114,6 +205,45 @@ class PluginManager:
     def refresh_order(self):
         for event in self.listening_plugins.keys():
             self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        self.rebuild_dispatch_tables()
+
+    def rebuild_dispatch_tables(self):
+        """
+        预先计算每个(事件, 消息类型)需要调用的处理函数，开启/关闭插件、调整优先级后重建，emit_event中只需要查表
+        """
+        tables = {}
+        indexes = {}
+        trigger_prefix = snapshot().plugin_trigger_prefix
+        for event, names in self.listening_plugins.items():
+            entries = []
+            routes = {}
+            for name in names:
+                instance = self.instances.get(name)
+                if instance is None or name not in self.plugins or not self.plugins[name].enabled:
+                    continue
+                context_types = getattr(instance, "handler_context_types", {}).get(event)
+                route = getattr(instance, "handler_routes", {}).get(event)
+                if route is not None:
+                    routes[len(entries)] = route
+                entries.append((name, instance.handlers[event], context_types))
+            for ctype in list(ContextType) + [None]:
+                table = tuple((index, name, handler) for index, (name, handler, context_types) in enumerate(entries) if context_types is None or ctype in context_types)
+                if table:
+                    tables[(event, ctype)] = table
+            if routes and (event, ContextType.TEXT) in tables:
+                indexes[event] = CommandIndex(tables[(event, ContextType.TEXT)], routes, trigger_prefix)
+        # 整体替换，分发中的事件继续使用旧的表
+        self.dispatch_tables, self.command_indexes = tables, indexes
+
+    def _on_config_change(self, config):
+        self.rebuild_dispatch_tables()
+
+    def _select_table(self, tables, indexes, event, context):
+        if context is None:
+            return tables.get((event, None), ())
+        if context.type == ContextType.TEXT and event in indexes:
+            return indexes[event].select(context.content)
+        return tables.get((event, context.type), ())
 
     def activate_plugins(self):  # 生成新开启的插件实例
         failed_plugins = []
@@ -135,6 +265,66 @@ class PluginManager:
         self.refresh_order()
         return failed_plugins
 
+    def realize_plugin(self, name: str):
+        """
+        导入按manifest延迟加载的插件并替换占位实例，返回真正的插件实例，失败时关闭插件并返回None
+        """
+        with self.realize_lock:
+            instance = self.instances.get(name)
+            if instance is None or not getattr(instance, "lazy", False):
+                return instance
+            placeholder = self.plugins[name]
+            start = time.time()
+            try:
+                self.current_plugin_path = placeholder.path
+                self.loaded[placeholder.path] = importlib.import_module("plugins.{}".format(os.path.basename(placeholder.path)))
+            except Exception as e:
+                logger.exception("Failed to import plugin %s: %s" % (name, e))
+                self.disable_plugin(name)
+                return None
+            finally:
+                self.current_plugin_path = None
+            plugincls = self.plugins[name]
+            if plugincls is placeholder:
+                logger.error("Plugin %s not registered by its module, check the name in manifest.json" % name)
+                self.disable_plugin(name)
+                return None
+            # 注册时会用desire_priority覆盖plugins.json中的配置
+            plugincls.enabled = placeholder.enabled
+            plugincls.priority = placeholder.priority
+            self.plugins._update_heap(name)
+            try:
+                instance = plugincls()
+            except Exception as e:
+                logger.exception("Failed to init %s, diabled. %s" % (name, e))
+                self.disable_plugin(name)
+                return None
+            self.instances[name] = instance
+            for event in self.listening_plugins:
+                if name in self.listening_plugins[event]:
+                    self.listening_plugins[event].remove(name)
+            for event in instance.handlers:
+                self.listening_plugins.setdefault(event, []).append(name)
+            self.refresh_order()
+            logger.info("Plugin %s loaded in %.2fs" % (name, time.time() - start))
+            return instance
+
+    def prewarm_plugins(self):
+        """
+        在后台按优先级依次加载所有开启的延迟加载插件，避免第一条消息等待插件导入
+        """
+        names = [name for name, instance in self.instances.items() if getattr(instance, "lazy", False)]
+        if not names:
+            return
+        names.sort(key=lambda name: self.plugins[name].priority, reverse=True)
+
+        def prewarm():
+            for name in names:
+                self.realize_plugin(name)
+
+        thread = threading.Thread(target=prewarm, name="plugin_prewarm", daemon=True)
+        thread.start()
+
     def reload_plugin(self, name: str):
         name = name.upper()
         if name in self.instances:
@@ -157,17 +347,112 @@ class PluginManager:
         self.activate_plugins()
 
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.info("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.info("Plugin %s breaked event %s" % (name, e_context.event))
+        context = e_context.econtext.get("context")
+        tables, indexes = self.dispatch_tables, self.command_indexes
+        table = self._select_table(tables, indexes, e_context.event, context)
+        if not table:  # 没有插件处理该消息
+            return e_context
+        state = (context.type, context.content) if context is not None else None
+        handler_stats = self.handler_stats
+        start = time.time()
+        i = 0
+        while i < len(table) and e_context.action == EventAction.CONTINUE:
+            index, name, handler = table[i]
+            i += 1
+            logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+            stats = handler_stats.get((name, e_context.event))
+            if stats is None:
+                stats = handler_stats.setdefault((name, e_context.event), HandlerStats())
+            handler_start = time.perf_counter()
+            try:
+                handler(e_context, *args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - handler_start
+                stats.calls += 1
+                stats.seconds += elapsed
+                if elapsed > stats.max_seconds:
+                    stats.max_seconds = elapsed
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.info("Plugin %s breaked event %s" % (name, e_context.event))
+                break
+            context = e_context.econtext.get("context")
+            new_state = (context.type, context.content) if context is not None else None
+            if new_state != state:  # 插件修改了消息类型或内容，后面的插件按新的消息分发
+                state = new_state
+                table = self._select_table(tables, indexes, e_context.event, context)
+                i = next((j for j, entry in enumerate(table) if entry[0] > index), len(table))
+        channel = e_context.econtext.get("channel")
+        PLUGIN_EVENT_SECONDS.observe(time.time() - start, channel=getattr(channel, "channel_type", ""), event=e_context.event.name.lower())
         return e_context
 
+    def emit_event_background(self, e_context: EventContext):
+        """
+        在后台线程中分发事件，调用方不等待插件处理完成，用于AFTER_SEND_REPLY等只需要观察结果的事件
+        队列满时丢弃事件并计数，返回是否已加入队列
+        """
+        if not self._select_table(self.dispatch_tables, self.command_indexes, e_context.event, e_context.econtext.get("context")):
+            return False  # 没有插件处理该事件
+        background_queue = self.background_queue
+        if background_queue is None:
+            background_queue = self._start_background_workers()
+        try:
+            background_queue.put_nowait(e_context)
+            return True
+        except queue.Full:
+            PLUGIN_EVENT_DROPPED.inc(event=e_context.event.name.lower())
+            logger.debug("[PluginManager] background queue is full, event %s dropped" % e_context.event)
+            return False
+
+    def _start_background_workers(self):
+        with self.background_lock:
+            if self.background_queue is None:
+                config = snapshot()
+                # 队列长度和线程数在第一次使用时确定，修改后需要重启生效
+                background_queue = queue.Queue(maxsize=max(config.plugin_background_queue_size, 1))
+                for i in range(max(config.plugin_background_workers, 1)):
+                    _thread = threading.Thread(target=self._background_loop, args=(background_queue,), name="plugin_background_{}".format(i), daemon=True)
+                    _thread.start()
+                self.background_queue = background_queue
+            return self.background_queue
+
+    def _background_loop(self, background_queue):
+        while True:
+            e_context = background_queue.get()
+            try:
+                self.emit_event(e_context)
+            except Exception as e:
+                logger.exception("[PluginManager] background event %s failed: %s" % (e_context.event, e))
+
+    def plugin_stats(self, top=None):
+        """
+        返回各插件处理函数的统计，按累计耗时从大到小排序
+        """
+        items = []
+        for (name, event), stats in list(self.handler_stats.items()):
+            items.append(
+                {
+                    "plugin": name,
+                    "event": event.name.lower(),
+                    "calls": stats.calls,
+                    "seconds": stats.seconds,
+                    "avg_seconds": stats.seconds / stats.calls if stats.calls else 0.0,
+                    "max_seconds": stats.max_seconds,
+                    "errors": stats.errors,
+                }
+            )
+        items.sort(key=lambda item: item["seconds"], reverse=True)
+        return items[:top] if top else items
+
+    def reset_plugin_stats(self):
+        self.handler_stats = {}
+
+    def _stats_metrics(self, field):
+        return [({"plugin": name, "event": event.name.lower()}, getattr(stats, field)) for (name, event), stats in list(self.handler_stats.items())]
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -207,6 +492,7 @@ class PluginManager:
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
+            self.rebuild_dispatch_tables()
             return True
         return True
 
@@ -305,8 +591,10 @@ class PluginManager:
                 if name in self.listening_plugins[event]:
                     self.listening_plugins[event].remove(name)
             del self.plugins[name]
+            self.rebuild_dispatch_tables()
             del self.pconf["plugins"][rawname]
-            self.loaded[dirname] = None
+            if dirname in self.loaded:  # 未导入过的延迟加载插件，重新安装后按manifest注册
+                self.loaded[dirname] = None
             self.save_config()
             return True, "卸载插件成功"
         except Exception as e:
@@ -27,7 +27,7 @@ class RolePlay:
     def action(self, user_action):
         session = self.bot.sessions.build_session(self.sessionid)
         if session.system_prompt != self.desc:  # 目前没有触发session过期事件，这里先简单判断，然后重置
-            session.set_system_prompt(self.desc)
+            self.bot.sessions.build_session(self.sessionid, system_prompt=self.desc)  # 通过SessionManager修改，会话存储在其他进程中时也能生效
         prompt = self.wrapper % user_action
         return prompt
 
@@ -64,7 +64,14 @@ class Role(Plugin):
 
             if len(self.roles) == 0:
                 raise Exception("no role found")
-            self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+            # 有会话在角色扮演时才需要处理其他文字消息
+            self.register_handler(
+                Event.ON_HANDLE_CONTEXT,
+                self.on_handle_context,
+                [ContextType.TEXT],
+                prefixes=["{trigger_prefix}停止扮演", "{trigger_prefix}角色", "{trigger_prefix}role", "{trigger_prefix}设定扮演"],
+                free_form=False,
+            )
             self.roleplays = {}
             logger.info("[Role] inited")
         except Exception as e:
@@ -96,8 +103,6 @@ class Role(Plugin):
         return found_role
 
     def on_handle_context(self, e_context: EventContext):
-        if e_context["context"].type != ContextType.TEXT:
-            return
         btype = Bridge().get_bot_type("chat")
         if btype not in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI]:
             return
@@ -112,6 +117,7 @@ class Role(Plugin):
             if sessionid in self.roleplays:
                 self.roleplays[sessionid].reset()
                 del self.roleplays[sessionid]
+                self.set_free_form(Event.ON_HANDLE_CONTEXT, len(self.roleplays) > 0)
             reply = Reply(ReplyType.INFO, "角色扮演结束!")
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
@@ -150,7 +156,7 @@ class Role(Plugin):
             return
         elif sessionid not in self.roleplays:
             return
-        logger.info("[Role] on_handle_context. content: %s" % content)
+        logger.debug("[Role] on_handle_context. content: %s" % content)
         if desckey is not None:
             if len(clist) == 1 or (len(clist) > 1 and clist[1].lower() in ["help", "帮助"]):
                 reply = Reply(ReplyType.INFO, self.get_help_text(verbose=True))
@@ -170,11 +176,13 @@ class Role(Plugin):
                     self.roles[role][desckey],
                     self.roles[role].get("wrapper", "%s"),
                 )
+                self.set_free_form(Event.ON_HANDLE_CONTEXT, True)
                 reply = Reply(ReplyType.INFO, f"预设角色为 {role}:\n" + self.roles[role][desckey])
                 e_context["reply"] = reply
                 e_context.action = EventAction.BREAK_PASS
         elif customize == True:
             self.roleplays[sessionid] = RolePlay(bot, sessionid, clist[1], "%s")
+            self.set_free_form(Event.ON_HANDLE_CONTEXT, True)
             reply = Reply(ReplyType.INFO, f"角色设定为:\n{clist[1]}")
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
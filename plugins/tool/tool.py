@@ -25,7 +25,7 @@ from plugins import *
 class Tool(Plugin):
     def __init__(self):
         super().__init__()
-        self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+        self.register_handler(Event.ON_HANDLE_CONTEXT, self.on_handle_context, [ContextType.TEXT], prefixes=["{trigger_prefix}tool"], free_form=False)
 
         self.app = self._reset_app()
 
@@ -47,9 +47,6 @@ class Tool(Plugin):
         return help_text
 
     def on_handle_context(self, e_context: EventContext):
-        if e_context["context"].type != ContextType.TEXT:
-            return
-
         # 暂时不支持未来扩展的bot
         if Bridge().get_bot_type("chat") not in (
             const.CHATGPT,
@@ -66,7 +63,7 @@ class Tool(Plugin):
             e_context.action = EventAction.CONTINUE
             return
 
-        logger.info("[tool] on_handle_context. content: %s" % content)
+        logger.debug("[tool] on_handle_context. content: %s" % content)
         reply = Reply()
         reply.type = ReplyType.TEXT
         trigger_prefix = conf().get("plugin_trigger_prefix", "$")